@@ -29,13 +29,15 @@ setup(name='slurm-accounting',
               'saccounting = slurm_accounting.saccounting:main',
               'sreporting = slurm_accounting.sreport:main',
               'periodic_reports = slurm_accounting.periodic_reports:main',
+              'sreporting_daemon = slurm_accounting.daemon:main',
           ]
         },
       keywords=['slurm'],
+      python_requires='>=3.8',
       classifiers=[
         'License :: OSI Approved :: BSD License',
         'Development Status :: 3 - Alpha',
-        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
         'Operating System :: POSIX :: Linux',
         'Topic :: Utilities',
       ],
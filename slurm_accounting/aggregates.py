@@ -0,0 +1,325 @@
+"""SQLite store of daily job aggregates for ad-hoc reports.
+
+    python -m slurm_accounting.aggregates load jobs.sqlite -s 2021-01 -e 2023-01
+    python -m slurm_accounting.aggregates query jobs.sqlite 'group*cpu_hours' \\
+        -s 2022-07 -e 2022-10 -w partition=gpu
+    python -m slurm_accounting.aggregates sql jobs.sqlite \\
+        "SELECT account, SUM(cpuseconds) / 3600 FROM daily GROUP BY account"
+
+The database holds:
+
+    daily  cpu seconds and job pieces (nonempty parts of jobs) per day,
+           cluster, user, group (grp), account and partition, split at
+           midnight like the daily grouping
+    jobs   the jobs themselves (start, end, ncpus, state...), for job counts
+    days   the days loaded, and whether their jobs data was final then
+           (query_grace elapsed after them)
+
+Loads only query the days that are missing or were not final. Grouping
+specs over user, group, account, partition, cluster and spans compile to
+one GROUP BY query on the daily table (job_count without spans on the jobs
+table), answered from the indexes without scanning sacct again.
+"""
+
+import datetime
+
+from .sreport import (
+    Report, Sacct, VALUES, cluster_list, leaves, make_sacct, parse_elapsed, parse_slurm_date,
+    print_date, print_datetime
+)
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS daily (
+        day TEXT NOT NULL,
+        cluster TEXT NOT NULL,
+        user TEXT NOT NULL,
+        grp TEXT NOT NULL,
+        account TEXT NOT NULL,
+        partition TEXT NOT NULL,
+        cpuseconds REAL NOT NULL,
+        jobs INTEGER NOT NULL,
+        PRIMARY KEY (day, cluster, user, grp, account, partition)
+    );
+    CREATE INDEX IF NOT EXISTS daily_user ON daily (user, day);
+    CREATE INDEX IF NOT EXISTS daily_grp ON daily (grp, day);
+    CREATE INDEX IF NOT EXISTS daily_account ON daily (account, day);
+    CREATE INDEX IF NOT EXISTS daily_partition ON daily (partition, day);
+
+    CREATE TABLE IF NOT EXISTS jobs (
+        cluster TEXT NOT NULL,
+        jobid TEXT NOT NULL,
+        user TEXT NOT NULL,
+        grp TEXT NOT NULL,
+        account TEXT NOT NULL,
+        partition TEXT NOT NULL,
+        state TEXT NOT NULL,
+        ncpus INTEGER NOT NULL,
+        start TEXT NOT NULL,
+        end TEXT,
+        PRIMARY KEY (cluster, jobid)
+    );
+    CREATE INDEX IF NOT EXISTS jobs_start ON jobs (start);
+
+    CREATE TABLE IF NOT EXISTS days (
+        day TEXT NOT NULL,
+        cluster TEXT NOT NULL,
+        final INTEGER NOT NULL,
+        PRIMARY KEY (day, cluster)
+    );
+'''
+
+# groupings of the daily rows, and of job counts
+KEYS = ('cluster', 'user', 'group', 'account', 'partition')
+LOAD_PLAN = ','.join('*'.join(('daily', ) + KEYS + (v, )) for v in ('cpu_seconds', 'job_count'))
+
+JOB_FIELDS = ('jobid', 'user', 'group', 'account', 'partition', 'state', 'ncpus', 'start', 'end')
+
+# grouping name: SQL expression of the daily table
+COLUMNS = {
+    'cluster': 'cluster',
+    'user': 'user',
+    'group': 'grp',
+    'account': 'account',
+    'partition': 'partition',
+    'daily': 'day',
+    'weekly': "date(day, 'weekday 0', '-6 days')",
+    'monthly': "substr(day, 1, 8) || '01'",
+    'quarterly': "printf('%s-%02d-01', substr(day, 1, 4), "
+                 "(CAST(substr(day, 6, 2) AS INTEGER) - 1) / 3 * 3 + 1)",
+    'yearly': "substr(day, 1, 5) || '01-01'",
+}
+
+# value name: SQL aggregate of the daily table, loaded into a VALUES bin
+AGGREGATES = {
+    'cpu_seconds': 'SUM(cpuseconds)',
+    'cpu_hours': 'SUM(cpuseconds)',
+    'job_count': 'SUM(jobs)',
+}
+
+
+def compile_spec(spec, start=None, end=None, where={}):
+    """(SQL, parameters) of a 'group * monthly * cpu_hours' like grouping
+
+    Jobs split between days only count once per day: job_count is only
+    exact without span groupings (counted on the jobs table), or daily.
+    """
+    *groupings, value = [s.strip() for s in spec.split('*')]
+
+    if value not in AGGREGATES:
+        raise ValueError('invalid grouping \'%s\': \'%s\' is not a value (%s)' %
+                         (spec, value, ', '.join(sorted(AGGREGATES))))
+    for g in groupings + list(where):
+        if g not in COLUMNS:
+            raise ValueError('invalid grouping \'%s\': unknown grouping \'%s\' (%s)' %
+                             (spec, g, ', '.join(sorted(COLUMNS))))
+
+    spans = [g for g in groupings if g not in KEYS]
+    table = 'daily'
+    columns = [COLUMNS[g] for g in groupings]
+    aggregate = AGGREGATES[value]
+    conditions = []
+    params = []
+
+    if value == 'job_count' and not spans:
+        table = 'jobs'
+        aggregate = 'COUNT(*)'
+        conditions.append('state != \'PENDING\'')
+        if start is not None:
+            conditions.append('(end IS NULL OR end >= ?)')
+            params.append(print_datetime(parse_slurm_date(start)))
+        if end is not None:
+            conditions.append('start <= ?')
+            params.append(print_datetime(parse_slurm_date(end)))
+    else:
+        if value == 'job_count' and spans != ['daily']:
+            raise ValueError('invalid grouping \'%s\': job_count can only be split daily' % spec)
+        if start is not None:
+            conditions.append('day >= ?')
+            params.append(print_date(parse_slurm_date(start)))
+        if end is not None:
+            conditions.append('day < ?')
+            params.append(print_date(parse_slurm_date(end)))
+
+    for g, v in sorted(where.items()):
+        conditions.append('{} = ?'.format(COLUMNS[g]))
+        params.append(v)
+
+    sql = 'SELECT {} FROM {}'.format(', '.join(columns + [aggregate]), table)
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    if columns:
+        keys = ', '.join(str(i + 1) for i in range(len(columns)))
+        sql += ' GROUP BY {} ORDER BY {}'.format(keys, keys)
+
+    return sql, params
+
+
+class Aggregates(object):
+    def __init__(self, path):
+        import sqlite3
+
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def loaded(self, cluster):
+        """days of cluster already loaded with final jobs data"""
+        return {d for d, in self.db.execute('SELECT day FROM days WHERE cluster = ? AND final',
+                                            (cluster, ))}
+
+    def load(self, cfg, start, end, report=None, clusters=None, reload=False, now=None):
+        """load the missing days of start to end, one sacct query per month at most"""
+        now = now or datetime.datetime.now()
+        query_grace = parse_elapsed(cfg.get('general', 'query_grace', '00:00:00'))
+        start_date, end_date = parse_slurm_date(start), parse_slurm_date(end)
+        day = datetime.timedelta(days=1)
+
+        n = 0
+        for c in cluster_list(cfg, clusters) or [None]:
+            done = set() if reload else self.loaded(c or 'local')
+
+            # runs of consecutive missing days
+            windows = []
+            d = start_date
+            while d < end_date:
+                if print_date(d) not in done:
+                    if windows and windows[-1][1] == d and d.day != 1:
+                        windows[-1][1] = d + day
+                    else:
+                        windows.append([d, d + day])
+                d += day
+
+            for s, e in windows:
+                n += self.load_window(cfg, report, c, s, e, e + query_grace <= now)
+
+        return n
+
+    def load_window(self, cfg, report, cluster, start_date, end_date, final):
+        """replace the aggregates of start_date to end_date days, return the job count"""
+        r = Report(cfg, report, LOAD_PLAN, print_date(start_date), print_date(end_date),
+                   cluster=cluster)
+        src = make_sacct(cfg, format=Sacct.sorted_format(r.fields() | set(JOB_FIELDS)),
+                         cluster=cluster)
+
+        cluster = r.cluster_name()
+        jobs = []
+        for batch in src.batches(start=print_datetime(r.query_start_date),
+                                 end=print_datetime(r.query_end_date),
+                                 partition=r.partition, nodes=r.selected_nodes_spec,
+                                 states=r.states):
+            r.batch(batch)
+            jobs += [
+                (cluster, jobid, user, group, account, partition, state, int(ncpus), start,
+                 None if end == 'Unknown' else end)
+                for jobid, user, group, account, partition, state, ncpus, start, end
+                in zip(*[batch[f] for f in JOB_FIELDS]) if state != 'PENDING'
+            ]
+
+        (cpuseconds, _), (counts, _) = r.groupings
+        counts = dict(leaves(counts, len(KEYS) + 1))
+        rows = [keys + (b[0], counts[keys][0])
+                for keys, b in leaves(cpuseconds, len(KEYS) + 1)]
+
+        days = []
+        d = start_date
+        while d < end_date:
+            days.append((print_date(d), cluster, final))
+            d += datetime.timedelta(days=1)
+
+        with self.db:
+            self.db.execute('DELETE FROM daily WHERE cluster = ? AND day >= ? AND day < ?',
+                            (cluster, print_date(start_date), print_date(end_date)))
+            self.db.executemany('INSERT INTO daily VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.db.executemany('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                jobs)
+            self.db.executemany('INSERT OR REPLACE INTO days VALUES (?, ?, ?)', days)
+
+        print(r, print_date(start_date), print_date(end_date), len(jobs), 'jobs')
+        return len(jobs)
+
+    def execute(self, sql, params=()):
+        """(column names, rows) of a query"""
+        cursor = self.db.execute(sql, params)
+        return [d[0] for d in cursor.description], cursor.fetchall()
+
+    def query(self, spec, start=None, end=None, where={}):
+        """CSV of a grouping spec, values formatted like report ones"""
+        sql, params = compile_spec(spec, start, end, where)
+        _names, rows = self.execute(sql, params)
+
+        title = [s.strip() for s in spec.split('*')]
+        ret = '{}\n'.format('*'.join(title))
+        for *keys, v in rows:
+            value = VALUES[title[-1]]().load(float(v or 0))
+            ret += '{}\n'.format(','.join(list(keys) + [str(value)]))
+        return ret
+
+    def close(self):
+        self.db.close()
+
+
+def main():
+    import argparse
+    import csv
+    import sys
+    from . import config
+
+    parser = argparse.ArgumentParser(description='SQLite store of daily job aggregates')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+
+    p = sub.add_parser('load', help='load the missing days of a period')
+    p.add_argument('db', metavar='DB')
+    p.add_argument('report', metavar='REPORT', nargs='?', default=None,
+                   help='node selection of section [report:REPORT]')
+    p.add_argument('-s', '--start', metavar='START_DATE', required=True)
+    p.add_argument('-e', '--end', metavar='END_DATE', required=True)
+    p.add_argument('-c', '--clusters', metavar='CLUSTERS', default=None,
+                   help='comma separated [cluster:NAME] sections')
+    p.add_argument('--reload', action='store_true', default=False,
+                   help='load days already loaded too')
+    p.add_argument('--cfg', metavar='PATH',
+                   default=config.find_config_file(__file__, 'sreporting.conf'),
+                   help='config file')
+
+    p = sub.add_parser('query', help='print a grouping (e.g. group*monthly*cpu_hours)')
+    p.add_argument('db', metavar='DB')
+    p.add_argument('grouping', metavar='GROUPING_SPEC')
+    p.add_argument('-s', '--start', metavar='START_DATE', default=None)
+    p.add_argument('-e', '--end', metavar='END_DATE', default=None)
+    p.add_argument('-w', '--where', metavar='GROUPING=VALUE', action='append', default=[],
+                   help='only jobs of this user, group, account, partition or cluster')
+    p.add_argument('--sql', action='store_true', default=False,
+                   help='print the SQL query instead')
+
+    p = sub.add_parser('sql', help='print the rows of an SQL query, as CSV')
+    p.add_argument('db', metavar='DB')
+    p.add_argument('sql', metavar='SQL')
+
+    args = parser.parse_args()
+
+    store = Aggregates(args.db)
+
+    if args.command == 'load':
+        n = store.load(config.Config(args.cfg), args.start, args.end, args.report,
+                       args.clusters, args.reload)
+        print('loaded', n, 'jobs')
+
+    elif args.command == 'query':
+        where = dict(w.split('=', 1) for w in args.where)
+        if args.sql:
+            print(*compile_spec(args.grouping, args.start, args.end, where))
+        else:
+            print(store.query(args.grouping, args.start, args.end, where), end='')
+
+    elif args.command == 'sql':
+        names, rows = store.execute(args.sql)
+        out = csv.writer(sys.stdout, lineterminator='\n')
+        out.writerow(names)
+        out.writerows(rows)
+
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
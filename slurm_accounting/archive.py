@@ -0,0 +1,429 @@
+"""Local job archive for ad-hoc historical reports.
+
+An archive directory holds:
+
+    jobs.dat      fixed-width job records sorted by start time
+    days.idx      per-day offset index: first record starting on each day
+    symbols.json  interned strings (users, groups, partitions, nodelists...)
+    meta.json     first day, record count, max job duration, running jobs,
+                  generation (incremented by each fill)
+
+Readers mmap jobs.dat and only unpack the records of the days a window may
+overlap: from window start minus the longest job duration (plus jobs still
+running when archived) to window end.
+
+    python -m slurm_accounting.archive fill ARCHIVE_DIR [DUMP...]
+    python -m slurm_accounting.archive fill ARCHIVE_DIR --sacct -s 2022-01 -e 2022-02
+    python -m slurm_accounting.archive info ARCHIVE_DIR
+
+Dumps are `sacct --parsable2` outputs, with their header line or in
+Sacct.default_format order. Their job step rows (jobid.step) are skipped.
+"""
+
+import os
+import json
+import struct
+import datetime
+
+from .sreport import JobBatch, parse_slurm_datetime, print_datetime
+from .symbols import TABLES
+
+EPOCH = datetime.datetime(1970, 1, 1)
+DAY = 86400
+
+# start, end (-1: running), jobid, then ncpus and symbol ids
+RECORD = struct.Struct('<qqqIIIIIIIII')
+SYMBOL_FIELDS = ('jobid_suffix', 'user', 'group', 'account', 'partition', 'state', 'nodelist',
+                 'alloctres')
+
+
+def seconds(s):
+    d = parse_slurm_datetime(s)
+    return -1 if d is None else int((d - EPOCH).total_seconds())
+
+
+def print_seconds(t):
+    return 'Unknown' if t < 0 else print_datetime(EPOCH + datetime.timedelta(seconds=t))
+
+
+def print_elapsed(t):
+    days, t = divmod(int(t), DAY)
+    h, t = divmod(t, 3600)
+    m, s = divmod(t, 60)
+    return ('%d-' % days if days else '') + '%02d:%02d:%02d' % (h, m, s)
+
+
+def split_jobid(jobid):
+    """1234, 1234_5, 1234+0 as (1234, suffix)"""
+    digits = len(jobid) - len(jobid.lstrip('0123456789'))
+    return int(jobid[:digits] or 0), jobid[digits:]
+
+
+class Archive(object):
+    # sacct fields stored, and fields derived from them
+    format = ('jobid', 'user', 'ncpus', 'partition', 'nodelist', 'group', 'account', 'start',
+              'end', 'state', 'alloctres')
+    derived = ('elapsed', 'elapsedraw')
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = {'first_day': 0, 'count': 0, 'max_duration': 0, 'running': [],
+                     'generation': 0}
+        self.symbols = ['']
+        self.days = []
+        self.data = None
+
+        if os.path.isfile(self.file('meta.json')):
+            with open(self.file('meta.json')) as f:
+                self.meta = json.load(f)
+            with open(self.file('symbols.json')) as f:
+                self.symbols = json.load(f)
+            with open(self.file('days.idx'), 'rb') as f:
+                raw = f.read()
+            self.days = list(struct.unpack('<%dq' % (len(raw) // 8), raw))
+
+        self.ids = {s: i for i, s in enumerate(self.symbols)}
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    @property
+    def generation(self):
+        return self.meta['generation']
+
+    def __len__(self):
+        return self.meta['count']
+
+    def intern(self, s):
+        i = self.ids.get(s)
+        if i is None:
+            i = self.ids[s] = len(self.symbols)
+            self.symbols.append(s)
+        return i
+
+    def mapped(self):
+        """jobs.dat mapped in memory (None when empty)"""
+        import mmap
+
+        if self.data is None and self.meta['count']:
+            with open(self.file('jobs.dat'), 'rb') as f:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.data
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+
+    def record(self, row):
+        jobid, suffix = split_jobid(row['jobid'])
+        row = dict(row, jobid_suffix=suffix)
+        return ((seconds(row['start']), seconds(row['end']), jobid, int(row['ncpus'] or 0))
+                + tuple(self.intern(row.get(f, '')) for f in SYMBOL_FIELDS))
+
+    def records(self, first=0, last=None):
+        data = self.mapped()
+        if data is None:
+            return iter(())
+        last = self.meta['count'] if last is None else last
+        return RECORD.iter_unpack(memoryview(data)[first * RECORD.size:last * RECORD.size])
+
+    def record_at(self, i):
+        return next(self.records(i, i + 1))
+
+    def fill(self, rows, now=None):
+        """add sacct rows (dicts), replacing already archived jobs
+
+        Records are sorted by start time: only the records from the day of
+        the first new job on (or from a replaced job still running when
+        archived) are unpacked and rewritten, merged with the new ones. New
+        jobs starting after the archived ones are appended.
+        """
+        now = int(((now or datetime.datetime.now()) - EPOCH).total_seconds())
+
+        new = {}
+        for row in rows:
+            if row['start'] in ('Unknown', 'None', ''):
+                # pending jobs are archived once started
+                continue
+            if '.' in row['jobid']:
+                # step rows of dumps made without sacct -X: the archive has
+                # no step usage (totalcpu, maxrss) to fold into their job
+                continue
+            r = self.record(row)
+            new[(r[2], r[4])] = r
+
+        if not new:
+            return 0
+
+        keys = set(new)
+        new = sorted(new.values(), key=lambda r: r[0])
+
+        count = self.meta['count']
+        cut = self.day_offset(new[0][0]) if count else 0
+        for i in self.meta['running']:
+            if i >= cut:
+                break
+            r = self.record_at(i)
+            if (r[2], r[4]) in keys:
+                cut = i
+                break
+
+        head_last = self.record_at(cut - 1)[0] if cut else None
+        tail = [r for r in self.records(cut) if (r[2], r[4]) not in keys]
+        append = len(tail) == count - cut and (not tail or tail[-1][0] <= new[0][0])
+        tail = sorted(tail + new, key=lambda r: r[0])
+
+        os.makedirs(self.path, exist_ok=True)
+
+        if append:
+            self.close()
+            with open(self.file('jobs.dat'), 'ab') as f:
+                for r in new:
+                    f.write(RECORD.pack(*r))
+        else:
+            # readers may have the file mapped: write a new one, the head as is
+            tmp = self.file('jobs.dat.tmp')
+            with open(tmp, 'wb') as f:
+                if cut:
+                    f.write(self.mapped()[:cut * RECORD.size])
+                for r in tail:
+                    f.write(RECORD.pack(*r))
+            self.close()
+            os.replace(tmp, self.file('jobs.dat'))
+
+        self.index(cut, head_last, tail, now)
+        return len(new)
+
+    def index(self, cut, head_last, tail, now):
+        """update the day index and meta, records from cut on being tail
+
+        head_last is the start of the last record before cut.
+        """
+        if cut:
+            first_day = self.meta['first_day']
+            # days starting up to the last kept record keep their offset
+            keep = head_last // DAY - first_day + 1
+            days = self.days[:keep]
+            max_duration = self.meta['max_duration']
+            running = [i for i in self.meta['running'] if i < cut]
+        else:
+            first_day = tail[0][0] // DAY
+            days = []
+            max_duration = 0
+            running = []
+
+        i = 0
+        for d in range(first_day + len(days), tail[-1][0] // DAY + 2):
+            while i < len(tail) and tail[i][0] < d * DAY:
+                i += 1
+            days.append(cut + i)
+
+        for i, r in enumerate(tail):
+            if r[1] < 0:
+                running.append(cut + i)
+            else:
+                max_duration = max(max_duration, r[1] - r[0])
+
+        self.days = days
+        self.meta = {
+            'first_day': first_day,
+            'count': cut + len(tail),
+            'max_duration': max_duration,
+            'running': running,
+            'generation': self.meta['generation'] + 1,
+            'filled': print_seconds(now),
+        }
+
+        with open(self.file('days.idx'), 'wb') as f:
+            f.write(struct.pack('<%dq' % len(days), *days))
+        with open(self.file('symbols.json'), 'w') as f:
+            json.dump(self.symbols, f)
+        with open(self.file('meta.json'), 'w') as f:
+            json.dump(self.meta, f)
+
+    def day_offset(self, t):
+        """index of the first record starting on or after the day of t"""
+        d = t // DAY - self.meta['first_day']
+        if d <= 0:
+            return 0
+        if d >= len(self.days):
+            return self.meta['count']
+        return self.days[d]
+
+    def overlapping(self, start=None, end=None):
+        """records of the jobs overlapping [start, end] (seconds)"""
+        start = 0 if start is None else start
+        end = (1 << 62) if end is None else end
+
+        first = self.day_offset(start - self.meta['max_duration'])
+        last = self.day_offset(end + DAY)
+
+        for r in self.records(first, last):
+            if r[0] <= end and (r[1] < 0 or r[1] >= start):
+                yield r
+
+        # running when archived, possibly longer than max_duration
+        for i in self.meta['running']:
+            if i < first:
+                r = next(self.records(i, i + 1))
+                if r[0] <= end:
+                    yield r
+
+    def batches(self, start=None, end=None, partition=None, nodes=None, states=[],
+                other_args=[], columns=None, block_size=65536, steps=False, format=None):
+        """Sacct.batches() compatible query, states only select overlapping jobs"""
+        from .slurm_config import parse_node_spec
+
+        format = format or self.format
+        unknown = set(format) - set(self.format) - set(self.derived)
+        if unknown or steps:
+            raise ValueError('archive has no %s' % ', '.join(sorted(unknown) or ['job steps']))
+
+        columns = columns or list(format)
+        start = seconds(start) if start is not None else None
+        end = seconds(end) if end is not None else None
+        partition = self.ids.get(partition, -1) if partition is not None else None
+        nodes = set(parse_node_spec(nodes)) if nodes else None
+
+        node_match = {}
+
+        def selected(r):
+            if partition is not None and r[8] != partition:
+                return False
+            if nodes is not None:
+                if r[10] not in node_match:
+                    node_match[r[10]] = bool(nodes.intersection(
+                        parse_node_spec(self.symbols[r[10]]) if self.symbols[r[10]] else ()
+                    ))
+                return node_match[r[10]]
+            return True
+
+        sym = self.symbols
+        getters = {
+            'jobid': lambda r: str(r[2]) + sym[r[4]],
+            'start': lambda r: print_seconds(r[0]),
+            'end': lambda r: print_seconds(r[1]),
+            'ncpus': lambda r: str(r[3]),
+            'elapsedraw': lambda r: str(max(0, r[1] - r[0])),
+            'elapsed': lambda r: print_elapsed(max(0, r[1] - r[0])),
+        }
+        for i, f in enumerate(SYMBOL_FIELDS):
+            if f in TABLES:
+                # archive symbols translated once to the process ones
+                getters[f] = (lambda k, s: lambda r: s[r[k]])(4 + i, TABLES[f].intern_column(sym))
+            elif f not in getters:
+                getters[f] = (lambda k: lambda r: sym[r[k]])(4 + i)
+
+        rows = []
+        for r in self.overlapping(start, end):
+            if selected(r):
+                rows.append(r)
+            if len(rows) == block_size:
+                yield JobBatch({c: [getters[c](r) for r in rows] for c in columns}, len(rows))
+                rows = []
+        if rows:
+            yield JobBatch({c: [getters[c](r) for r in rows] for c in columns}, len(rows))
+
+
+class ArchiveSacct(object):
+    """Archive queries with a Sacct interface, for reports and the planner"""
+    # as FileSource: fields queries can ask for, missing features
+    dump_format = Archive.format + Archive.derived
+    unavailable = ('steps', )
+
+    def __init__(self, archive, format=None):
+        self.archive = archive
+        self.format = tuple(format or Archive.format)
+
+    def generation(self):
+        return str(self.archive.generation)
+
+    def batches(self, columns=None, **kwargs):
+        return self.archive.batches(columns=columns, format=self.format, **kwargs)
+
+    def __call__(self, start=None, end=None, partition=None, nodes=None, states=[],
+                 other_args=[]):
+        for batch in self.batches(start=start, end=end, partition=partition, nodes=nodes,
+                                  states=states):
+            for r in batch.rows():
+                yield r
+
+
+def read_dump(f):
+    """rows of a sacct --parsable2 dump, with or without header line
+
+    Headerless dumps are in Sacct.default_format order, as for dump:
+    sources. A line with another number of fields is an error.
+    """
+    from .sreport import Sacct
+
+    format = None
+    for n, l in enumerate(f, 1):
+        values = l.rstrip('\n').split('|')
+        if format is None:
+            if values[0].lower() == 'jobid':
+                format = [v.lower() for v in values]
+                continue
+            format = list(Sacct.default_format)
+        if len(values) == len(format):
+            yield dict(zip(format, values))
+        elif l.strip():
+            raise ValueError('%s:%d: %d fields, expected %d (%s)' % (
+                getattr(f, 'name', 'dump'), n, len(values), len(format), '|'.join(format)))
+
+
+def main():
+    import argparse
+    from . import config
+    from .sreport import make_sacct
+
+    parser = argparse.ArgumentParser(description='local job archive')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+
+    p = sub.add_parser('fill', help='add sacct dumps or a sacct query to the archive')
+    p.add_argument('archive', metavar='ARCHIVE_DIR')
+    p.add_argument('dumps', metavar='DUMP', nargs='*', help='sacct --parsable2 outputs')
+    p.add_argument('--sacct', action='store_true', default=False,
+                   help='query sacct instead of reading dumps')
+    p.add_argument('-s', '--start', metavar='START_DATE', default=None)
+    p.add_argument('-e', '--end', metavar='END_DATE', default=None)
+    p.add_argument('--cfg', metavar='PATH',
+                   default=config.find_config_file(__file__, 'sreporting.conf'),
+                   help='config file, for the sacct command')
+
+    p = sub.add_parser('info', help='archive summary')
+    p.add_argument('archive', metavar='ARCHIVE_DIR')
+
+    args = parser.parse_args()
+
+    archive = Archive(args.archive)
+
+    if args.command == 'fill':
+        if args.sacct:
+            from .sreport import parse_slurm_date
+
+            src = make_sacct(config.Config(args.cfg), format=Archive.format, source='sacct')
+            start = args.start and print_datetime(parse_slurm_date(args.start))
+            end = args.end and print_datetime(parse_slurm_date(args.end))
+            n = archive.fill(src(start=start, end=end, states=['RUNNING']))
+        else:
+            n = 0
+            for path in args.dumps:
+                with open(path) as f:
+                    n += archive.fill(read_dump(f))
+        print('archived', n, 'jobs, generation', archive.generation)
+
+    elif args.command == 'info':
+        meta = archive.meta
+        print('jobs,{}'.format(meta['count']))
+        print('symbols,{}'.format(len(archive.symbols)))
+        print('first_day,{}'.format(print_seconds(meta['first_day'] * DAY)[:10]))
+        print('max_duration,{}'.format(print_elapsed(meta['max_duration'])))
+        print('running,{}'.format(len(meta['running'])))
+        print('generation,{}'.format(meta['generation']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+"""Benchmarks catching performance regressions.
+
+    python -m slurm_accounting.benchmarks startup
+
+checks that importing the CLI modules stays within an import time budget
+(measured with python -X importtime, interpreter startup excluded) and that
+heavy or optional modules are only imported by the code paths needing them.
+
+    python -m slurm_accounting.benchmarks parse
+
+compares per-row and batch parsing of synthetic sacct output.
+
+    python -m slurm_accounting.benchmarks shard -j 8
+
+compares single process and sharded aggregation of a synthetic report, or
+of jobs replayed from a dump (--source dump:PATH).
+
+    python -m slurm_accounting.benchmarks slurm_conf -n 50000
+
+times parsing a generated slurm.conf of n nodes spread over Include files.
+"""
+
+import sys
+
+
+# CLI entry modules and their import time budget (microseconds)
+STARTUP_BUDGET = {
+    'slurm_accounting.saccounting': 40000,
+    'slurm_accounting.sreport': 40000,
+    'slurm_accounting.periodic_reports': 40000,
+}
+
+# must not be imported just by loading a CLI module
+STARTUP_FORBIDDEN = (
+    'subprocess', 'tempfile', 'configparser', 'argparse', 'shutil',
+    'concurrent.futures', 'multiprocessing', 'http.server', 'sqlite3', 'zlib',
+    'numpy', 'pyarrow',
+)
+
+
+def import_profile(statement):
+    """run statement with -X importtime, return {module: self time in us}"""
+    import subprocess
+
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                       universal_newlines=True, check=True)
+
+    ret = {}
+    for l in p.stderr.splitlines():
+        if not l.startswith('import time:') or 'self [us]' in l:
+            continue
+        self_us, _cumulative, name = l.split(':', 1)[1].split('|')
+        ret[name.strip()] = int(self_us)
+
+    return ret
+
+
+def import_cost(module, runs=5):
+    """best of runs import time of module, interpreter startup excluded"""
+    best = None
+    for _ in range(runs):
+        base = import_profile('pass')
+        profile = import_profile('import ' + module)
+        own = {k: v for k, v in profile.items() if k not in base}
+        total = sum(own.values())
+        if best is None or total < best[0]:
+            best = (total, own)
+
+    return best
+
+
+def startup(runs=5, budget_scale=1.):
+    failures = []
+
+    print('module,import_us,budget_us,forbidden')
+    for module, budget in sorted(STARTUP_BUDGET.items()):
+        total, own = import_cost(module, runs)
+        budget = int(budget * budget_scale)
+        forbidden = sorted(m for m in own if m in STARTUP_FORBIDDEN)
+
+        print('{},{},{},{}'.format(module, total, budget, ' '.join(forbidden)))
+
+        if total > budget:
+            failures.append('{} imports in {}us, budget is {}us'.format(module, total, budget))
+        if forbidden:
+            failures.append('{} imports {}'.format(module, ', '.join(forbidden)))
+
+    for f in failures:
+        print('FAIL', f, file=sys.stderr)
+
+    return 1 if failures else 0
+
+
+def synthetic_sacct(n, seed=0):
+    """n lines of sacct --parsable2 output in Sacct.default_format"""
+    import random
+
+    from .sreport import Sacct
+
+    rnd = random.Random(seed)
+    values = {
+        'jobid': lambda i: str(100000 + i),
+        'user': lambda i: 'user%03d' % rnd.randrange(500),
+        'elapsed': lambda i: '01:00:00',
+        'ncpus': lambda i: str(rnd.choice((1, 4, 16, 32, 128))),
+        'partition': lambda i: rnd.choice(('batch', 'gpu', 'bigmem')),
+        'nodelist': lambda i: 'n%03d' % rnd.randrange(300),
+        'group': lambda i: 'group%02d' % rnd.randrange(40),
+        'start': lambda i: '2022-03-%02dT%02d:00:00' % (rnd.randrange(1, 29), rnd.randrange(24)),
+        'end': lambda i: '2022-04-%02dT%02d:00:00' % (rnd.randrange(1, 29), rnd.randrange(24)),
+        'state': lambda i: rnd.choice(('COMPLETED', 'FAILED', 'RUNNING', 'TIMEOUT')),
+    }
+
+    return ''.join(
+        '|'.join(values[f](i) for f in Sacct.default_format) + '\n' for i in range(n)
+    ).encode()
+
+
+def parse(n=200000, columns=('start', 'end', 'ncpus', 'state', 'user', 'group')):
+    import io
+    import time
+
+    from .sreport import Sacct, split_blocks
+
+    data = synthetic_sacct(n)
+
+    t = time.perf_counter()
+    rows = 0
+    for l in io.BytesIO(data):
+        r = Sacct.filter(l.decode())
+        dict(list(zip(Sacct.default_format, r)))
+        rows += 1
+    per_row = time.perf_counter() - t
+
+    t = time.perf_counter()
+    f = io.BytesIO(data)
+    blocks = iter(lambda: f.read(1 << 20), b'')
+    batched = sum(len(b) for b in split_blocks(blocks, Sacct.default_format, list(columns)))
+    batch = time.perf_counter() - t
+
+    assert rows == batched == n
+
+    print('rows,per_row_s,batch_s,speedup')
+    print('{},{:.3f},{:.3f},{:.1f}'.format(n, per_row, batch, per_row / batch))
+
+    return 0
+
+
+class SyntheticSacct(object):
+    """Sacct stand-in serving synthetic_sacct() output"""
+    def __init__(self, n):
+        from .sreport import Sacct
+
+        self.format = Sacct.default_format
+        self.data = synthetic_sacct(n)
+
+    def cmdline(self, *args, **kwargs):
+        return []
+
+    def blocks(self, cmdline=[], block_size=1 << 20):
+        for i in range(0, len(self.data), block_size):
+            yield self.data[i:i + block_size]
+
+    def batches(self, steps=False, block_size=1 << 20, **kwargs):
+        from .sreport import split_blocks
+
+        return split_blocks(self.blocks(block_size=block_size), self.format)
+
+
+def shard(n=200000, processes=4,
+          grouping='user*cpu_hours,group*cpu_hours,monthly*group*cpu_hours,user*job_count',
+          source=None, start='2022-03-01', end='2022-05-01'):
+    """with source (see sources), replay captured jobs instead of synthetic ones"""
+    import io
+    import time
+
+    from . import config, planner
+    from .slurm_config import parse_slurm_conf
+    from .sreport import Report
+
+    cfg = config.Config('/nonexistent')
+    slurm_conf = parse_slurm_conf(io.StringIO('NodeName=n[000-299] Procs=128\n'))
+
+    if source is None:
+        src = SyntheticSacct(n)
+    else:
+        from .sources import make_source
+
+        r = Report(cfg, 'replay', grouping, start, end, slurm_conf=slurm_conf)
+        src = make_source(source, format=planner.fields(planner.plan([r])))
+        n = sum(len(b) for b in src.batches(start=start, end=end, states=['RUNNING']))
+
+    print('processes,rows,seconds,speedup')
+    rendered = None
+    base = None
+    for p in sorted({1, processes}):
+        r = Report(cfg, 'synthetic', grouping, start, end, slurm_conf=slurm_conf)
+
+        t = time.perf_counter()
+        planner.execute(planner.plan([r]), src, processes=p)
+        elapsed = time.perf_counter() - t
+        base = base or elapsed
+
+        print('{},{},{:.3f},{:.1f}'.format(p, n, elapsed, base / elapsed))
+
+        if rendered is None:
+            rendered = r.render()
+        elif r.render() != rendered:
+            print('FAIL sharded report differs', file=sys.stderr)
+            return 1
+
+    return 0
+
+
+def synthetic_slurm_conf(directory, n, per_file=5000):
+    """slurm.conf of n nodes in directory, NodeName lines in included files"""
+    import os
+
+    path = os.path.join(directory, 'slurm.conf')
+    with open(path, 'w') as f:
+        f.write('ClusterName=synthetic\n')
+        f.write('NodeName=DEFAULT CPUs=64 RealMemory=256000 State=UNKNOWN\n')
+        f.write('Include nodes.d/*.conf\n')
+        f.write('NodeSet=gpus Feature=gpu\n')
+        f.write('PartitionName=DEFAULT MaxTime=1-00:00:00 State=UP\n')
+        f.write('PartitionName=all Nodes=ALL Default=YES\n')
+        f.write('PartitionName=gpu Nodes=gpus\n')
+        f.write('PartitionName=half Nodes=n[%06d-%06d]\n' % (0, n // 2 - 1))
+
+    os.mkdir(os.path.join(directory, 'nodes.d'))
+    for k, first in enumerate(range(0, n, per_file)):
+        last = min(n, first + per_file) - 1
+        with open(os.path.join(directory, 'nodes.d', '%03d.conf' % k), 'w') as f:
+            # one line per rack of 40 nodes, like generated configurations
+            for r in range(first, last + 1, 40):
+                features = 'gpu' if r % 1000 == 0 else 'cpu'
+                f.write('NodeName=n[%06d-%06d] Features=%s\n' % (r, min(last, r + 39), features))
+
+    return path
+
+
+def slurm_conf(n=50000):
+    import tempfile
+    import time
+    import tracemalloc
+
+    from .slurm_config import nodes_procs, parse_slurm_conf, partition_nodes
+
+    with tempfile.TemporaryDirectory() as d:
+        path = synthetic_slurm_conf(d, n)
+
+        tracemalloc.start()
+        t = time.perf_counter()
+        with open(path) as f:
+            conf = parse_slurm_conf(f)
+        parse_s = time.perf_counter() - t
+        _, parse_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        t = time.perf_counter()
+        all_nodes = partition_nodes(conf['partitions']['all'])
+        half = partition_nodes(conf['partitions']['half'])
+        procs = nodes_procs(half, conf['nodes'])
+        gpus = len(conf['partitions']['gpu']['Nodes'])
+        index_s = time.perf_counter() - t
+
+    assert len(all_nodes) == n and procs == 64 * (n // 2)
+
+    print('nodes,parse_s,parse_peak_kb,index_s,gpu_nodes')
+    print('{},{:.3f},{},{:.3f},{}'.format(n, parse_s, parse_peak // 1024, index_s, gpus))
+
+    return 0
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='slurm_accounting benchmarks')
+    sub = parser.add_subparsers(dest='benchmark')
+    sub.required = True
+
+    p = sub.add_parser('startup', help='CLI import time budget')
+    p.add_argument('-r', '--runs', type=int, default=5, help='best of RUNS')
+    p.add_argument('--budget-scale', type=float, default=1.,
+                   help='scale budgets for slow machines')
+
+    p = sub.add_parser('parse', help='per-row vs batch sacct output parsing')
+    p.add_argument('-n', '--rows', type=int, default=200000, help='number of sacct rows')
+
+    p = sub.add_parser('shard', help='single process vs sharded aggregation')
+    p.add_argument('-n', '--rows', type=int, default=200000, help='number of sacct rows')
+    p.add_argument('-j', '--processes', type=int, default=4, help='worker processes')
+    p.add_argument('--source', metavar='SOURCE', default=None,
+                   help='replay jobs of SOURCE (dump:PATH, archive:DIR, mysqldump:PATH)')
+    p.add_argument('-s', '--start', metavar='START_DATE', default='2022-03-01')
+    p.add_argument('-e', '--end', metavar='END_DATE', default='2022-05-01')
+
+    p = sub.add_parser('slurm_conf', help='large slurm.conf parsing')
+    p.add_argument('-n', '--nodes', type=int, default=50000, help='number of nodes')
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'startup':
+        sys.exit(startup(args.runs, args.budget_scale))
+    elif args.benchmark == 'parse':
+        sys.exit(parse(args.rows))
+    elif args.benchmark == 'shard':
+        sys.exit(shard(args.rows, args.processes, source=args.source, start=args.start,
+                       end=args.end))
+    elif args.benchmark == 'slurm_conf':
+        sys.exit(slurm_conf(args.nodes))
+
+
+if __name__ == '__main__':
+    main()
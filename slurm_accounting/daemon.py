@@ -0,0 +1,421 @@
+"""Long running sreporting server.
+
+Keeps the slurm configuration, a warm cache of sacct job rows and rendered
+reports in memory, refreshes the cache incrementally on a schedule and
+answers report queries over local HTTP or a Unix socket:
+
+    GET /report?report=main&grouping=group*cpu_hours&start=2022-01&end=2022-02&format=json
+    GET /report?report=main&grouping=user*cpu_hours&last=7d
+    GET /status
+    POST /refresh
+"""
+
+import os
+import json
+import logging
+import datetime
+import threading
+
+from . import config
+from .sources import FileSource
+from .sreport import (
+    GROUPINGS, PARAMETRIC_GROUPINGS, VALUES, CpuSecondsBin, GroupingBin, JobBatch, Report,
+    Sacct, grouping_plan, load_slurm_conf, make_sacct, parse_elapsed, plan_fields,
+    print_datetime, register_histograms
+)
+
+logger = logging.getLogger("slurm_accounting.daemon")
+
+# job step usage, only known from step rows
+STEP_FIELDS = {'totalcpu', 'maxrss'}
+
+
+def cache_fields(cfg):
+    """sacct fields of every grouping and value: any report runs on the cache
+
+    Job step usage (totalcpu, maxrss) needs sacct step rows, several times
+    more rows than jobs: it is only cached when a report or periodic report
+    of cfg uses it.
+    """
+    fields = {'jobid', 'start', 'end', 'ncpus', 'state', 'partition', 'nodelist'}
+    b = CpuSecondsBin()
+    for value in VALUES.values():
+        fields |= value().fields()
+    for grouping in GROUPINGS.values():
+        fields |= grouping(b, None, None).fields()
+    for grouping in PARAMETRIC_GROUPINGS.values():
+        fields |= grouping(1, b, None, None).fields()
+    # set by reports
+    fields.discard('cluster')
+
+    specs = [cfg.get(s, 'grouping', '') for s in cfg.sections('^report:')]
+    specs += [v for s in cfg.sections('^periodic_report:') for v in cfg.section(s).values()]
+    configured = set()
+    for spec in specs:
+        if spec:
+            configured |= plan_fields(grouping_plan(spec))
+
+    return fields - (STEP_FIELDS - configured)
+
+
+class JobCache(FileSource):
+    """sacct rows of jobs, refreshed from the last refresh date on
+
+    Rows hold the fields of every grouping and value (cache_fields()), job
+    steps folded in: queries select batches of them like file sources do.
+    Each refresh fetches the jobs running since the previous one (sacct
+    --state=RUNNING selects jobs running at any time of the window: started,
+    still running or ended since), from overlap earlier for records
+    reaching slurmdbd late.
+
+    Ended jobs are appended to column chunks, the last two merged while the
+    previous one is at most twice as large (few chunks, each row copied a
+    few times); a job fetched again with other values only marks its old row
+    dead. Running jobs, fetched by every refresh, are kept apart. A refresh
+    costs the rows it fetched, and queries read immutable snapshots.
+    """
+    def __init__(self, src, start, overlap, steps=False):
+        super(JobCache, self).__init__([], src.format)
+        self.dump_format = src.format
+        self.src = src
+        self.start = start
+        self.overlap = overlap
+        self.steps = steps
+        # (JobBatch, dead rows) of ended jobs, oldest first
+        self.chunks = []
+        # jobid: (chunk, row) of ended jobs
+        self.where = {}
+        # jobid: row values in format order, of running jobs
+        self.running = {}
+        self.snapshot = ((), None)
+        self.last_refresh = None
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.where) + len(self.running)
+
+    def chunk(self, rows, number):
+        """JobBatch of rows (value tuples), indexed as chunk number"""
+        for i, values in enumerate(rows):
+            self.where[values[0]] = (number, i)
+        columns = list(zip(*rows)) or [()] * len(self.format)
+        return JobBatch({f: list(c) for f, c in zip(self.format, columns)}, len(rows)), \
+            frozenset()
+
+    def live(self, number):
+        batch, dead = self.chunks[number]
+        return [values for i, values in enumerate(zip(*[batch[f] for f in self.format]))
+                if i not in dead]
+
+    def refresh(self, now=None):
+        now = now or datetime.datetime.now()
+
+        start = self.start
+        if self.last_refresh is not None:
+            start = max(self.start, self.last_refresh - self.overlap)
+
+        fetched = {}
+        for batch in self.src.batches(start=print_datetime(start), end=print_datetime(now),
+                                      states=['RUNNING'], steps=self.steps):
+            for values in zip(*[batch[f] for f in self.format]):
+                fetched[values[0]] = values
+
+        end = self.format.index('end')
+
+        with self.lock:
+            running = {j: v for j, v in self.running.items() if j not in fetched}
+            ended = []
+            dead = {}
+            for jobid, values in fetched.items():
+                at = self.where.get(jobid)
+                if at is not None:
+                    batch, _ = self.chunks[at[0]]
+                    if tuple(batch[f][at[1]] for f in self.format) == values:
+                        continue
+                    dead.setdefault(at[0], set()).add(at[1])
+                    del self.where[jobid]
+
+                if values[end] == 'Unknown':
+                    running[jobid] = values
+                else:
+                    ended.append(values)
+
+            for number, rows in dead.items():
+                batch, d = self.chunks[number]
+                self.chunks[number] = (batch, d | rows)
+                if 2 * len(self.chunks[number][1]) > len(batch):
+                    self.chunks[number] = self.chunk(self.live(number), number)
+
+            if ended:
+                self.chunks.append(self.chunk(ended, len(self.chunks)))
+                while len(self.chunks) > 1 and \
+                        len(self.chunks[-2][0]) <= 2 * len(self.chunks[-1][0]):
+                    rows = self.live(len(self.chunks) - 2) + self.live(len(self.chunks) - 1)
+                    self.chunks.pop()
+                    self.chunks[-1] = self.chunk(rows, len(self.chunks) - 1)
+
+            self.running = running
+            columns = list(zip(*running.values())) or [()] * len(self.format)
+            self.snapshot = (tuple(self.chunks),
+                             JobBatch({f: list(c) for f, c in zip(self.format, columns)},
+                                      len(running)))
+            self.last_refresh = now
+            self.generation += 1
+
+        logger.info('refreshed %d jobs from %s (generation %d)', len(fetched), start,
+                    self.generation)
+
+        return len(fetched)
+
+    def raw_batches(self):
+        with self.lock:
+            chunks, running = self.snapshot
+        for batch, dead in chunks:
+            if dead:
+                batch = batch.take([i for i in range(len(batch)) if i not in dead])
+            if len(batch):
+                yield batch
+        if running is not None and len(running):
+            yield running
+
+    def batches(self, start=None, end=None, partition=None, nodes=None, states=[],
+                other_args=[], columns=None, block_size=None, steps=False):
+        """Sacct.batches() compatible query, job steps are already folded"""
+        return self.select(start, end, partition, nodes, states, columns)
+
+
+def grouping_values(grouping):
+    if isinstance(grouping, GroupingBin):
+        return {k: grouping_values(grouping[k]) for k in grouping.key_list()}
+
+    return grouping[0]
+
+
+class ReportServer(object):
+    def __init__(self, cfg_path):
+        self.cfg_path = cfg_path
+        self.cfg = config.Config(cfg_path)
+        self.slurm_conf = load_slurm_conf(self.cfg)
+
+        overlap = parse_elapsed(self.cfg.get('daemon', 'overlap', '00:10:00'))
+        history_start = self.cfg.getdate('general', 'default_start', '1970-01-01')
+        if self.cfg.has('daemon', 'history'):
+            history = parse_elapsed(self.cfg.get('daemon', 'history'))
+            history_start = max(history_start, datetime.datetime.now() - history)
+
+        self.refresh_interval = self.cfg.getint('daemon', 'refresh', 300)
+        # fields of [histogram:NAME] values too
+        register_histograms(self.cfg)
+        fields = cache_fields(self.cfg)
+        src = make_sacct(self.cfg)
+        if hasattr(src, 'dump_format'):
+            # files and archives lack some fields
+            fields &= set(src.dump_format)
+        steps = bool(fields & STEP_FIELDS) and 'steps' not in getattr(src, 'unavailable', ())
+        self.cache = JobCache(make_sacct(self.cfg, format=Sacct.sorted_format(fields)),
+                              history_start, overlap, steps)
+
+        self.reports = {}
+        self.reports_lock = threading.Lock()
+
+        # rolling windows, advanced by each refresh
+        self.windows = {}
+        self.windows_lock = threading.Lock()
+
+    def refresh(self):
+        n = self.cache.refresh()
+        with self.reports_lock:
+            # rendered reports belong to the previous generation
+            self.reports.clear()
+        with self.windows_lock:
+            for w in self.windows.values():
+                w.refresh()
+        return n
+
+    def check_cached(self, r):
+        missing = r.fields() - set(self.cache.format)
+        if missing:
+            raise ValueError('{} not cached, use it in a configured report'.format(
+                ','.join(sorted(missing))))
+
+    def rolling(self, report=None, grouping=None, last='7d'):
+        from .rolling import RollingWindow
+
+        key = (report, grouping, last)
+        with self.windows_lock:
+            if key not in self.windows:
+                w = RollingWindow(self.cfg, report, grouping, last, slurm_conf=self.slurm_conf,
+                                  src=self.cache)
+                self.check_cached(w.proto)
+                w.refresh()
+                self.windows[key] = w
+
+            return self.windows[key].report()
+
+    def report(self, report=None, grouping=None, start=None, end=None):
+        key = (report, grouping, start, end, self.cache.generation)
+
+        with self.reports_lock:
+            if key in self.reports:
+                return self.reports[key]
+
+        r = Report(self.cfg, report, grouping, start, end, slurm_conf=self.slurm_conf)
+        self.check_cached(r)
+
+        def feed(r):
+            for batch in self.cache.batches(start=print_datetime(r.start_date),
+                                            end=print_datetime(r.end_date),
+                                            partition=r.partition, nodes=r.selected_nodes_spec,
+                                            states=r.states, columns=r.fields()):
+                r.batch(batch)
+
+        feed(r)
+        # top-K leaders not exact after one pass
+        rescan = r.rescan()
+        if rescan is not None:
+            feed(rescan)
+
+        if end is not None:
+            # an open period changes with every refresh, closed ones don't
+            with self.reports_lock:
+                self.reports[key] = r
+
+        return r
+
+    def status(self):
+        last = self.cache.last_refresh
+        return {
+            'generation': self.cache.generation,
+            'jobs': len(self.cache),
+            'last_refresh': last and print_datetime(last),
+            'reports': len(self.reports),
+            'rolling_windows': len(self.windows),
+        }
+
+    def schedule(self):
+        def loop():
+            while not self.stop.wait(self.refresh_interval):
+                try:
+                    self.refresh()
+                except Exception:
+                    logger.exception('refresh failed')
+
+        self.stop = threading.Event()
+        t = threading.Thread(target=loop, daemon=True)
+        t.start()
+        return t
+
+
+def make_handler(server):
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import urlparse, parse_qs
+
+    class Handler(BaseHTTPRequestHandler):
+        def address_string(self):
+            # Unix socket peers have no address
+            if isinstance(self.client_address, tuple):
+                return self.client_address[0]
+            return 'unix'
+
+        def log_message(self, fmt, *args):
+            logger.info('%s - %s', self.address_string(), fmt % args)
+
+        def reply(self, code, body, content_type='text/plain'):
+            body = body.encode()
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+
+            if url.path == '/status':
+                return self.reply(200, json.dumps(server.status()), 'application/json')
+
+            if url.path != '/report':
+                return self.reply(404, 'not found\n')
+
+            try:
+                if 'last' in query:
+                    r = server.rolling(query.get('report'), query.get('grouping'), query['last'])
+                else:
+                    r = server.report(query.get('report'), query.get('grouping'),
+                                      query.get('start'), query.get('end'))
+            except (KeyError, ValueError) as e:
+                return self.reply(400, 'bad request: {}\n'.format(e))
+
+            if query.get('format', 'csv') == 'json':
+                body = json.dumps({
+                    '*'.join(title): grouping_values(grouping)
+                    for grouping, title in r.groupings
+                })
+                return self.reply(200, body, 'application/json')
+
+            return self.reply(200, '\n'.join(r.render().values()), 'text/csv')
+
+        def do_POST(self):
+            if urlparse(self.path).path != '/refresh':
+                return self.reply(404, 'not found\n')
+
+            n = server.refresh()
+            return self.reply(200, json.dumps({'refreshed': n}), 'application/json')
+
+    return Handler
+
+
+def serve(server, address):
+    import socketserver
+    from http.server import ThreadingHTTPServer
+
+    handler = make_handler(server)
+
+    if address.startswith('/') or address.startswith('.'):
+        class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        if os.path.exists(address):
+            os.unlink(address)
+        httpd = UnixHTTPServer(address, handler)
+    else:
+        host, port = address.rsplit(':', 1)
+        httpd = ThreadingHTTPServer((host or '127.0.0.1', int(port)), handler)
+
+    return httpd
+
+
+def main(cfg_path='sreporting.conf'):
+    import argparse
+
+    if not os.path.isabs(cfg_path):
+        cfg_path = config.find_config_file(__file__, cfg_path)
+
+    parser = argparse.ArgumentParser(description='accounting report server')
+    parser.add_argument('--cfg', metavar='PATH',
+                        default=cfg_path, help='config file (default=%s)' % cfg_path)
+    parser.add_argument('-l', '--listen', metavar='ADDRESS', default=None,
+                        help='HOST:PORT or Unix socket path (default from [daemon] listen, '
+                        'or 127.0.0.1:8642)')
+    parser.add_argument('--loglevel', default='info', help='logging level')
+
+    args = parser.parse_args()
+
+    config.loggerConfig(logger, args)
+
+    server = ReportServer(args.cfg)
+    address = args.listen or server.cfg.get('daemon', 'listen', '127.0.0.1:8642')
+
+    server.refresh()
+    server.schedule()
+
+    httpd = serve(server, address)
+    logger.info('listening on %s', address)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
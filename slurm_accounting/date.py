@@ -53,3 +53,19 @@ class SlurmDate:
         return self.date == other.date
     def __ne__(self, other):
         return self.date != other.date
+
+
+def split_periods(start, end, split):
+    """consecutive (start, end) SlurmDate periods of start to end, split 'monthly' or 'daily'"""
+    periods = []
+    d = start.date
+    while d < end.date:
+        if split == 'daily':
+            e = d + datetime.timedelta(days=1)
+        else:
+            e = datetime.datetime(d.year + d.month // 12, d.month % 12 + 1, 1)
+        e = min(e, end.date)
+        periods.append((SlurmDate(d.strftime('%Y-%m-%d')), SlurmDate(e.strftime('%Y-%m-%d'))))
+        d = e
+
+    return periods
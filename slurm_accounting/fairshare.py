@@ -0,0 +1,198 @@
+"""Decayed (fairshare) usage of accounts and users over time.
+
+Slurm's multifactor priority plugin weighs past usage down with a half-life
+(PriorityDecayHalfLife of slurm.conf, 7 days by default): cpu seconds used
+d days ago count for 0.5 ** (d / half-life).
+
+    python -m slurm_accounting.fairshare [REPORT] -s 2022-01 -e 2023-01 \\
+        [-g account*user] [--half-life 14-0] [--state PATH]
+
+prints the decayed cpu seconds (sshare RawUsage) of each account (or
+account and user...) at the end of every day. Daily cpu seconds come from
+the daily grouping, one month of jobs at a time, and are replayed through a
+running state:
+
+    usage(day) = usage(day - 1) * 0.5 ** (1 / half-life days) + cpu seconds(day)
+
+so a series costs one update per day and key. With --state, the running
+state is saved and a later run goes on from the day after the last one.
+Without, usage is zero before START_DATE: start some half-lives earlier for
+the series to settle.
+"""
+
+import sys
+import json
+import datetime
+
+from . import spans
+from .sreport import (
+    GROUPINGS, Report, Sacct, cluster_get, leaves, make_sacct, parse_slurm_date,
+    print_datetime
+)
+
+DAY = 86400
+
+# slurm.conf default
+DEFAULT_HALF_LIFE = '7-0'
+
+
+def parse_slurm_time(s):
+    """seconds of a slurm.conf time: min, min:sec, h:min:sec, days-h[:min[:sec]]"""
+    days = 0
+    if '-' in s:
+        days, s = s.split('-', 1)
+        h, m, sec = (list(map(int, s.split(':'))) + [0, 0])[:3]
+    else:
+        values = list(map(int, s.split(':')))
+        if len(values) == 3:
+            h, m, sec = values
+        else:
+            h = 0
+            m, sec = (values + [0])[:2]
+
+    return ((int(days) * 24 + h) * 60 + m) * 60 + sec
+
+
+def slurm_half_life(cfg, cluster=None):
+    """PriorityDecayHalfLife of slurm.conf, in seconds"""
+    from .slurm_config import conf_lines
+
+    value = DEFAULT_HALF_LIFE
+    with open(cluster_get(cfg, cluster, 'slurm_conf', '/etc/slurm/slurm.conf')) as f:
+        for key, v in conf_lines(f):
+            if key.lower() == 'prioritydecayhalflife':
+                value = v
+
+    return parse_slurm_time(value)
+
+
+class DecayedUsage(object):
+    """running decayed usage of keys, one day at a time"""
+    def __init__(self, half_life):
+        # half_life 0 disables decay, as in Slurm
+        self.half_life = half_life
+        self.decay = 0.5 ** (DAY / half_life) if half_life else 1.
+        self.usage = {}
+        # last day accounted
+        self.day = None
+
+    def advance(self, day, usages):
+        """decay usage to the end of day ('YYYY-MM-DD') and add its {key: cpu seconds}"""
+        if self.day is not None:
+            days = (parse_slurm_date(day) - parse_slurm_date(self.day)).days
+            if days <= 0:
+                raise ValueError('day %s already accounted (last %s)' % (day, self.day))
+
+            decay = self.decay ** days
+            for k in self.usage:
+                self.usage[k] *= decay
+
+        for k, v in usages.items():
+            self.usage[k] = self.usage.get(k, 0.) + v
+        self.day = day
+
+    def state(self):
+        return {'half_life': self.half_life, 'day': self.day,
+                'usage': [[list(k), v] for k, v in self.usage.items()]}
+
+    def load(self, state):
+        self.day = state['day']
+        self.usage = {tuple(k): v for k, v in state['usage']}
+        return self
+
+
+def replay(cfg, usage, report=None, grouping='account', start=None, end=None):
+    """advance usage over the days of start to end, yield each day once accounted"""
+    keys = [g.strip() for g in grouping.split('*')]
+    for g in keys:
+        if g not in GROUPINGS or g in spans.UNITS or g == 'job_start':
+            raise ValueError('invalid fairshare grouping \'%s\': \'%s\' is not a job field' %
+                             (grouping, g))
+
+    r = Report(cfg, report, 'daily*{}*cpu_seconds'.format('*'.join(keys)), start, end)
+    src = make_sacct(cfg, format=Sacct.sorted_format(r.fields()))
+
+    d = r.start_date
+    if usage.day is not None:
+        d = max(d, parse_slurm_date(usage.day) + datetime.timedelta(days=1))
+
+    while d < r.end_date:
+        e = min(datetime.datetime(d.year + d.month // 12, d.month % 12 + 1, 1), r.end_date)
+
+        w = r.window(d, e)
+        for batch in src.batches(start=print_datetime(d), end=print_datetime(e),
+                                 partition=w.partition, nodes=w.selected_nodes_spec,
+                                 states=w.states):
+            w.batch(batch)
+
+        tree, _title = w.groupings[0]
+        for day in tree.key_list():
+            usage.advance(day, {k: b[0] for k, b in leaves(tree[day], len(keys))})
+            yield day
+
+        d = e
+
+
+def fairshare(cfg, report=None, grouping='account', start=None, end=None, half_life=None,
+              state_path=None, out=sys.stdout):
+    """print the decayed usage series, return the DecayedUsage"""
+    grouping = '*'.join(g.strip() for g in grouping.split('*'))
+    half_life = slurm_half_life(cfg) if half_life is None else parse_slurm_time(half_life)
+    usage = DecayedUsage(half_life)
+
+    if state_path is not None:
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = None
+        if state is not None and (state.get('half_life'), state.get('grouping')) == \
+           (half_life, grouping):
+            usage.load(state)
+
+    print('half_life_seconds,{}'.format(half_life), file=out)
+    print(file=out)
+    print('daily*{}*decayed_cpu_seconds'.format(grouping), file=out)
+
+    for day in replay(cfg, usage, report, grouping, start, end):
+        for k in sorted(usage.usage):
+            v = usage.usage[k]
+            # keys used long ago eventually vanish
+            if v >= 1.:
+                print('{},{},{:.0f}'.format(day, ','.join(k), v), file=out)
+
+    if state_path is not None:
+        with open(state_path, 'w') as f:
+            json.dump(dict(usage.state(), grouping=grouping), f)
+
+    return usage
+
+
+def main():
+    import argparse
+    from . import config
+
+    parser = argparse.ArgumentParser(description='decayed fairshare usage over time')
+    parser.add_argument('report', metavar='REPORT', nargs='?', default=None,
+                        help='use section [report:REPORT] section in configuration file')
+    parser.add_argument('-s', '--start', metavar='START_DATE', default=None)
+    parser.add_argument('-e', '--end', metavar='END_DATE', default=None)
+    parser.add_argument('-g', '--grouping', metavar='GROUPING', default='account',
+                        help='usage keys (default account, e.g. account*user)')
+    parser.add_argument('--half-life', metavar='TIME', default=None,
+                        help='decay half-life (default slurm.conf PriorityDecayHalfLife, '
+                        'or %s)' % DEFAULT_HALF_LIFE)
+    parser.add_argument('--state', metavar='PATH', default=None,
+                        help='keep the running usage in PATH between runs')
+    parser.add_argument('--cfg', metavar='PATH',
+                        default=config.find_config_file(__file__, 'sreporting.conf'),
+                        help='config file')
+
+    args = parser.parse_args()
+
+    fairshare(config.Config(args.cfg), args.report, args.grouping, args.start, args.end,
+              args.half_life, args.state)
+
+
+if __name__ == '__main__':
+    main()
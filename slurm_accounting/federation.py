@@ -0,0 +1,84 @@
+"""Reports spanning several Slurm clusters.
+
+Clusters are described by [cluster:NAME] sections of the configuration:
+
+    [cluster:alpha]
+    slurm_conf = /etc/slurm/alpha.conf
+    remote_host = alpha-login    ; run sacct through ssh
+    clusters = alpha             ; or sacct --clusters through slurmdbd
+    cores = 10368                ; optional whole cluster capacity
+
+Each cluster gets its own Report (node selection and capacity come from its
+slurm.conf) but all of them account jobs into the same grouping trees, jobs
+being tagged with their cluster name for the 'cluster' grouping.
+"""
+
+from .sreport import (
+    Report, capacity_header, tres_header, load_slurm_conf, make_sacct, render_groupings
+)
+
+
+class FederatedReport(object):
+    def __init__(self, cfg, clusters, report=None, grouping_specs=None, start=None, end=None,
+                 slurm_confs=None):
+        slurm_confs = slurm_confs or {}
+
+        self.members = []
+        groupings = None
+        for cluster in clusters:
+            slurm_conf = slurm_confs.get(cluster) or load_slurm_conf(cfg, cluster)
+            r = Report(cfg, report, grouping_specs, start, end, slurm_conf=slurm_conf,
+                       cluster=cluster, groupings=groupings)
+            groupings = r.groupings
+            self.members.append(r)
+
+        first = self.members[0]
+        self.report = first.report
+        self.groupings = first.groupings
+        self.plan = first.plan
+        self.start_date = first.start_date
+        self.end_date = first.end_date
+
+        self.cores = sum(r.cores for r in self.members)
+        self.maxseconds = sum(r.maxseconds for r in self.members)
+        self.tres = {k: sum(r.tres[k] for r in self.members) for k in first.tres}
+
+    def __str__(self):
+        return '\n'.join(str(r) for r in self.members)
+
+    def fields(self):
+        return self.members[0].fields()
+
+    def header(self):
+        ret = 'clusters,{}\n'.format(','.join(r.cluster for r in self.members))
+
+        for r in self.members:
+            ret += 'cluster,{}\n'.format(r.cluster)
+            ret += r.selection_header()
+            ret += 'cluster_cores,{}\n'.format(r.cores)
+
+        if self.members[0].uses_tres():
+            ret += tres_header(self.tres, self.members[0].duration)
+
+        return ret + capacity_header(self.cores, self.maxseconds)
+
+    def render(self):
+        return render_groupings(self.header(), self.groupings)
+
+
+def federated_sreporting(cfg, clusters, report=None, grouping_specs=None, start=None, end=None,
+                         extra_options=[], processes=1):
+    from . import planner
+
+    fr = FederatedReport(cfg, clusters, report, grouping_specs, start, end)
+
+    print(fr)
+
+    windows = planner.plan(fr.members)
+    format = planner.fields(windows)
+    sources = {c: make_sacct(cfg, format=format, extra_options=extra_options, cluster=c)
+               for c in clusters}
+
+    planner.execute(windows, sources, processes=processes)
+
+    return fr.render()
@@ -0,0 +1,397 @@
+"""Differential checks of the report engines against sreporting.
+
+    python -m slurm_accounting.golden [-n 1000,10000,100000] [--timezone Europe/Paris]
+
+generates random jobs around a report period, with edge cases: jobs crossing
+midnight, month ends and the 2024 leap day, running jobs (Unknown end),
+zero-length jobs, jobs ending exactly at the period start or starting at its
+end, PENDING rows, job steps (jobid.batch, jobid.0) and TRES. They are
+written as a sacct dump with a config using it (source = dump:...), and
+each engine computes the same report through its own entry point:
+
+    sreporting  sreporting(), the reference
+    rows        Report.job() on each job row, steps folded
+    sharded     batches accounted on 2 processes (sreporting -j 2)
+    rollup      monthly reports rolled up (periodic_reports run_units())
+    rolling     hourly ring of a rolling window (sreporting --last)
+
+Rendered reports must be identical to the reference ones, byte for byte;
+speedups are relative to the reference at each number of rows. Rollups need
+a period of whole months, rolling windows whole days and only compare the
+groupings adding up over hours. The exit status is 1 on any difference.
+Engines are functions returning the rendered groupings of a config file,
+report grouping spec and period: new ones can be added to ENGINES.
+
+The reference changes with the engines: tests/test_golden.py checks all of
+them, sreporting() included, against frozen reports of the baseline
+sreporting() for the groupings it had.
+"""
+
+import os
+import sys
+import datetime
+
+REPORT = 'golden'
+
+# default report: span groupings, top-K, histograms, percentages, counts,
+# TRES and efficiencies (job steps)
+GROUPING = ','.join((
+    'user*cpu_hours', 'account*user*cpu_seconds', 'group*job_count', 'cluster*utilization',
+    'daily*cpu_seconds', 'weekly*group*cpu_hours', 'monthly*utilization', 'job_start*job_count',
+    'weekly*job_count', 'weekly*utilization', 'top_user(3)*cpu_hours',
+    'ncpus_hist', 'duration_hist', 'partition*cpu_seconds',
+    'account*gpu_hours', 'user*mem_gb_hours', 'partition*billing_hours',
+    'account*cpu_efficiency', 'group*mem_efficiency',
+))
+
+# around the 2024-02-29 leap day and the 2024-03-31 DST change of Europe
+PERIOD = ('2024-01-01', '2024-04-01')
+
+FORMAT = ('jobid', 'user', 'elapsed', 'ncpus', 'partition', 'nodelist', 'group', 'start', 'end',
+          'state', 'account', 'alloctres', 'totalcpu', 'maxrss', 'elapsedraw')
+
+SLURM_CONF = '''NodeName=n[000-299] Procs=128
+PartitionName=batch Nodes=n[000-249]
+PartitionName=gpu Nodes=n[250-299]
+'''
+
+
+def print_totalcpu(seconds):
+    """sacct TotalCPU: [DD-]HH:MM:SS, MM:SS.mmm under an hour"""
+    if seconds < 3600:
+        return '%02d:%06.3f' % divmod(seconds, 60)
+    days, s = divmod(int(seconds), 86400)
+    ret = '%02d:%02d:%02d' % (s // 3600, s // 60 % 60, s % 60)
+    return '%d-%s' % (days, ret) if days else ret
+
+
+def random_jobs(n, seed=0, start=PERIOD[0], end=PERIOD[1], margin=20):
+    """sacct --parsable2 dump of n jobs and their steps, some of them edge cases"""
+    import random
+
+    rnd = random.Random(seed)
+    t0 = datetime.datetime.fromisoformat(start)
+    t1 = datetime.datetime.fromisoformat(end)
+    first = t0 - datetime.timedelta(days=margin)
+    span = int((t1 - first).total_seconds()) + margin * 86400
+
+    def at(d):
+        return d.isoformat()
+
+    def seconds(s):
+        return datetime.timedelta(seconds=s)
+
+    lines = ['|'.join(FORMAT) + '\n']
+    for i in range(n):
+        b = first + seconds(rnd.randrange(span))
+        e = b + seconds(min(int(rnd.expovariate(1. / 21600)), 14 * 86400))
+        state = rnd.choice(('COMPLETED', 'COMPLETED', 'FAILED', 'TIMEOUT', 'CANCELLED'))
+
+        kind = rnd.randrange(20)
+        if kind == 0:
+            state = 'PENDING'
+        elif kind == 1:
+            state = 'RUNNING'
+        elif kind == 2:
+            e = b
+        elif kind == 3:
+            # crossing midnight
+            b = b.replace(hour=23, minute=rnd.randrange(60))
+            e = b + seconds(rnd.randrange(600, 3 * 3600))
+        elif kind == 4:
+            # crossing a month end
+            m = datetime.datetime(b.year + b.month // 12, b.month % 12 + 1, 1)
+            b = m - seconds(rnd.randrange(1, 6 * 3600))
+            e = m + seconds(rnd.randrange(0, 48 * 3600))
+        elif kind == 5:
+            # on the leap day
+            b = datetime.datetime(2024, 2, 28, 12) + seconds(rnd.randrange(48 * 3600))
+            e = b + seconds(rnd.randrange(0, 36 * 3600))
+        elif kind == 6:
+            # touching the period ends
+            if rnd.random() < .5:
+                b, e = t0 - seconds(rnd.randrange(1, 86400)), t0
+            else:
+                b, e = t1, t1 + seconds(rnd.randrange(0, 86400))
+
+        u = rnd.randrange(40)
+        ncpus = rnd.choice((1, 1, 2, 4, 16, 32, 128))
+        partition = rnd.choice(('batch', 'batch', 'gpu'))
+        elapsed = int((e - b).total_seconds())
+
+        tres = ['cpu=%d' % ncpus, 'mem=%dM' % (ncpus * rnd.choice((2000, 4000)))]
+        if rnd.random() < .8:
+            # billing defaults to cpu
+            tres.insert(0, 'billing=%d' % (ncpus * rnd.choice((1, 2))))
+        if partition == 'gpu':
+            tres.append('gres/gpu=%d' % rnd.randrange(1, 5))
+        tres.append('node=1')
+
+        values = {
+            'jobid': str(1000 + i),
+            # one-off users evict top-K candidates
+            'user': 'u%02d' % u if rnd.random() < .7 else 'v%d' % i,
+            'elapsed': '00:00:00',
+            'ncpus': str(ncpus),
+            'partition': partition,
+            'nodelist': 'n%03d' % (rnd.randrange(250) if partition == 'batch'
+                                   else rnd.randrange(250, 300)),
+            'group': 'g%d' % (u % 7),
+            'start': at(b),
+            'end': at(e),
+            'state': state,
+            'account': 'a%d' % (u % 3),
+            'alloctres': ','.join(tres),
+            'totalcpu': '00:00:00',
+            'maxrss': '',
+            'elapsedraw': str(elapsed),
+        }
+        if state == 'PENDING':
+            values.update(start='Unknown', end='Unknown', elapsedraw='0', nodelist='None assigned',
+                          alloctres='')
+        elif state == 'RUNNING':
+            values.update(end='Unknown')
+
+        # batch script and one srun step, their usage summed in the job row
+        steps = []
+        if state != 'PENDING' and rnd.random() < .9:
+            total = 0.
+            for name in ('batch', '0'):
+                cpu = elapsed * ncpus * rnd.random() / 2
+                total += cpu
+                steps.append(dict(values, jobid='%s.%s' % (values['jobid'], name), user='',
+                                  partition='', group='', totalcpu=print_totalcpu(cpu),
+                                  maxrss='%dK' % rnd.randrange(1 << 24)))
+            values['totalcpu'] = print_totalcpu(total)
+
+        for v in [values] + steps:
+            lines.append('|'.join(v[f] for f in FORMAT) + '\n')
+
+    return ''.join(lines).encode()
+
+
+def write_config(path, jobs, timezone=None):
+    """sreporting.conf reading the dump jobs, with periodic reports under its directory"""
+    d = os.path.dirname(path)
+    with open(os.path.join(d, 'slurm.conf'), 'w') as f:
+        f.write(SLURM_CONF)
+
+    with open(path, 'w') as f:
+        f.write('[general]\n')
+        f.write('source = dump:%s\n' % jobs)
+        f.write('slurm_conf = %s\n' % os.path.join(d, 'slurm.conf'))
+        if timezone is not None:
+            f.write('timezone = %s\n' % timezone)
+        f.write('\n[report:%s]\n' % REPORT)
+        f.write('\n[periodic_reports]\nreport_dir = %s\n' % os.path.join(d, 'reports'))
+
+
+def quiet(f, *args, **kwargs):
+    """f(*args, **kwargs) without its progress output"""
+    import io
+    import contextlib
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        return f(*args, **kwargs)
+
+
+def sreporting_engine(cfg_path, grouping, start, end):
+    from .sreport import sreporting
+
+    return quiet(sreporting, cfg_path, REPORT, grouping, start, end)
+
+
+def rows_engine(cfg_path, grouping, start, end):
+    from . import config
+    from .sreport import Report, Sacct, make_sacct, print_datetime
+
+    cfg = config.Config(cfg_path)
+    r = Report(cfg, REPORT, grouping, start, end)
+    src = make_sacct(cfg, format=Sacct.sorted_format(r.fields()))
+
+    def rows():
+        for batch in src.batches(start=print_datetime(r.query_start_date),
+                                 end=print_datetime(r.query_end_date), partition=r.partition,
+                                 nodes=r.selected_nodes_spec, states=r.states,
+                                 steps=r.uses_steps()):
+            yield from batch.rows()
+
+    for row in rows():
+        r.job(row)
+
+    rescan = r.rescan()
+    if rescan is not None:
+        for row in rows():
+            rescan.job(row)
+
+    return r.render()
+
+
+def sharded_engine(cfg_path, grouping, start, end):
+    from .sreport import sreporting
+
+    return quiet(sreporting, cfg_path, REPORT, grouping, start, end, processes=2)
+
+
+def rollup_engine(cfg_path, grouping, start, end):
+    """monthly reports, then the period rolled up from their sidecars"""
+    import shutil
+
+    from . import config
+    from .periodic_reports import month_parts, period_units, run_units
+    from .report_store import make_store
+    from .sreport import grouping_plan, parse_slurm_date
+
+    start_date, end_date = parse_slurm_date(start), parse_slurm_date(end)
+    for d in (start_date, end_date):
+        if d != datetime.datetime(d.year, d.month, 1):
+            raise ValueError('rollups are made of whole months')
+
+    cfg = config.Config(cfg_path)
+    report_dir = cfg.get('periodic_reports', 'report_dir')
+    shutil.rmtree(report_dir, ignore_errors=True)
+
+    reports = {REPORT: grouping}
+    parts = month_parts(report_dir, start_date, end_date)
+    units = [u for part, s, e in parts for u in period_units(reports, s, e, part, (s.year, s.month))]
+    units += period_units(reports, start_date, end_date, os.path.join(report_dir, 'rollup'),
+                          ('rollup', ), parts)
+
+    quiet(run_units, cfg_path, units)
+
+    store = make_store(cfg)
+    ret = {}
+    for title in grouping_plan(grouping).titles:
+        k = '*'.join(title)
+        # after the report=...,grouping=... line
+        ret[k] = store.read('rollup', '{}-{}'.format(REPORT, k)).split('\n\n', 1)[1]
+    store.close()
+
+    return ret
+
+
+def rolling_engine(cfg_path, grouping, start, end):
+    """window of the period length ending at its end, groupings adding up over hours"""
+    from . import config
+    from .rolling import RollingWindow
+    from .sreport import grouping_plan, parse_slurm_date
+
+    start_date, end_date = parse_slurm_date(start), parse_slurm_date(end)
+    days = end_date - start_date
+    if days != datetime.timedelta(days=days.days):
+        raise ValueError('rolling windows are made of whole days')
+
+    plan = grouping_plan(grouping)
+    titles = [t for t in plan.titles if plan.mergeable(t, 'hourly')]
+    if not titles:
+        raise ValueError('no grouping adds up over hours')
+
+    w = RollingWindow(config.Config(cfg_path), REPORT, ','.join('*'.join(t) for t in titles),
+                      '%dd' % days.days)
+    w.refresh(now=end_date)
+
+    return w.render()
+
+
+ENGINES = {
+    'sreporting': sreporting_engine,
+    'rows': rows_engine,
+    'sharded': sharded_engine,
+    'rollup': rollup_engine,
+    'rolling': rolling_engine,
+}
+REFERENCE = 'sreporting'
+
+
+def run(engine, cfg_path, grouping, start, end):
+    """(rendered report, seconds) of an engine"""
+    import time
+
+    t = time.perf_counter()
+    ret = ENGINES[engine](cfg_path, grouping, start, end)
+    elapsed = time.perf_counter() - t
+
+    return ret, elapsed
+
+
+def first_difference(expected, got, out=sys.stderr, lines=20):
+    import difflib
+
+    for title in got:
+        if got[title] != expected.get(title):
+            diff = difflib.unified_diff(expected.get(title, '').splitlines(),
+                                        got[title].splitlines(),
+                                        REFERENCE, title, lineterm='')
+            for l in list(diff)[:lines]:
+                print(l, file=out)
+            return
+
+
+def golden(scales=(1000, 10000, 100000), engines=None, grouping=GROUPING, start=PERIOD[0],
+           end=PERIOD[1], timezone=None, seed=0, out=sys.stdout):
+    """compare engines with the reference at each scale, return the number of mismatches"""
+    import tempfile
+
+    engines = [e for e in engines or sorted(ENGINES) if e != REFERENCE]
+
+    mismatches = 0
+    print('rows,engine,groupings,seconds,speedup,status', file=out)
+    with tempfile.TemporaryDirectory(prefix='golden') as d:
+        jobs = os.path.join(d, 'jobs.txt')
+        cfg_path = os.path.join(d, 'sreporting.conf')
+        write_config(cfg_path, jobs, timezone)
+
+        for n in scales:
+            with open(jobs, 'wb') as f:
+                f.write(random_jobs(n, seed, start, end))
+
+            expected, base = run(REFERENCE, cfg_path, grouping, start, end)
+            print('{},{},{},{:.3f},{:.1f},ok'.format(n, REFERENCE, len(expected), base, 1.),
+                  file=out)
+
+            for engine in engines:
+                try:
+                    got, elapsed = run(engine, cfg_path, grouping, start, end)
+                except ValueError as e:
+                    print('{},{},0,,,skipped: {}'.format(n, engine, e), file=out)
+                    continue
+
+                # rolling windows only have some of the groupings
+                status = 'ok'
+                if not got or any(got[t] != expected.get(t) for t in got):
+                    status = 'MISMATCH'
+                    mismatches += 1
+                    first_difference(expected, got)
+
+                print('{},{},{},{:.3f},{:.1f},{}'.format(n, engine, len(got), elapsed,
+                                                          base / elapsed, status), file=out)
+
+    return mismatches
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='report engines against sreporting')
+    parser.add_argument('-n', '--rows', metavar='N,N...', default='1000,10000,100000',
+                        help='numbers of random jobs')
+    parser.add_argument('--engines', metavar='ENGINE,...', default=None,
+                        help='engines to check (%s)' % ', '.join(sorted(ENGINES)))
+    parser.add_argument('-g', '--grouping', metavar='GROUPING_SPEC', default=GROUPING)
+    parser.add_argument('-s', '--start', metavar='START_DATE', default=PERIOD[0])
+    parser.add_argument('-e', '--end', metavar='END_DATE', default=PERIOD[1])
+    parser.add_argument('--timezone', metavar='ZONE', default=None,
+                        help='calendar timezone (default local time)')
+    parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+
+    engines = args.engines.split(',') if args.engines else None
+    mismatches = golden([int(n) for n in args.rows.split(',')], engines, args.grouping,
+                        args.start, args.end, args.timezone, args.seed)
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,115 +2,419 @@
 
 import os
 import os.path
-import shutil
+import json
 
 from datetime import datetime
 
-from slurm_accounting.sreport import sreporting
-from slurm_accounting import config
+from slurm_accounting.sreport import (
+    Report, cluster_get, cluster_list, grouping_plan, load_slurm_conf, make_sacct,
+    merge_groupings, parse_elapsed, parse_slurm_date, plan_fields
+)
+from slurm_accounting.federation import FederatedReport
+from slurm_accounting.slurm_config import slurm_conf_digest
+from slurm_accounting.version import __version__
+from slurm_accounting import planner
+
+
+class Fingerprints(object):
+    """fingerprint of the inputs of a report grouping over a period
+
+    Covers the report section, the clusters sections and slurm.conf
+    contents, query_grace, the code version and the generation of the jobs
+    data of the period. Outputs whose stored fingerprint differs are stale.
+    """
+    def __init__(self, cfg, clusters=None, now=None):
+        import hashlib
+        from slurm_accounting.sources import source_generation
+
+        self.cfg = cfg
+        self.now = now or datetime.now()
+        self.query_grace = parse_elapsed(cfg.get('general', 'query_grace', '00:00:00'))
+
+        self.clusters = {}
+        for c in clusters or [None]:
+            section = 'cluster:{}'.format(c)
+            self.clusters[c or ''] = {
+                'section': cfg.section(section) if section in cfg.sections() else {},
+                'slurm_conf': slurm_conf_digest(
+                    cluster_get(cfg, c, 'slurm_conf', '/etc/slurm/slurm.conf')
+                ),
+            }
+
+        # jobs data of file sources (see sources), None for sacct
+        generations = [source_generation(cfg, c) for c in clusters or [None]]
+        self.source = None if None in generations else ','.join(generations)
+
+        # uid/gid resolution snapshots (see symbols)
+        self.snapshots = {}
+        for option in ('passwd', 'group'):
+            path = cfg.get('general', option, '')
+            if path:
+                with open(path, 'rb') as f:
+                    self.snapshots[option] = hashlib.sha256(f.read()).hexdigest()
+
+    def generation(self, start_date, end_date):
+        """jobs data of a period is final once query_grace has elapsed after it
+
+        Jobs of file sources only change with the files.
+        """
+        if self.source is not None:
+            return 'source:' + self.source
+        if self.now >= end_date + self.query_grace:
+            return 'final'
+        return self.now.strftime('%Y-%m-%d')
+
+    def inputs(self, report, grouping):
+        """inputs of a report grouping over any period (see rolling)"""
+        inputs = {
+            'version': __version__,
+            'report': self.cfg.section('report:' + report),
+            'grouping': grouping,
+            'clusters': self.clusters,
+        }
+
+        histograms = {s: self.cfg.section(s) for s in self.cfg.sections('^histogram:')}
+        if histograms:
+            inputs['histograms'] = histograms
+        if self.snapshots:
+            inputs['snapshots'] = self.snapshots
+
+        return inputs
+
+    def __call__(self, report, grouping, start_date, end_date):
+        import hashlib
+
+        inputs = self.inputs(report, grouping)
+        inputs.update({
+            'start': start_date.isoformat(),
+            'end': end_date.isoformat(),
+            'query_grace': str(self.query_grace),
+            'generation': self.generation(start_date, end_date),
+        })
+
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+class Unit(object):
+    """One report of a period directory, possibly out of date
+
+    Units with parts (yearly, quarterly...) may be rolled up from the
+    aggregate sidecars of their parts, (period_dir, start_date, end_date)
+    of monthly period directories. Outputs go to a store (see report_store).
+    Subsets of the groupings keep the header of the whole report (TRES).
+    """
+    def __init__(self, period_dir, report, groupings, start_date, end_date, label, parts=(),
+                 header=None):
+        self.period_dir = period_dir
+        self.report = report
+        self.groupings = groupings
+        self.header = header or groupings
+        self.start_date = start_date
+        self.end_date = end_date
+        self.start = '{}-{}-{}'.format(start_date.year, start_date.month, 1)
+        self.end = '{}-{}-{}'.format(end_date.year, end_date.month, 1)
+        self.label = label
+        self.parts = parts
+
+    def subset(self, groupings):
+        return Unit(self.period_dir, self.report, groupings, self.start_date, self.end_date,
+                    self.label, self.parts, self.header)
+
+    def files(self):
+        return ['{}-{}.csv'.format(self.report, g) for g in self.groupings]
+
+    def is_complete(self, store):
+        return all(store.exists(self.period_dir, self.name(g)) for g in self.groupings)
+
+    def stale(self, fingerprints, store, recompute=False):
+        """groupings whose outputs are missing or computed from other inputs
+
+        Outputs without sidecar, written before fingerprints, are kept
+        unless recompute (see adopt()).
+        """
+        if self.period_dir is None:
+            return self.groupings
+
+        ret = []
+        for g in self.groupings:
+            if not store.exists(self.period_dir, self.name(g)):
+                ret.append(g)
+                continue
+
+            fingerprint = store.fingerprint(self.period_dir, self.name(g))
+            if fingerprint is None and not recompute:
+                continue
+            if fingerprint != fingerprints(self.report, g, self.start_date, self.end_date):
+                ret.append(g)
+
+        return ret
+
+    def adopt(self, fingerprints, store):
+        """record the current fingerprint of outputs without sidecar
+
+        Later input changes make them stale. Their sidecar has no aggregate
+        state: periods containing them are not rolled up from them.
+        """
+        if self.period_dir is None:
+            return
+
+        for g in self.groupings:
+            name = self.name(g)
+            if store.exists(self.period_dir, name) and \
+               store.fingerprint(self.period_dir, name) is None:
+                store.adopt(self.period_dir, name, {
+                    'report': self.report,
+                    'grouping': g,
+                    'start': self.start,
+                    'end': self.end,
+                    'fingerprint': fingerprints(self.report, g, self.start_date,
+                                                self.end_date),
+                })
+
+    def name(self, grouping):
+        """REPORT-GROUPING name of the outputs of grouping"""
+        return '{}-{}'.format(self.report, grouping)
+
+    def write(self, r, fingerprints, store):
+        rets = r.render()
+
+        if self.period_dir is None:
+            for v in rets.values():
+                print(v)
+            return
+
+        for grouping, title in r.groupings:
+            k = '*'.join(title)
+
+            csv = 'report={},grouping={},start={},end={}\n\n{}'.format(
+                self.report, k, self.start, self.end, rets[k]
+            )
 
+            # machine readable aggregate state of grouping
+            store.put(self.period_dir, self.name(k), csv, {
+                'report': self.report,
+                'grouping': k,
+                'start': self.start,
+                'end': self.end,
+                'fingerprint': fingerprints(self.report, k, self.start_date, self.end_date),
+                'state': grouping.state(),
+            })
 
-def yearly(cfg_path, report_dir, reports, year):
+    def rollup(self, r, store):
+        """merge the sidecars of parts into the empty groupings of report r"""
+        for part, _, _ in self.parts:
+            trees = r.plan.new(None, None)
+            for tree, title in trees:
+                tree.load(store.sidecar(part, self.name('*'.join(title)))['state'])
 
-    start_date = datetime(year, 1, 1)
-    start = '{}-{}-{}'.format(start_date.year, start_date.month, 1)
+            merge_groupings(r.groupings, trees)
 
-    end_date = datetime(year + 1, 1, 1)
-    end = '{}-{}-{}'.format(end_date.year, end_date.month, 1)
 
-    year_dir = os.path.join(report_dir, str(year))
+def period_units(reports, start_date, end_date, period_dir, label, parts=()):
+    return [
+        Unit(period_dir, report, groupings.split(','), start_date, end_date, label, parts)
+        for report, groupings in reports.items()
+    ]
 
-    modified = False
 
-    for report, groupings in reports.items():
-        groupings = groupings.split(',')
-        files = ['{}-{}.csv'.format(report, g) for g in groupings]
-        if all([os.path.isfile(os.path.join(year_dir, f)) for f in files]):
-            continue
+def month_dir(report_dir, year, month):
+    return os.path.join(report_dir, str(year), '{:02d}'.format(month))
 
-        modified = True
 
-        print(start_date.year, report, groupings)
+def month_parts(report_dir, start_date, end_date):
+    """(period_dir, start_date, end_date) of the months of a period"""
+    parts = []
+    d = start_date
+    while d < end_date:
+        next_d = datetime(d.year + d.month // 12, d.month % 12 + 1, 1)
+        parts.append((month_dir(report_dir, d.year, d.month), d, next_d))
+        d = next_d
 
-        if not os.path.isdir(year_dir):
-            os.makedirs(year_dir)
+    return parts
 
-        rets = sreporting(
-            cfg_path, report=report,
-            grouping_specs=','.join(groupings),
-            start=start,
-            end=end
-        )
 
-        for k, v in rets.items():
-            report_path = os.path.join(year_dir, '{}-{}.csv'.format(report, k))
+def yearly_units(report_dir, reports, year):
+    start_date = datetime(year, 1, 1)
+    end_date = datetime(year + 1, 1, 1)
 
-            with open(report_path, 'w') as f:
-                f.write('report={},grouping={},start={},end={}\n'.format(
-                    report, k, start, end
-                ))
-                f.write('\n')
-                f.write(v)
+    year_dir = os.path.join(report_dir, str(year))
 
-    if modified:
-        shutil.copy(cfg_path, year_dir)
+    return period_units(reports, start_date, end_date, year_dir,
+                        (start_date.year, ),
+                        month_parts(report_dir, start_date, end_date))
 
 
-def monthly(cfg_path, report_dir, reports, year, month):
+def quarterly_units(report_dir, reports, year, quarter):
+    start_date = datetime(year, 3 * quarter - 2, 1)
+    end_date = datetime(year + 1, 1, 1) if quarter == 4 else datetime(year, 3 * quarter + 1, 1)
+
+    quarter_dir = os.path.join(report_dir, str(year), 'Q{}'.format(quarter))
+
+    return period_units(reports, start_date, end_date, quarter_dir,
+                        (start_date.year, 'Q{}'.format(quarter)),
+                        month_parts(report_dir, start_date, end_date))
 
+
+def monthly_units(report_dir, reports, year, month):
     start_date = datetime(year, month, 1)
-    start = '{}-{}-{}'.format(start_date.year, start_date.month, 1)
 
     if month == 12:
         end_date = datetime(year + 1, 1, 1)
     else:
         end_date = datetime(year, month + 1, 1)
-    end = '{}-{}-{}'.format(end_date.year, end_date.month, 1)
 
-    month_dir = os.path.join(report_dir, str(year), '{:02d}'.format(month))
+    return period_units(reports, start_date, end_date, month_dir(report_dir, year, month),
+                        (start_date.year, start_date.month))
 
-    modified = False
 
-    for report, groupings in reports.items():
-        groupings = groupings.split(',')
-        files = ['{}-{}.csv'.format(report, g) for g in groupings]
+def rollup_units(report_dir, reports, start_date, end_date):
+    """units of an arbitrary range of months, printed instead of written"""
+    return period_units(reports, start_date, end_date, None,
+                        (start_date.year, start_date.month),
+                        month_parts(report_dir, start_date, end_date))
 
-        if all([os.path.isfile(os.path.join(month_dir, f)) for f in files]):
-            continue
 
-        modified = True
+def split_rollups(units, plan_of, fingerprints, store):
+    """split units between the ones computed from sacct and the ones rolled up
 
-        print(start_date.year, start_date.month, report, groupings)
+    A grouping of a unit with parts is rolled up when it is mergeable and
+    every part has an up to date sidecar with its aggregate state, or is
+    computed in this run.
+    """
+    scheduled = {(u.period_dir, u.name(g)) for u in units if not u.parts for g in u.groupings}
 
-        if not os.path.isdir(month_dir):
-            os.makedirs(month_dir)
+    def aggregated(part, name, fingerprint):
+        if store.fingerprint(part, name) != fingerprint:
+            return False
+        # not adopted (see Unit.adopt())
+        return 'state' in store.sidecar(part, name)
 
-        rets = sreporting(
-            cfg_path, report=report,
-            grouping_specs=','.join(groupings),
-            start=start,
-            end=end
-        )
+    direct = []
+    rollups = []
+    for u in units:
+        if not u.parts:
+            direct.append(u)
+            continue
 
-        for k, v in rets.items():
-            report_path = os.path.join(
-                month_dir,
-                '{}-{}.csv'.format(report, k)
+        plan = plan_of(u)
+        rollable = [
+            g for g, title in zip(u.groupings, plan.titles)
+            if plan.mergeable(title) and all(
+                (part, u.name(g)) in scheduled
+                or aggregated(part, u.name(g), fingerprints(u.report, g, start, end))
+                for part, start, end in u.parts
             )
+        ]
+        others = [g for g in u.groupings if g not in rollable]
+
+        if rollable:
+            rollups.append(u.subset(rollable))
+        if others:
+            direct.append(u.subset(others))
+
+    return direct, rollups
+
+
+def run_units(cfg_path, units, dry_run=False, estimate=False, processes=1, recompute=False):
+    """compute stale units, sharing sacct queries between them
+
+    Units with parts are rolled up from their parts sidecars when possible,
+    after the parts computed in this run. Outputs without sidecar are only
+    recomputed with recompute.
+    """
+    from slurm_accounting import config
+    from slurm_accounting.report_store import make_store
+
+    cfg = config.Config(cfg_path)
+    clusters = cluster_list(cfg, cfg.get('periodic_reports', 'clusters', False) or None)
+    fingerprints = Fingerprints(cfg, clusters)
+
+    store = make_store(cfg)
+
+    if not dry_run and not recompute:
+        for u in units:
+            u.adopt(fingerprints, store)
+
+    units = [u.subset(u.stale(fingerprints, store, recompute)) for u in units]
+    units = [u for u in units if u.groupings]
+    if not units:
+        return
+
+    if clusters is None:
+        slurm_conf = load_slurm_conf(cfg)
+    else:
+        slurm_confs = {c: load_slurm_conf(cfg, c) for c in clusters}
+
+    def make_report(u):
+        if clusters is None:
+            r = Report(cfg, u.report, grouping_specs=','.join(u.groupings), start=u.start,
+                       end=u.end, slurm_conf=slurm_conf)
+        else:
+            r = FederatedReport(cfg, clusters, u.report, grouping_specs=','.join(u.groupings),
+                                start=u.start, end=u.end, slurm_confs=slurm_confs)
+
+        header_fields = plan_fields(grouping_plan(','.join(u.header)))
+        for m in getattr(r, 'members', [r]):
+            m.header_fields = header_fields
+        return r
+
+    direct, rollups = split_rollups(units, lambda u: grouping_plan(','.join(u.groupings)),
+                                    fingerprints, store)
+
+    reports = []
+    members = []
+    for u in direct:
+        print(*(u.label + (u.report, u.groupings)))
 
-            with open(report_path, 'w') as f:
-                f.write('report={},grouping={},start={},end={}\n'.format(
-                    report, k, start, end
-                ))
-                f.write('\n')
-                f.write(v)
+        r = make_report(u)
+        members += getattr(r, 'members', [r])
+        print(r)
+        reports.append(r)
 
-    if modified:
-        shutil.copy(cfg_path, month_dir)
+    windows = planner.plan(members)
+
+    def sources(format):
+        if clusters is None:
+            return make_sacct(cfg, format=format)
+        return {c: make_sacct(cfg, format=format, cluster=c) for c in clusters}
+
+    if dry_run:
+        planner.dry_run(members, windows, estimate=estimate, src=sources(('jobid', )))
+        for u in rollups:
+            print('rollup', *(u.label + (u.report, u.groupings, len(u.parts))))
+        return
+
+    if windows:
+        planner.execute(windows, sources(planner.fields(windows)), processes=processes)
+
+    modified = set()
+    for u, r in zip(direct, reports):
+        u.write(r, fingerprints, store)
+        modified.add(u.period_dir)
+
+    for u in rollups:
+        print('rollup', *(u.label + (u.report, u.groupings)))
+
+        r = make_report(u)
+        u.rollup(r, store)
+        u.write(r, fingerprints, store)
+        modified.add(u.period_dir)
+
+    for period_dir in sorted(d for d in modified if d is not None):
+        store.snapshot(period_dir, cfg_path)
+
+
+def yearly(cfg_path, report_dir, reports, year):
+    run_units(cfg_path, yearly_units(report_dir, reports, year))
+
+
+def monthly(cfg_path, report_dir, reports, year, month):
+    run_units(cfg_path, monthly_units(report_dir, reports, year, month))
 
 
 def main():
     import argparse
+    from slurm_accounting import config
 
     parser = argparse.ArgumentParser(
         description='Gather cluster Slurm accounting reports'
@@ -121,25 +425,86 @@ def main():
         default=config.find_config_file(__file__, 'sreporting.conf'),
         help='config file'
     )
+    parser.add_argument(
+        '-n', '--dry-run', action='store_true', default=False,
+        help='print the sacct fetch plan instead of computing reports'
+    )
+    parser.add_argument(
+        '--estimate', action='store_true', default=False,
+        help='with --dry-run, count the jobs of each fetch window'
+    )
+    parser.add_argument(
+        '-j', '--processes', metavar='N', type=int, default=1,
+        help='account jobs on N processes'
+    )
+    parser.add_argument(
+        '--recompute', action='store_true', default=False,
+        help='recompute the reports written before fingerprints (without sidecar) '
+        'instead of keeping them'
+    )
+    parser.add_argument(
+        '--rollup', nargs=2, metavar=('START_MONTH', 'END_MONTH'), default=None,
+        help='print [periodic_report:monthly] reports of months START_MONTH to END_MONTH '
+        '(excluded) merged from the monthly aggregates'
+    )
+    parser.add_argument(
+        '--list', nargs='?', metavar='PERIOD', const='', default=None,
+        help='list the stored reports, of PERIOD (e.g. 2022/03) only if given'
+    )
+    parser.add_argument(
+        '--show', nargs=2, metavar=('PERIOD', 'NAME'), default=None,
+        help='print the stored report NAME (REPORT-GROUPING) of PERIOD'
+    )
 
     args = parser.parse_args()
 
     cfg = config.Config(args.cfg)
     year_start = cfg.getint('periodic_reports', 'year_start', 2000)
-    report_dir = cfg.get('periodic_reports', 'report_dir')
+    # periods of a store are keyed by their path relative to report_dir
+    store_path = cfg.get('periodic_reports', 'store', '')
+    report_dir = cfg.get('periodic_reports', 'report_dir', '' if store_path else None)
+
+    if args.list is not None or args.show is not None:
+        from slurm_accounting.report_store import make_store
+
+        store = make_store(cfg)
+        if args.show is not None:
+            print(store.read(*args.show), end='')
+        else:
+            for period, name in store.list(args.list or None):
+                print(period, name)
+        store.close()
+        return
+
+    if args.rollup is not None:
+        start, end = [parse_slurm_date(d) for d in args.rollup]
+        units = rollup_units(report_dir, cfg.section('periodic_report:monthly'), start, end)
+        run_units(args.cfg, units, dry_run=args.dry_run)
+        return
 
     today = datetime.today()
     year_end = today.year
 
+    quarterly = {}
+    if 'periodic_report:quarterly' in cfg.sections():
+        quarterly = cfg.section('periodic_report:quarterly')
+
+    units = []
     for year in range(year_start, year_end + 1):
         month_end = today.month - 1
         if year < year_end:
-            yearly(args.cfg, report_dir, cfg.section('periodic_report:yearly'), year)
+            units += yearly_units(report_dir, cfg.section('periodic_report:yearly'), year)
 
             month_end = 12
 
+        for quarter in range(1, month_end // 3 + 1):
+            units += quarterly_units(report_dir, quarterly, year, quarter)
+
         for month in range(1, month_end + 1):
-            monthly(args.cfg, report_dir, cfg.section('periodic_report:monthly'), year, month)
+            units += monthly_units(report_dir, cfg.section('periodic_report:monthly'), year, month)
+
+    run_units(args.cfg, units, dry_run=args.dry_run, estimate=args.estimate,
+              processes=args.processes, recompute=args.recompute)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,213 @@
+"""Plan sacct queries for a batch of reports.
+
+Each Report widens its sacct window by query_grace on both sides, so running
+consecutive periods one by one fetches the overlapping grace ranges several
+times. The planner merges the windows of reports sharing the same sacct
+filters into non-overlapping fetch windows, runs one query per window and
+dispatches every job row to each report it may contribute to.
+"""
+
+import sys
+
+from .sreport import Sacct, print_datetime
+
+
+class FetchWindow(object):
+    def __init__(self, key, start, end):
+        self.key = key
+        self.start = start
+        self.end = end
+        self.reports = []
+
+    def add(self, report):
+        self.start = min(self.start, report.query_start_date)
+        self.end = max(self.end, report.query_end_date)
+        self.reports.append(report)
+
+    def days(self):
+        return (self.end - self.start).total_seconds() / 86400.
+
+    @property
+    def cluster(self):
+        return self.key[0]
+
+    def steps(self):
+        return any(r.uses_steps() for r in self.reports)
+
+    def sacct_args(self):
+        _cluster, partition, nodes, states = self.key
+        return dict(start=print_datetime(self.start), end=print_datetime(self.end),
+                    partition=partition, nodes=nodes, states=list(states))
+
+    def __str__(self):
+        cluster, partition, nodes, states = self.key
+        ret = 'window start={} end={} partition={} nodes={} states={} reports={}'.format(
+            print_datetime(self.start), print_datetime(self.end), partition, nodes,
+            ','.join(states), len(self.reports)
+        )
+        if cluster is not None:
+            ret = 'cluster={} '.format(cluster) + ret
+        return ret
+
+
+def plan(reports):
+    """merge the sacct windows of reports into a minimal list of FetchWindow
+
+    Windows are only shared by reports with identical sacct filters
+    (cluster, partition, node restriction, states); overlapping or adjacent
+    windows are merged.
+    """
+    by_key = {}
+    for r in reports:
+        by_key.setdefault(r.fetch_key(), []).append(r)
+
+    windows = []
+    for key in sorted(by_key, key=repr):
+        current = None
+        for r in sorted(by_key[key], key=lambda r: r.query_start_date):
+            if current is None or r.query_start_date > current.end:
+                current = FetchWindow(key, r.query_start_date, r.query_end_date)
+                windows.append(current)
+            current.add(r)
+
+    return windows
+
+
+def naive_days(reports):
+    """days fetched when every report queries its own window"""
+    return sum((r.query_end_date - r.query_start_date).total_seconds() / 86400.
+               for r in reports)
+
+
+def source(sources, window):
+    """sacct source of a window: sources is a Sacct or a {cluster: Sacct} dict"""
+    if isinstance(sources, dict):
+        return sources[window.cluster]
+    return sources
+
+
+def estimate_rows(window, src=None):
+    """count the jobs of a window with a jobid-only sacct query"""
+    src = source(src, window) or Sacct(format=('jobid', ))
+    return sum(1 for _ in src(**window.sacct_args()))
+
+
+def dry_run(reports, windows, estimate=False, src=None, out=sys.stdout):
+    print('reports,{}'.format(len(reports)), file=out)
+    print('naive_fetch_days,{:.1f}'.format(naive_days(reports)), file=out)
+    print('planned_fetch_days,{:.1f}'.format(sum(w.days() for w in windows)), file=out)
+    print('windows,{}'.format(len(windows)), file=out)
+
+    total = 0
+    for w in windows:
+        line = str(w)
+        if estimate:
+            rows = estimate_rows(w, src)
+            total += rows
+            line += ' estimated_rows={}'.format(rows)
+        print(line, file=out)
+        for r in w.reports:
+            print('  {} start={} end={}'.format(r.report, print_datetime(r.start_date),
+                                                print_datetime(r.end_date)), file=out)
+
+    if estimate:
+        print('estimated_rows,{}'.format(total), file=out)
+
+
+def fields(windows):
+    """sacct fields needed by the reports of windows"""
+    ret = set()
+    for w in windows:
+        for r in w.reports:
+            ret |= r.fields()
+    return Sacct.sorted_format(ret)
+
+
+def execute(windows, src=None, workers=4, processes=1, per_cluster=2):
+    """fetch each window once and feed its jobs to the matching reports
+
+    Windows are fetched concurrently (e.g. one per cluster), at most
+    per_cluster at once on a cluster, but accounted in plan order, keeping
+    sums reproducible. With processes > 1, jobs are accounted by that many
+    worker processes instead (see sharding). Reports whose top-K leaders are
+    not exact after that are fed their jobs again.
+    """
+    src = src or Sacct(format=fields(windows), verbose=False)
+
+    if processes > 1:
+        from .sharding import execute as sharded_execute
+        sharded_execute(windows, src, processes)
+    else:
+        account(windows, src, workers, per_cluster)
+
+    rescans = [x for x in (r.rescan() for w in windows for r in w.reports) if x is not None]
+    if rescans:
+        account(plan(rescans), src, workers, per_cluster)
+
+
+def account(windows, src, workers=4, per_cluster=2, queue_size=4):
+    """execute() in threads, without rescans
+
+    Each fetch thread streams its batches through a queue of queue_size
+    batches: at most workers windows are held in memory, partly. Threads
+    take their slots in plan order and free them once their window is
+    accounted, so the window being accounted is always being fetched.
+    """
+    import queue
+    import threading
+
+    done = object()
+    slots = threading.BoundedSemaphore(max(1, workers))
+    cluster_slots = {w.cluster: threading.BoundedSemaphore(max(1, per_cluster))
+                     for w in windows}
+    queues = [queue.Queue(queue_size) for _ in windows]
+    stop = threading.Event()
+
+    def put(q, item):
+        # give up when accounting failed, nothing reads the queue anymore
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch(w, q):
+        try:
+            for batch in source(src, w).batches(steps=w.steps(), **w.sacct_args()):
+                if not put(q, batch):
+                    return
+            put(q, done)
+        except Exception as e:
+            put(q, e)
+        finally:
+            cluster_slots[w.cluster].release()
+            slots.release()
+
+    def schedule():
+        for w, q in zip(windows, queues):
+            slots.acquire()
+            cluster_slots[w.cluster].acquire()
+            if stop.is_set():
+                cluster_slots[w.cluster].release()
+                slots.release()
+                return
+            threading.Thread(target=fetch, args=(w, q), daemon=True).start()
+
+    scheduler = threading.Thread(target=schedule, daemon=True)
+    scheduler.start()
+
+    try:
+        for w, q in zip(windows, queues):
+            while True:
+                batch = q.get()
+                if batch is done:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                for r in w.reports:
+                    # reports clip the batch to their own period
+                    r.batch(batch)
+    finally:
+        stop.set()
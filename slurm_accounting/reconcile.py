@@ -0,0 +1,156 @@
+"""Cross-check of sacct derived cpu hours against slurmdbd sreport rollups.
+
+    python -m slurm_accounting.reconcile [REPORT] -s 2022-01 -e 2022-02
+
+computes account * user * cpu_hours from sacct jobs (Report) and from
+`sreport cluster AccountUtilizationByUser` over the same period, aligns
+them by account and user and prints their deltas. Exits with status 1 when
+some delta exceeds the tolerance.
+
+sreport totals are cluster wide: reports restricted to a partition or to
+some nodes can't be reconciled with them, a warning line says so.
+
+sreport rollups can also answer reports on their own: with
+
+    [report:NAME]
+    use_sreport_rollups = yes
+
+sreporting() fills account/user cpu_hours groupings from sreport instead of
+scanning sacct jobs, when the report only has such groupings and no node
+restriction (see rollup_answerable()).
+"""
+
+import sys
+
+from .sreport import Report, Sacct, make_sacct, make_sreport, print_datetime
+
+# groupings and values sreport AccountUtilizationByUser can provide
+ROLLUP_GROUPINGS = ('account', 'user')
+ROLLUP_VALUES = ('cpu_hours', 'cpu_seconds')
+
+
+def sreport_rows(src, start, end):
+    """{(account, user): hours} of user rows, account rows being sums of them"""
+    ret = {}
+    for account, user, used in src(start.strftime('%Y-%m-%dT%H:%M'),
+                                   end.strftime('%Y-%m-%dT%H:%M')):
+        if user:
+            ret[(account, user)] = ret.get((account, user), 0.) + float(used)
+    return ret
+
+
+def report_rows(r):
+    """{(account, user): hours} of an account*user*cpu_hours Report"""
+    grouping, _title = r.groupings[0]
+    return {(a, u): grouping[a][u][0] for a in grouping.key_list()
+            for u in grouping[a].key_list()}
+
+
+def restricted(r):
+    return r.partition is not None or r.selected_nodes_spec is not None
+
+
+def rollup_answerable(r):
+    """can the groupings of report r be computed from sreport rollups alone?"""
+    if restricted(r) or r.cluster is not None:
+        return False
+
+    for title in r.plan.titles:
+        *groupings, value = title
+        if value not in ROLLUP_VALUES or any(g not in ROLLUP_GROUPINGS for g in groupings):
+            return False
+
+    return True
+
+
+def fill_from_rollups(r, rows):
+    """account sreport {(account, user): hours} into the groupings of r"""
+    start, end = print_datetime(r.start_date), print_datetime(r.end_date)
+    seconds = (r.end_date - r.start_date).total_seconds()
+
+    for (account, user), hours in sorted(rows.items()):
+        job = {'account': account, 'user': user, 'start': start, 'end': end,
+               'ncpus': '0', 'seconds': seconds, 'cpuseconds': hours * 3600.,
+               'cluster': r.cluster_name()}
+        for grouping, _title in r.groupings:
+            grouping.job(dict(job))
+
+
+def reconcile(cfg, report=None, start=None, end=None, tolerance=1., out=sys.stdout):
+    """print the deltas of both paths, return the number of mismatches
+
+    A delta is a mismatch above tolerance percent, and above one hour
+    (sreport rounds hours).
+    """
+    r = Report(cfg, report, 'account*user*cpu_hours', start, end)
+
+    src = make_sacct(cfg, format=Sacct.sorted_format(r.fields()))
+    for batch in src.batches(start=print_datetime(r.query_start_date),
+                             end=print_datetime(r.query_end_date),
+                             partition=r.partition, nodes=r.selected_nodes_spec,
+                             states=r.states):
+        r.batch(batch)
+
+    sacct = report_rows(r)
+    sreport = sreport_rows(make_sreport(cfg, include_header=False), r.start_date, r.end_date)
+
+    print('report,{}'.format(r.report), file=out)
+    print('start,{}'.format(print_datetime(r.start_date)), file=out)
+    print('end,{}'.format(print_datetime(r.end_date)), file=out)
+    if restricted(r):
+        print('warning,sreport totals are cluster wide but the report has a node selection',
+              file=out)
+    print(file=out)
+
+    def line(account, user, a, b):
+        delta = a - b
+        pct = 100. * delta / b if b else (0. if not a else 100.)
+        bad = abs(delta) > 1. and abs(pct) > tolerance
+        # + 0. turns -0. into 0.
+        print('{},{},{},{},{},{:.1f}%,{}'.format(
+            account, user, round(a), round(b), round(delta), round(pct, 1) + 0.,
+            'MISMATCH' if bad else 'ok'), file=out)
+        return bad
+
+    print('account,user,sacct_hours,sreport_hours,delta,delta_pct,status', file=out)
+
+    mismatches = 0
+    accounts = sorted({a for a, _ in sacct} | {a for a, _ in sreport})
+    for account in accounts:
+        users = sorted({u for a, u in list(sacct) + list(sreport) if a == account})
+        for user in users:
+            mismatches += line(account, user, sacct.get((account, user), 0.),
+                               sreport.get((account, user), 0.))
+        # account totals from user rows: sreport ones include sub-accounts
+        line(account, '', sum(v for (a, _), v in sacct.items() if a == account),
+             sum(v for (a, _), v in sreport.items() if a == account))
+
+    line('TOTAL', '', sum(sacct.values()), sum(sreport.values()))
+    print('mismatches,{}'.format(mismatches), file=out)
+
+    return mismatches
+
+
+def main():
+    import argparse
+    from . import config
+
+    parser = argparse.ArgumentParser(description='reconcile sacct and sreport cpu hours')
+    parser.add_argument('report', metavar='REPORT', nargs='?', default=None,
+                        help='use section [report:REPORT] section in configuration file')
+    parser.add_argument('-s', '--start', metavar='START_DATE', default=None)
+    parser.add_argument('-e', '--end', metavar='END_DATE', default=None)
+    parser.add_argument('-t', '--tolerance', metavar='PERCENT', type=float, default=1.,
+                        help='accepted delta (default 1%%)')
+    parser.add_argument('--cfg', metavar='PATH',
+                        default=config.find_config_file(__file__, 'sreporting.conf'),
+                        help='config file')
+
+    args = parser.parse_args()
+
+    cfg = config.Config(args.cfg)
+    sys.exit(1 if reconcile(cfg, args.report, args.start, args.end, args.tolerance) else 0)
+
+
+if __name__ == '__main__':
+    main()
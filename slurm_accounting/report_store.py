@@ -0,0 +1,199 @@
+"""Storage of periodic_reports outputs.
+
+By default each period is a directory (REPORT_DIR/2022/03, 2022/Q1, 2022)
+holding a CSV and an aggregate sidecar per report grouping, and a copy of
+the config file. With
+
+    [periodic_reports]
+    store = /var/lib/sreporting/reports.sqlite
+
+all periods live in a single SQLite file instead: one row per report
+grouping with its zlib compressed CSV and sidecar, indexed by period and
+name, and config snapshots stored once per distinct content (sha256).
+
+    python -m slurm_accounting.periodic_reports --list [PERIOD]
+    python -m slurm_accounting.periodic_reports --show 2022/03 main-group*cpu_hours
+"""
+
+import os
+import json
+
+
+class DirectoryStore(object):
+    """REPORT-GROUPING.csv and .json files in period directories"""
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, period_dir, name, ext):
+        return os.path.join(period_dir, name + ext)
+
+    def exists(self, period_dir, name):
+        return os.path.isfile(self.path(period_dir, name, '.csv'))
+
+    def sidecar(self, period_dir, name):
+        try:
+            with open(self.path(period_dir, name, '.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def fingerprint(self, period_dir, name):
+        return (self.sidecar(period_dir, name) or {}).get('fingerprint')
+
+    def put(self, period_dir, name, csv, sidecar):
+        if not os.path.isdir(period_dir):
+            os.makedirs(period_dir)
+
+        with open(self.path(period_dir, name, '.csv'), 'w') as f:
+            f.write(csv)
+
+        with open(self.path(period_dir, name, '.json'), 'w') as f:
+            json.dump(sidecar, f)
+
+    def adopt(self, period_dir, name, sidecar):
+        """sidecar of a CSV written without one"""
+        with open(self.path(period_dir, name, '.json'), 'w') as f:
+            json.dump(sidecar, f)
+
+    def snapshot(self, period_dir, cfg_path):
+        import shutil
+        shutil.copy(cfg_path, period_dir)
+
+    def read(self, period_dir, name):
+        with open(self.path(os.path.join(self.root, period_dir), name, '.csv')) as f:
+            return f.read()
+
+    def list(self, period=None):
+        """[(period, name)] of the stored CSVs"""
+        ret = []
+        for d, _dirs, files in os.walk(os.path.join(self.root, period or '')):
+            rel = os.path.relpath(d, self.root)
+            ret += [(rel, f[:-4]) for f in files if f.endswith('.csv')]
+        return sorted(ret)
+
+    def close(self):
+        pass
+
+
+class SqliteStore(object):
+    """all periods in one SQLite file
+
+    Periods are keyed by their directory relative to root (2022/03).
+    """
+    schema = '''
+        CREATE TABLE IF NOT EXISTS configs (
+            digest TEXT PRIMARY KEY,
+            text BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS periods (
+            period TEXT PRIMARY KEY,
+            config TEXT REFERENCES configs(digest)
+        );
+        CREATE TABLE IF NOT EXISTS reports (
+            period TEXT NOT NULL,
+            name TEXT NOT NULL,
+            fingerprint TEXT,
+            csv BLOB NOT NULL,
+            sidecar BLOB NOT NULL,
+            PRIMARY KEY (period, name)
+        );
+    '''
+
+    def __init__(self, path, root=''):
+        import sqlite3
+
+        self.path = path
+        self.root = root
+        self.db = sqlite3.connect(path)
+        self.db.executescript(self.schema)
+
+    def period(self, period_dir):
+        return os.path.relpath(period_dir, self.root) if self.root else period_dir
+
+    def exists(self, period_dir, name):
+        return self.db.execute('SELECT 1 FROM reports WHERE period = ? AND name = ?',
+                               (self.period(period_dir), name)).fetchone() is not None
+
+    def sidecar(self, period_dir, name):
+        import zlib
+
+        row = self.db.execute('SELECT sidecar FROM reports WHERE period = ? AND name = ?',
+                              (self.period(period_dir), name)).fetchone()
+        return None if row is None else json.loads(zlib.decompress(row[0]).decode())
+
+    def fingerprint(self, period_dir, name):
+        row = self.db.execute('SELECT fingerprint FROM reports WHERE period = ? AND name = ?',
+                              (self.period(period_dir), name)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, period_dir, name, csv, sidecar):
+        import zlib
+
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?, ?)',
+                (self.period(period_dir), name, sidecar.get('fingerprint'),
+                 zlib.compress(csv.encode()), zlib.compress(json.dumps(sidecar).encode()))
+            )
+
+    def adopt(self, period_dir, name, sidecar):
+        """sidecar of a report imported without one"""
+        import zlib
+
+        with self.db:
+            self.db.execute('UPDATE reports SET fingerprint = ?, sidecar = ? '
+                            'WHERE period = ? AND name = ?',
+                            (sidecar.get('fingerprint'),
+                             zlib.compress(json.dumps(sidecar).encode()),
+                             self.period(period_dir), name))
+
+    def snapshot(self, period_dir, cfg_path):
+        import hashlib
+        import zlib
+
+        with open(cfg_path, 'rb') as f:
+            text = f.read()
+        digest = hashlib.sha256(text).hexdigest()
+
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO configs VALUES (?, ?)',
+                            (digest, zlib.compress(text)))
+            self.db.execute('INSERT OR REPLACE INTO periods VALUES (?, ?)',
+                            (self.period(period_dir), digest))
+
+    def read(self, period, name):
+        import zlib
+
+        row = self.db.execute('SELECT csv FROM reports WHERE period = ? AND name = ?',
+                              (period, name)).fetchone()
+        if row is None:
+            raise KeyError('{} {}'.format(period, name))
+        return zlib.decompress(row[0]).decode()
+
+    def config(self, period):
+        """config snapshot of the last run that wrote in period"""
+        import zlib
+
+        row = self.db.execute('SELECT text FROM configs JOIN periods ON digest = config '
+                              'WHERE period = ?', (period, )).fetchone()
+        return None if row is None else zlib.decompress(row[0]).decode()
+
+    def list(self, period=None):
+        if period is None:
+            rows = self.db.execute('SELECT period, name FROM reports ORDER BY period, name')
+        else:
+            rows = self.db.execute('SELECT period, name FROM reports WHERE period = ? '
+                                   'ORDER BY name', (period, ))
+        return rows.fetchall()
+
+    def close(self):
+        self.db.close()
+
+
+def make_store(cfg):
+    """store of the [periodic_reports] section"""
+    report_dir = cfg.get('periodic_reports', 'report_dir', '')
+    path = cfg.get('periodic_reports', 'store', '')
+    if path:
+        return SqliteStore(path, report_dir)
+    return DirectoryStore(report_dir)
@@ -0,0 +1,186 @@
+"""Reports over a rolling window (last 24h, 7d, 30d...).
+
+The window is kept as a ring buffer of hourly grouping trees. Refreshing only
+fetches and accounts the hours elapsed since the previous refresh, the oldest
+hours falling out of the ring, plus the current hour up to now (RUNNING jobs
+being credited up to now) and the tail of the hour before the ring, from
+exactly the window length ago. Reading the report merges these trees.
+
+Only groupings of cpu or TRES time by job fields add up over hours (see
+GroupingPlan.mergeable()): job counts, utilization, histograms... are
+rejected.
+
+    sreporting --last 7d [--state PATH]
+"""
+
+import json
+import datetime
+from collections import deque
+
+from .sreport import Report, Sacct, make_sacct, merge_groupings, print_datetime
+
+HOUR = datetime.timedelta(hours=1)
+
+
+def parse_length(s):
+    """rolling window length: Nh or Nd"""
+    units = {'h': 1, 'd': 24}
+    if not s or s[-1] not in units or not s[:-1].isdigit() or int(s[:-1]) == 0:
+        raise ValueError('invalid window length \'%s\' (e.g. 24h, 7d)' % s)
+    return int(s[:-1]) * units[s[-1]]
+
+
+def hour_floor(d):
+    return d.replace(minute=0, second=0, microsecond=0)
+
+
+class RollingWindow(object):
+    def __init__(self, cfg, report=None, grouping_specs=None, length='7d', slurm_conf=None,
+                 src=None, extra_options=[]):
+        self.cfg = cfg
+        self.hours = parse_length(length)
+        self.length = length
+
+        self.proto = Report(cfg, report, grouping_specs, slurm_conf=slurm_conf)
+        for title in self.proto.plan.titles:
+            if not self.proto.plan.mergeable(title, 'hourly'):
+                raise ValueError('grouping \'%s\' cannot be aggregated over a rolling window' %
+                                 '*'.join(title))
+
+        self.src = src or make_sacct(cfg, format=Sacct.sorted_format(self.proto.fields()),
+                                     extra_options=extra_options)
+
+        # (hour start, groupings) of complete hours, oldest first: with the
+        # head (window start to the first ring hour) and the current hour
+        # up to now, they cover exactly the window length
+        self.ring = deque(maxlen=self.hours - 1)
+        self.head = None
+        self.current = None
+        self.now = None
+
+    def refresh(self, now=None):
+        """account the hours elapsed since last refresh, return their number"""
+        now = now or datetime.datetime.now()
+        current = hour_floor(now)
+
+        begin = now - self.hours * HOUR
+        first = current - (self.hours - 1) * HOUR
+        if self.ring:
+            first = max(first, self.ring[-1][0] + HOUR)
+
+        reports = []
+        h = first
+        while h < current:
+            reports.append(self.proto.window(h, h + HOUR))
+            h += HOUR
+
+        partial = self.proto.window(current, now)
+        self.fetch(reports + [partial], first, now)
+
+        head = self.proto.window(begin, current - (self.hours - 1) * HOUR)
+        self.fetch([head], begin, head.end_date)
+
+        for r in reports:
+            self.ring.append((r.start_date, r.groupings))
+        self.head = head
+        self.current = partial
+        self.now = now
+
+        return len(reports)
+
+    def fetch(self, reports, start, end):
+        """feed each consecutive hourly report the jobs overlapping its hour"""
+        fromiso = datetime.datetime.fromisoformat
+        last = len(reports) - 1
+
+        batches = self.src.batches(start=print_datetime(start), end=print_datetime(end),
+                                   partition=self.proto.partition,
+                                   nodes=self.proto.selected_nodes_spec,
+                                   states=self.proto.states,
+                                   steps=self.proto.uses_steps())
+
+        for batch in batches:
+            hours = [[] for _ in reports]
+            for i, (s, e, state) in enumerate(zip(batch['start'], batch['end'], batch['state'])):
+                if state == 'PENDING' or s == 'Unknown':
+                    continue
+
+                # first and last hours overlapped by the job
+                b = max(0, int((fromiso(s) - start).total_seconds() // 3600))
+                if e == 'Unknown':
+                    l = last
+                else:
+                    # jobs ending at an hour start (or the window start) don't
+                    # overlap it, but keep their keys like reports do
+                    l = min(last, max(b, -int(-(fromiso(e) - start).total_seconds() // 3600) - 1))
+
+                for k in range(b, l + 1):
+                    hours[k].append(i)
+
+            for r, indices in zip(reports, hours):
+                if indices:
+                    r.batch(batch.take(indices))
+
+    def report(self):
+        """Report of the whole window, merged from the hourly trees"""
+        if self.now is None:
+            self.refresh()
+
+        r = self.proto.window(self.head.start_date, self.now)
+
+        merge_groupings(r.groupings, self.head.groupings)
+        for _, groupings in self.ring:
+            merge_groupings(r.groupings, groupings)
+        merge_groupings(r.groupings, self.current.groupings)
+
+        return r
+
+    def render(self):
+        return self.report().render()
+
+    def fingerprint(self):
+        """inputs of the hourly trees: report and histogram sections,
+        slurm.conf, code version... as periodic reports fingerprints"""
+        import hashlib
+        from .periodic_reports import Fingerprints
+
+        fingerprints = Fingerprints(self.cfg)
+        inputs = fingerprints.inputs(self.proto.report, str(self.proto.plan))
+        inputs['length'] = self.length
+        if fingerprints.source is not None:
+            # jobs data of file sources
+            inputs['source'] = fingerprints.source
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def save(self, path):
+        """save complete hours, the current one is recomputed on refresh"""
+        with open(path, 'w') as f:
+            json.dump({
+                'report': self.proto.report,
+                'grouping': str(self.proto.plan),
+                'length': self.length,
+                'fingerprint': self.fingerprint(),
+                'hours': [[print_datetime(h), [g.state() for g, _ in groupings]]
+                          for h, groupings in self.ring],
+            }, f)
+
+    def load(self, path):
+        """restore hours saved by save() with the same inputs, if any"""
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if state.get('fingerprint') != self.fingerprint():
+            return False
+
+        self.ring.clear()
+        for h, states in state['hours']:
+            start = datetime.datetime.fromisoformat(h)
+            groupings = self.proto.plan.new(start, start + HOUR)
+            for (g, _), st in zip(groupings, states):
+                g.load(st)
+            self.ring.append((start, groupings))
+
+        return True
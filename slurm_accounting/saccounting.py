@@ -1,10 +1,10 @@
 from . import sreport
 from . import date
 
-import argparse
-
 
 def main():
+    import argparse
+
     parser = argparse.ArgumentParser()
     parser.add_argument('-v','--verbose', action='store_true', default=False, help='be verbose')
     parser.add_argument('startdate', metavar='START', type=date.SlurmDate, nargs='?',
@@ -15,6 +15,16 @@ def main():
                         help='report type (u, g or ug)')
     parser.add_argument('-n','--no-header', dest='header', action='store_false', default=True,
                         help='don\'t print header')
+    parser.add_argument('-p', '--period', dest='periods', metavar=('START', 'END'),
+                        type=date.SlurmDate, nargs=2, action='append', default=None,
+                        help='report on period START to END (may be repeated)')
+    split = parser.add_mutually_exclusive_group()
+    split.add_argument('--monthly', dest='split', action='store_const', const='monthly',
+                       default=None, help='split START to END in months')
+    split.add_argument('--daily', dest='split', action='store_const', const='daily',
+                       help='split START to END in days')
+    parser.add_argument('-j', '--jobs', type=int, default=4, metavar='N',
+                        help='run up to N sreport queries at once (default 4)')
 
     args = parser.parse_args()
 
@@ -29,6 +39,22 @@ def main():
     r = sreport.SreportCluster(include_header=args.header, skip_users=skip_users,
                                skip_groups=skip_groups, verbose=args.verbose)
 
+    periods = list(args.periods or [])
+    if args.split is not None:
+        if args.startdate is None or args.enddate is None:
+            parser.error('--%s needs START and END' % args.split)
+        periods += date.split_periods(args.startdate, args.enddate, args.split)
+
+    if periods:
+        # one table, period columns first
+        if args.header:
+            print(','.join(['start', 'end', 'account', 'user', 'used(hours)']))
+
+        for start, end, rows in r.periods(periods, workers=args.jobs):
+            for row in rows:
+                print(','.join([str(start), str(end)] + row))
+        return
+
     if args.header:
         print(('Period: start=%s end=%s' % (args.startdate, args.enddate)))
         print()
@@ -0,0 +1,222 @@
+"""Aggregation of large sacct outputs on several processes.
+
+The parent process only reads the raw sacct output: blocks of whole jobs are
+copied into shared memory segments and dealt round-robin to worker
+processes, which parse them and account the jobs into their own copy of the
+reports grouping trees. Every job being accounted by exactly one worker, the
+partial trees of the workers add up: their states are merged into the
+parent reports at the end, in worker order.
+
+Workers are forked, so reports are inherited rather than pickled.
+"""
+
+from .sreport import fold_steps, merge_groupings, split_blocks
+
+
+def cut(block, steps):
+    """length of the leading part of block made of whole jobs
+
+    With steps, the rows of a job must stay together: the block is cut
+    before its last allocation row (jobid is the first field).
+    """
+    end = block.rfind(b'\n') + 1
+    if not steps:
+        return end
+
+    while end:
+        start = block.rfind(b'\n', 0, end - 1) + 1
+        if b'.' not in block[start:block.find(b'|', start, end)]:
+            return start
+        end = start
+
+    return 0
+
+
+def source_blocks(s, w, block_size):
+    """raw sacct output blocks of a window
+
+    Sources without raw output (dumps, archive) are queried and their rows
+    serialized back to --parsable2 ones, job steps unfolded.
+    """
+    if hasattr(s, 'blocks'):
+        return s.blocks(s.cmdline(steps=w.steps(), **w.sacct_args()), block_size)
+
+    def blocks():
+        query = getattr(s, 'select', s.batches)
+        for batch in query(steps=w.steps(), **w.sacct_args()):
+            columns = [batch[f] for f in s.format]
+            yield ''.join('|'.join(row) + '\n' for row in zip(*columns)).encode()
+
+    return blocks()
+
+
+def grouping_trees(windows):
+    """distinct (plan, groupings) of the reports of windows, in order
+
+    Reports of a federation share their groupings.
+    """
+    trees = {}
+    for w in windows:
+        for r in w.reports:
+            trees.setdefault(id(r.groupings), (r.plan, r.groupings))
+    return list(trees.values())
+
+
+def worker(index, windows, formats, tasks, results):
+    import traceback
+    from multiprocessing.shared_memory import SharedMemory
+
+    error = None
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        i, name, size = task
+        shm = SharedMemory(name=name)
+        data = bytes(shm.buf[:size])
+        shm.close()
+        shm.unlink()
+
+        if error is not None:
+            # keep draining tasks: the parent would block on a full queue
+            continue
+
+        try:
+            w = windows[i]
+            batches = split_blocks([data], formats[i])
+            if w.steps():
+                batches = fold_steps(batches)
+            for batch in batches:
+                for r in w.reports:
+                    r.batch(batch)
+        except Exception:
+            error = traceback.format_exc()
+
+    if error is not None:
+        results.put((index, None, error))
+    else:
+        results.put((index, [[g.state() for g, _ in groupings]
+                             for _, groupings in grouping_trees(windows)], None))
+
+
+def died(procs, reported=()):
+    """error of the first worker that exited without reporting its trees
+
+    Workers catch exceptions and always report: a non-zero exit code is a
+    crash or a kill (e.g. by the OOM killer).
+    """
+    for k, p in enumerate(procs):
+        if k not in reported and p.exitcode not in (None, 0):
+            return RuntimeError('aggregation worker {} died (exit code {})'.format(k, p.exitcode))
+    return None
+
+
+def execute(windows, src, processes=4, block_size=1 << 20, queue_size=4, poll=1.):
+    """planner.execute() on processes worker processes
+
+    Queue operations time out every poll seconds to check the workers are
+    alive: a dead worker fails the run instead of hanging it.
+    """
+    import queue
+    import multiprocessing
+    from multiprocessing import resource_tracker
+    from multiprocessing.shared_memory import SharedMemory
+    from .planner import source
+
+    ctx = multiprocessing.get_context('fork')
+
+    formats = [source(src, w).format for w in windows]
+    for w, format in zip(windows, formats):
+        if w.steps() and format[0] != 'jobid':
+            raise ValueError('job steps can only be sharded with jobid as first sacct field')
+
+    # workers unlink the segments: they must share the parent tracker
+    resource_tracker.ensure_running()
+
+    tasks = [ctx.Queue(queue_size) for _ in range(processes)]
+    results = ctx.Queue()
+    procs = [ctx.Process(target=worker, args=(k, windows, formats, tasks[k], results))
+             for k in range(processes)]
+    for p in procs:
+        p.start()
+
+    def put(k, task):
+        while True:
+            try:
+                return tasks[k].put(task, timeout=poll)
+            except queue.Full:
+                error = died(procs)
+                if error is not None:
+                    raise error
+
+    sent = 0
+
+    def send(i, data):
+        nonlocal sent
+        shm = SharedMemory(create=True, size=len(data))
+        shm.buf[:len(data)] = data
+        try:
+            put(sent % processes, (i, shm.name, len(data)))
+        except BaseException:
+            shm.unlink()
+            raise
+        finally:
+            shm.close()
+        sent += 1
+
+    states = [None] * processes
+    errors = []
+    try:
+        for i, w in enumerate(windows):
+            s = source(src, w)
+            steps = w.steps()
+
+            tail = b''
+            for block in source_blocks(s, w, block_size):
+                block = tail + block
+                c = cut(block, steps)
+                tail = block[c:]
+                if c:
+                    send(i, block[:c])
+
+            if tail.strip():
+                send(i, tail if tail.endswith(b'\n') else tail + b'\n')
+
+        for k in range(processes):
+            put(k, None)
+
+        reported = set()
+        while len(reported) < processes:
+            try:
+                k, st, error = results.get(timeout=poll)
+            except queue.Empty:
+                error = died(procs, reported)
+                if error is not None:
+                    raise error
+                continue
+
+            reported.add(k)
+            states[k] = st
+            if error is not None:
+                errors.append(error)
+    except BaseException:
+        for p in procs:
+            p.terminate()
+        raise
+    finally:
+        for p in procs:
+            p.join()
+
+    if errors:
+        raise RuntimeError('aggregation worker failed:\n' + errors[0])
+
+    trees = grouping_trees(windows)
+    for worker_states in states:
+        for (plan, groupings), tree_states in zip(trees, worker_states):
+            others = plan.new(None, None)
+            for (g, _), st in zip(others, tree_states):
+                g.load(st)
+            merge_groupings(groupings, others)
+
+    return sent
@@ -1,3 +1,4 @@
+import io
 import re
 
 
@@ -82,20 +83,74 @@ def parse_node_sequence(s):
         for n in range(int(start), int(end) + 1)
     ]
 
-def parse_node_spec(s):
-    words = s.split(',')
+
+def split_node_spec(s):
+    """split a node spec on the commas outside brackets"""
+    words = []
+    depth = 0
+    start = 0
+    for i, c in enumerate(s):
+        if c == '[':
+            depth += 1
+        elif c == ']':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            words.append(s[start:i])
+            start = i + 1
+    words.append(s[start:])
+
+    return [w.strip() for w in words if w.strip()]
+
+
+_range_re = re.compile(r'^(.*?)\[([^\]]*)\](.*)$')
+_number_re = re.compile(r'^(.*?)(\d+)$')
+
+
+def node_ranges(word):
+    """compressed ranges (prefix, first, last, width) of a node spec word
+
+    n[001-004,010] gives ('n', 1, 4, 3) and ('n', 10, 10, 3). Names without
+    trailing number give (name, None, None, 0). Only the last bracket range
+    stays compressed: r[1-2]n[01-04] gives one range per r.
+    """
+    m = _range_re.match(word)
+    if m is None:
+        m = _number_re.match(word)
+        if m is None:
+            return [(word, None, None, 0)]
+        prefix, num = m.groups()
+        return [(prefix, int(num), int(num), len(num))]
+
+    prefix, slices, rest = m.groups()
 
     ret = []
+    for sl in slices.split(','):
+        first, _, last = sl.partition('-')
+        last = last or first
+        if rest:
+            # more brackets follow: expand this one
+            for n in range(int(first), int(last) + 1):
+                ret += node_ranges(prefix + nodenum_format(first).format(n) + rest)
+        else:
+            ret.append((prefix, int(first), int(last), len(first)))
+
+    return ret
+
 
-    for w in words:
-        if '[' not in w:
-            ret.append(w)
+def expand_ranges(ranges):
+    for prefix, first, last, width in ranges:
+        if first is None:
+            yield prefix
             continue
+        fmt = '{}{:0%dd}' % width
+        for n in range(first, last + 1):
+            yield fmt.format(prefix, n)
 
-        prefix, nums = parse_node_sequence(w)
 
-        for num in nums:
-            ret.append(prefix + num)
+def parse_node_spec(s):
+    ret = []
+    for w in split_node_spec(s):
+        ret += expand_ranges(node_ranges(w))
 
     return ret
 
@@ -105,8 +160,15 @@ def int_or_string(s):
     except ValueError:
         return s
 
+
+_property_re = re.compile(r'([^\s=]+)=("[^"]*"|\'[^\']*\'|\S*)')
+
+
 def parse_properties(s):
-    return {k: int_or_string(v) for k, v in [w.split('=', 1) for w in s]}
+    """Key=Value words (a list, or a string where quoted values may hold spaces)"""
+    if not isinstance(s, str):
+        s = ' '.join(s)
+    return {k: int_or_string(v.strip('"\'')) for k, v in _property_re.findall(s)}
 
 def parse_node_name(line):
     words = line.split()
@@ -130,41 +192,329 @@ def parse_partition_name(line):
 
     return name, properties
 
-def parse_slurm_conf(f):
-    node_dict = {}
-    partition_dict = {}
 
-    for l in f.readlines():
-        l = l.strip()
+class NodeTable(object):
+    """node name -> properties mapping keeping NodeName ranges compressed
+
+    Ranges are indexed by (prefix, number width) on first lookup, then
+    found by bisection: names are only expanded when iterating.
+    """
+    def __init__(self):
+        self.ranges = []  # (prefix, first, last, width, properties) in definition order
+        self.index = None
+
+    def add(self, ranges, properties):
+        for r in ranges:
+            self.ranges.append(r + (properties, ))
+        self.index = None
+
+    def build_index(self):
+        index = {}
+        for seq, (prefix, first, last, width, properties) in enumerate(self.ranges):
+            if first is None:
+                index[prefix] = properties
+            else:
+                index.setdefault((prefix, width), []).append((first, last, seq, properties))
+
+        for k, v in index.items():
+            if isinstance(k, tuple):
+                v.sort(key=lambda r: r[0])
+                # max last of the ranges up to each one, to stop looking back
+                maxlast = []
+                m = -1
+                for r in v:
+                    m = max(m, r[1])
+                    maxlast.append(m)
+                index[k] = ([r[0] for r in v], maxlast, v)
+
+        self.index = index
+        return index
+
+    def get(self, name, default=None):
+        import bisect
+
+        index = self.index if self.index is not None else self.build_index()
+
+        if name in index:
+            return index[name]
+
+        m = _number_re.match(name)
+        if m is not None:
+            prefix, num = m.groups()
+            k = (prefix, len(num))
+            if k in index:
+                firsts, maxlast, ranges = index[k]
+                n = int(num)
+                i = bisect.bisect_right(firsts, n)
+                # redefined nodes: the last definition holding n wins
+                found = None
+                while i > 0 and maxlast[i - 1] >= n:
+                    i -= 1
+                    first, last, seq, properties = ranges[i]
+                    if last >= n and (found is None or seq > found[0]):
+                        found = (seq, properties)
+                if found is not None:
+                    return found[1]
+
+        return default
+
+    def __getitem__(self, name):
+        properties = self.get(name, self)
+        if properties is self:
+            raise KeyError(name)
+        return properties
+
+    def __contains__(self, name):
+        return self.get(name, self) is not self
+
+    def __iter__(self):
+        seen = set()
+        for r in self.ranges:
+            for name in expand_ranges([r[:4]]):
+                if name not in seen:
+                    seen.add(name)
+                    yield name
+
+    def keys(self):
+        return [n for n in self]
+
+    def with_feature(self, feature):
+        """names of the nodes having feature in their Features"""
+        ret = []
+        for r in self.ranges:
+            if feature in str(r[4].get('Features', '')).split(','):
+                ret += [n for n in expand_ranges([r[:4]]) if self[n] is r[4]]
+        return ret
+
+    def items(self):
+        return [(n, self[n]) for n in self]
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class PartitionTable(object):
+    """partition name -> properties, parsed on first access
+
+    Partition Nodes are resolved against NodeSets and ALL, then expanded.
+    """
+    def __init__(self, nodes, nodesets):
+        self.nodes = nodes
+        self.nodesets = nodesets
+        self.raw = {}
+        self.parsed = {}
+
+    def add(self, name, properties):
+        self.raw[name] = properties
+        self.parsed.pop(name, None)
+
+    def __getitem__(self, name):
+        if name not in self.parsed:
+            properties = dict(self.raw[name])
+            if 'Nodes' in properties:
+                properties['Nodes'] = self.resolve(str(properties['Nodes']))
+            self.parsed[name] = properties
+        return self.parsed[name]
+
+    def resolve(self, spec):
+        ret = []
+        for w in split_node_spec(spec):
+            if w == 'ALL':
+                ret += self.nodes.keys()
+            elif w in self.nodesets:
+                ret += self.nodesets[w]
+            else:
+                ret += expand_ranges(node_ranges(w))
+        return ret
+
+    def get(self, name, default=None):
+        return self[name] if name in self.raw else default
+
+    def __contains__(self, name):
+        return name in self.raw
+
+    def __iter__(self):
+        return iter(self.raw)
+
+    def keys(self):
+        return list(self.raw)
+
+    def items(self):
+        return [(n, self[n]) for n in self.raw]
+
+    def __len__(self):
+        return len(self.raw)
+
+
+def conf_lines(f, path=None, opener=open):
+    """(key, value) of a slurm.conf stream, following Include directives
+
+    Include paths are relative to the including file directory and may be
+    glob patterns.
+    """
+    import glob
+    import os.path
+
+    path = path or getattr(f, 'name', None)
+    base = os.path.dirname(path) if isinstance(path, str) else '.'
+
+    for l in f:
         l = l.split('#', 1)[0].strip()
-        if not l: continue
-        key, value = [s.strip() for s in l.split('=', 1)]
+        if not l:
+            continue
+
+        if '=' not in l.split(None, 1)[0]:
+            words = l.split(None, 1)
+            if words[0].lower() == 'include' and len(words) > 1:
+                pattern = os.path.join(base, words[1].strip())
+                for include in sorted(glob.glob(pattern)):
+                    with opener(include) as inc:
+                        for kv in conf_lines(inc, include, opener):
+                            yield kv
+            continue
+
+        key, value = l.split('=', 1)
+        yield key.strip(), value.strip()
+
+
+def parse_slurm_conf(f):
+    nodes = NodeTable()
+    nodesets = {}
+    partitions = PartitionTable(nodes, nodesets)
+    node_defaults = {}
+    partition_defaults = {}
+
+    for key, value in conf_lines(f):
+        key = key.lower()
 
-        if key not in ['NodeName', 'PartitionName']: continue
+        if key == 'nodename':
+            spec, _, properties = value.partition(' ')
+            properties = parse_properties(properties)
 
-        if key == 'NodeName':
-            nodes, properties = parse_node_name(value)
-            # print(key, nodes, properties)
+            if spec == 'DEFAULT':
+                node_defaults.update(properties)
+                continue
 
-            for node in nodes:
-                node_dict[node] = properties
+            if node_defaults:
+                properties = dict(node_defaults, **properties)
 
-        elif key == 'PartitionName':
-            # print(value)
-            partition, properties = parse_partition_name(value)
-            #print(key, partition, properties)
+            ranges = []
+            for w in split_node_spec(spec):
+                ranges += node_ranges(w)
+            # nodes of a line share their properties
+            nodes.add(ranges, properties)
 
-            partition_dict[partition] = properties
+        elif key == 'partitionname':
+            name, _, properties = value.partition(' ')
+            properties = parse_properties(properties)
 
-    return {'nodes': node_dict, 'partitions': partition_dict}
+            if name == 'DEFAULT':
+                partition_defaults.update(properties)
+                continue
+
+            partitions.add(name, dict(partition_defaults, **properties))
+
+        elif key == 'nodeset':
+            name, _, properties = value.partition(' ')
+            properties = parse_properties(properties)
+
+            members = []
+            if 'Nodes' in properties:
+                members += partitions.resolve(str(properties['Nodes']))
+            if 'Feature' in properties:
+                members += nodes.with_feature(properties['Feature'])
+            nodesets[name] = members
+
+    return {'nodes': nodes, 'partitions': partitions}
+
+
+def slurm_conf_digest(path):
+    """sha256 of slurm.conf and the files it includes"""
+    import hashlib
+
+    h = hashlib.sha256()
+
+    def opener(p):
+        with open(p, 'rb') as f:
+            data = f.read()
+        h.update(data)
+        return io.StringIO(data.decode())
+
+    with opener(path) as f:
+        for _ in conf_lines(f, path, opener):
+            pass
+
+    return h.hexdigest()
 
 def nodes_procs(nodes, node_dict):
     procs = 0
     for n in nodes:
-        procs += node_dict[n]['Procs']
+        procs += node_procs(node_dict[n])
 
     return procs
 
+def node_gpus(properties):
+    """number of gpus from a Gres=gpu:4 or Gres=gpu:a100:2(S:0-1),mps:100 property"""
+    gpus = 0
+    for g in str(properties.get('Gres', '')).split(','):
+        words = g.split('(', 1)[0].split(':')
+        if words[0] != 'gpu' or len(words) < 2:
+            continue
+        try:
+            gpus += int(words[-1])
+        except ValueError:
+            gpus += 1
+
+    return gpus
+
+
+def parse_billing_weights(s):
+    """TRESBillingWeights=CPU=1.0,Mem=0.25G,GRES/gpu=2.0 as {tres: weight per unit}
+
+    Memory weights are per MB unless suffixed (K, M, G, T).
+    """
+    scale = {'K': 1. / 1024, 'M': 1., 'G': 1024., 'T': 1024. * 1024}
+    weights = {}
+    for w in s.split(','):
+        if '=' not in w:
+            continue
+        k, v = w.split('=', 1)
+        k = k.strip().lower()
+        unit = 1.
+        if v[-1:].upper() in scale:
+            unit = scale[v[-1].upper()]
+            v = v[:-1]
+        weights[k] = float(v) / unit if k == 'mem' else float(v)
+
+    return weights
+
+
+def node_procs(properties):
+    return properties.get('Procs', properties.get('CPUs', 0))
+
+
+def nodes_tres(nodes, node_dict, billing_weights=None):
+    """capacity of nodes as {'cpu', 'mem' (MB), 'gpu', 'billing'}"""
+    ret = {'cpu': 0, 'mem': 0, 'gpu': 0, 'billing': 0.}
+    for n in nodes:
+        properties = node_dict[n]
+        cpus = node_procs(properties)
+        mem = properties.get('RealMemory', 0)
+        gpus = node_gpus(properties)
+
+        ret['cpu'] += cpus
+        ret['mem'] += mem
+        ret['gpu'] += gpus
+        if billing_weights:
+            ret['billing'] += (billing_weights.get('cpu', 0.) * cpus
+                               + billing_weights.get('mem', 0.) * mem
+                               + billing_weights.get('gres/gpu', 0.) * gpus)
+        else:
+            ret['billing'] += cpus
+
+    return ret
+
+
 def partition_nodes(partition):
     return {n for n in partition['Nodes']}
 
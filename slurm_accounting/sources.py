@@ -0,0 +1,409 @@
+"""Job sources: where reports read their jobs from.
+
+    [general]                   ; or [cluster:NAME]
+    source = sacct                                  ; default: live sacct queries
+    source = dump:/data/sacct-2022-*.txt.gz         ; sacct --parsable2 dumps
+    source = archive:/var/lib/sreporting/archive    ; local job archive
+    source = mysqldump:/backup/slurm_acct_db.sql.xz ; slurmdbd database dump
+
+Every source answers Sacct queries (format, __call__(), batches()), so
+reports, the planner, periodic reports and the daemon run unchanged on
+captured data, on any machine. Dumps are plain, .gz, .bz2 or .xz files read
+as streams; they may start with the sacct header line (jobid|user|...),
+otherwise their fields are Sacct.default_format. Dump queries select jobs
+overlapping the query window like sacct does.
+
+mysqldump sources read the <cluster>_job_table rows of a slurmdbd dump
+(uids and gids are resolved through [general] passwd/group, see symbols).
+Job steps, totalcpu and maxrss are not available from them.
+
+Sources over files have a generation(): periodic reports outputs are
+fingerprinted with it instead of the query date.
+"""
+
+import re
+import sys
+import glob
+
+from .sreport import JobBatch, Sacct, fold_steps, split_blocks
+from .symbols import intern_columns
+
+ROWS = 65536
+
+
+def open_dump(path):
+    """binary stream of a plain or compressed file"""
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.open(path, 'rb')
+    if path.endswith('.bz2'):
+        import bz2
+        return bz2.open(path, 'rb')
+    if path.endswith('.xz'):
+        import lzma
+        return lzma.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def sacct_time(s):
+    """query bound as a sacct timestamp, comparable as a string"""
+    if s is None:
+        return None
+    if 'T' not in s:
+        s += 'T00:00:00'
+    return s + ':00' if s.count(':') == 1 else s
+
+
+def files_generation(paths):
+    import os
+    import hashlib
+
+    h = hashlib.sha256()
+    for p in paths:
+        st = os.stat(p)
+        h.update('{}|{}|{}\n'.format(p, st.st_size, st.st_mtime_ns).encode())
+    return h.hexdigest()[:16]
+
+
+class FileSource(object):
+    """Sacct query interface over rows read from files
+
+    Subclasses yield JobBatch objects of all their fields (dump_format) from
+    raw_batches(); queries filter and project them.
+    """
+    # query features the files lack
+    unavailable = ()
+
+    def __init__(self, paths, format=None):
+        self.paths = paths
+        self.format = tuple(format or Sacct.default_format)
+        # {node spec: {nodelist: overlaps}}, kept between queries
+        self.node_matches = {}
+
+    def raw_batches(self):
+        raise NotImplementedError
+
+    def generation(self):
+        return files_generation(self.paths)
+
+    def check(self, fields, steps):
+        missing = set(fields) - set(self.dump_format)
+        if missing or (steps and 'steps' in self.unavailable):
+            raise ValueError('%s has no %s' % (self, ', '.join(sorted(missing) or ['job steps'])))
+
+    def batches(self, start=None, end=None, partition=None, nodes=None, states=[],
+                other_args=[], columns=None, block_size=None, steps=False):
+        """Sacct.batches() compatible query"""
+        batches = self.select(start, end, partition, nodes, states, columns, steps)
+        return fold_steps(batches) if steps else batches
+
+    def select(self, start=None, end=None, partition=None, nodes=None, states=[], columns=None,
+               steps=False):
+        """batches of the rows selected by a query, job steps not folded
+
+        Without steps, step rows of dumps made without sacct -X are dropped:
+        every query sees one row per job.
+        """
+        from .slurm_config import parse_node_spec
+
+        self.check(self.format, steps)
+
+        columns = list(columns or self.format)
+        start, end = sacct_time(start), sacct_time(end)
+        selected_nodes = set(parse_node_spec(nodes)) if nodes else None
+        node_match = self.node_matches.setdefault(nodes, {})
+
+        def query():
+            # step rows (jobid.step) follow their job row: they are selected
+            # with it, whatever their own fields (no partition...)
+            parent = None
+            for batch in self.raw_batches():
+                keep = []
+                for i, (jobid, s, e, state) in enumerate(zip(batch['jobid'], batch['start'],
+                                                             batch['end'], batch['state'])):
+                    if '.' in jobid:
+                        if steps and jobid.split('.', 1)[0] == parent:
+                            keep.append(i)
+                        continue
+                    parent = None
+                    if s in ('Unknown', 'None', ''):
+                        # never started
+                        if states:
+                            continue
+                    elif end is not None and s > end:
+                        continue
+                    if start is not None and e not in ('Unknown', '') and e < start:
+                        continue
+                    if states and 'RUNNING' not in states and state.split(' ')[0] not in states:
+                        continue
+                    if partition is not None and batch['partition'][i] != partition:
+                        continue
+                    if selected_nodes is not None:
+                        nodelist = batch['nodelist'][i]
+                        if nodelist not in node_match:
+                            node_match[nodelist] = bool(selected_nodes.intersection(
+                                parse_node_spec(nodelist) if nodelist not in ('', 'None assigned')
+                                else ()
+                            ))
+                        if not node_match[nodelist]:
+                            continue
+                    keep.append(i)
+                    parent = jobid
+
+                if keep:
+                    yield JobBatch({c: [batch[c][i] for i in keep] for c in columns}, len(keep))
+
+        return query()
+
+    def __call__(self, start=None, end=None, partition=None, nodes=None, states=[], other_args=[]):
+        for batch in self.batches(start=start, end=end, partition=partition, nodes=nodes,
+                                  states=states):
+            for r in batch.rows():
+                yield r
+
+
+class DumpSacct(FileSource):
+    """sacct --parsable2 dump files"""
+    def __init__(self, pattern, format=None):
+        paths = sorted(glob.glob(pattern))
+        if not paths:
+            raise ValueError('no sacct dump matches \'%s\'' % pattern)
+
+        super(DumpSacct, self).__init__(paths, format)
+
+        with open_dump(paths[0]) as f:
+            first = f.readline()
+        self.dump_format = self.header(first) or Sacct.default_format
+        if first.strip() and first.count(b'|') != len(self.dump_format) - 1:
+            # split_blocks() would drop every line
+            raise ValueError('%s: %d fields, expected %d (%s): add the sacct header line' % (
+                paths[0], first.count(b'|') + 1, len(self.dump_format),
+                '|'.join(self.dump_format)))
+
+    def __str__(self):
+        return 'sacct dump {}'.format(','.join(self.paths))
+
+    @staticmethod
+    def header(line):
+        """fields of a sacct header line, or None"""
+        fields = line.decode().strip().lower().split('|')
+        if fields[0] == 'jobid':
+            return tuple(fields)
+        return None
+
+    def raw_batches(self, block_size=1 << 20):
+        for path in self.paths:
+            with open_dump(path) as f:
+                first = f.readline()
+                format = self.header(first) or Sacct.default_format
+                if format != self.dump_format:
+                    raise ValueError('%s fields differ from %s ones' % (path, self.paths[0]))
+
+                lines = [0]
+
+                def blocks():
+                    if self.header(first) is None:
+                        lines[0] += 1
+                        yield first
+                    for block in iter(lambda: f.read(block_size), b''):
+                        lines[0] += block.count(b'\n')
+                        yield block
+
+                rows = 0
+                for batch in split_blocks(blocks(), format):
+                    rows += len(batch)
+                    yield batch
+
+                if rows < lines[0]:
+                    print('warning,{}: skipped {} lines without {} fields'.format(
+                        path, lines[0] - rows, len(format)), file=sys.stderr)
+
+
+# slurmdbd job states (job_state & JOB_STATE_BASE)
+JOB_STATES = ('PENDING', 'RUNNING', 'SUSPENDED', 'COMPLETED', 'CANCELLED', 'FAILED', 'TIMEOUT',
+              'NODE_FAIL', 'PREEMPTED', 'BOOT_FAIL', 'DEADLINE', 'OUT_OF_MEMORY')
+
+# slurmdbd static TRES ids, gres ones come from tres_table
+TRES_NAMES = {'1': 'cpu', '2': 'mem', '3': 'energy', '4': 'node', '5': 'billing'}
+
+_value_re = re.compile(r"\s*(?:'((?:[^'\\]|\\.|'')*)'|(NULL)|([^,()'\s]+))\s*([,)])")
+_unescape_re = re.compile(r"\\(.)|''")
+_escapes = {'n': '\n', 't': '\t', 'r': '\r', '0': '\0', None: "'"}
+
+
+def sql_tuples(s, pos=0):
+    """value tuples of an INSERT ... VALUES (...),(...); statement from pos"""
+    while True:
+        pos = s.find('(', pos)
+        if pos < 0:
+            return
+        pos += 1
+
+        values = []
+        while True:
+            m = _value_re.match(s, pos)
+            if m is None:
+                raise ValueError('unparsable SQL values at %r' % s[pos:pos + 40])
+            quoted, null, bare, sep = m.groups()
+            if quoted is not None:
+                values.append(_unescape_re.sub(lambda e: _escapes.get(e.group(1), e.group(1)),
+                                               quoted))
+            else:
+                values.append(None if null else bare)
+            pos = m.end()
+            if sep == ')':
+                break
+
+        yield values
+
+
+class MysqlDumpSacct(FileSource):
+    """job table of a slurmdbd database dump (mysqldump)"""
+    dump_format = ('jobid', 'user', 'elapsed', 'ncpus', 'partition', 'nodelist', 'group', 'start',
+                   'end', 'state', 'account', 'alloctres', 'elapsedraw')
+    unavailable = ('steps', )
+
+    _create_re = re.compile(r'^CREATE TABLE `(\w+)`')
+    _column_re = re.compile(r'^\s+`(\w+)`')
+    _insert_re = re.compile(r'^INSERT INTO `(\w+)`\s*(?:\(([^)]*)\))?\s*VALUES')
+
+    def __init__(self, path, format=None, cluster=None):
+        super(MysqlDumpSacct, self).__init__([path], format)
+        self.path = path
+        self.cluster = cluster
+        self.tres = None
+
+    def __str__(self):
+        return 'slurmdbd dump {}'.format(self.path)
+
+    def statements(self, tables):
+        """(table, columns, line, values offset) of the INSERT lines of tables"""
+        columns = {}
+        current = None
+        with open_dump(self.path) as f:
+            for line in f:
+                line = line.decode('utf-8', 'replace')
+                if current is not None:
+                    m = self._column_re.match(line)
+                    if m:
+                        columns[current].append(m.group(1))
+                        continue
+                    current = None
+
+                m = self._create_re.match(line)
+                if m:
+                    current = m.group(1)
+                    columns[current] = []
+                    continue
+
+                m = self._insert_re.match(line)
+                if m and tables(m.group(1)):
+                    cols = m.group(2)
+                    cols = [c.strip(' `') for c in cols.split(',')] if cols else \
+                        columns.get(m.group(1))
+                    if cols is None:
+                        raise ValueError('%s: no CREATE TABLE for %s' % (self.path, m.group(1)))
+                    yield m.group(1), cols, line, m.end()
+
+    def job_table(self, table):
+        if self.cluster is not None:
+            return table == self.cluster + '_job_table'
+        return table.endswith('_job_table')
+
+    def tres_names(self):
+        """{TRES id: name} of the dump tres_table"""
+        if self.tres is None:
+            self.tres = dict(TRES_NAMES)
+            for _, cols, line, pos in self.statements(lambda t: t == 'tres_table'):
+                for values in sql_tuples(line, pos):
+                    r = dict(zip(cols, values))
+                    if r.get('type') == 'gres':
+                        self.tres[r['id']] = 'gres/' + r['name']
+        return self.tres
+
+    def raw_batches(self):
+        from .archive import print_elapsed
+        from .spans import calendar
+
+        local = calendar().local
+        tres = self.tres_names() if 'alloctres' in self.format else {}
+        now = None
+
+        out = {f: [] for f in self.dump_format}
+        tables = set()
+        for table, cols, line, pos in self.statements(self.job_table):
+            tables.add(table)
+            if len(tables) > 1:
+                raise ValueError('%s holds several clusters, set the cluster of the source' %
+                                 self.path)
+
+            for values in sql_tuples(line, pos):
+                r = dict(zip(cols, values))
+
+                if r.get('id_array_job') not in (None, '0'):
+                    jobid = '%s_%s' % (r['id_array_job'], r['id_array_task'])
+                else:
+                    jobid = r['id_job']
+
+                alloc = dict(w.split('=', 1) for w in (r.get('tres_alloc') or '').split(',')
+                             if '=' in w)
+
+                start = int(r['time_start'] or 0)
+                end = int(r['time_end'] or 0)
+                if start and not end:
+                    if now is None:
+                        import time
+                        now = int(time.time())
+                    elapsed = now - start
+                else:
+                    elapsed = max(0, end - start) if start else 0
+
+                out['jobid'].append(jobid)
+                out['user'].append(r['id_user'])
+                out['group'].append(r['id_group'])
+                out['account'].append(r.get('account') or '')
+                out['partition'].append(r.get('partition') or '')
+                out['nodelist'].append(r.get('nodelist') or '')
+                out['ncpus'].append(alloc.get('1') or r.get('cpus_req') or '0')
+                out['start'].append(local(start) if start else 'Unknown')
+                out['end'].append(local(end) if end else 'Unknown')
+                out['state'].append(JOB_STATES[int(r['state']) & 0xff]
+                                    if int(r['state']) & 0xff < len(JOB_STATES) else 'UNKNOWN')
+                out['elapsedraw'].append(str(elapsed))
+                out['elapsed'].append(print_elapsed(elapsed))
+                out['alloctres'].append(','.join(
+                    '%s=%s' % (tres[k], v + 'M' if k == '2' else v)
+                    for k, v in sorted(alloc.items(), key=lambda kv: int(kv[0])) if k in tres
+                ))
+
+                if len(out['jobid']) == ROWS:
+                    yield JobBatch(intern_columns(out), ROWS)
+                    out = {f: [] for f in self.dump_format}
+
+        if out['jobid']:
+            yield JobBatch(intern_columns(out), len(out['jobid']))
+
+
+def make_source(spec, format=None, cluster=None):
+    """job source of a 'source' option value"""
+    kind, _, arg = spec.partition(':')
+
+    if kind == 'dump':
+        return DumpSacct(arg, format)
+    if kind == 'archive':
+        from .archive import Archive, ArchiveSacct
+        return ArchiveSacct(Archive(arg), format)
+    if kind == 'mysqldump':
+        return MysqlDumpSacct(arg, format, cluster)
+
+    raise ValueError('unknown job source \'%s\' (sacct, dump:, archive:, mysqldump:)' % spec)
+
+
+def source_generation(cfg, cluster=None):
+    """generation of the jobs data of a configured file source, None for sacct"""
+    from .sreport import cluster_get
+
+    spec = cluster_get(cfg, cluster, 'source', 'sacct')
+    if spec == 'sacct':
+        return None
+    return make_source(spec, cluster=cluster).generation()
@@ -0,0 +1,191 @@
+"""Calendar spans of the span groupings: days, weeks, months, quarters, years.
+
+sacct prints naive local times. A Calendar turns them into epoch seconds
+with a table of the UTC offset changes (DST transitions) of its timezone,
+and keeps the epoch seconds of span boundaries in sorted tables: the spans
+a job overlaps are found by binary search, and span lengths are the true
+ones (23 or 25 hour days on DST changes). Tables cover the years seen so
+far and grow on demand.
+
+The timezone is the local time of the host, or a zoneinfo name (Python >=
+3.9, or the backports.zoneinfo package):
+
+    [general]
+    timezone = Europe/Paris
+"""
+
+import bisect
+import datetime
+import time
+
+UNITS = ('daily', 'weekly', 'monthly', 'quarterly', 'yearly')
+
+DAY = 86400
+
+_epoch = datetime.datetime(1970, 1, 1)
+
+
+def span_starts(unit, first, last):
+    """dates starting the spans of unit over years first to last, and the next one"""
+    d = datetime.date(first, 1, 1)
+    end = datetime.date(last + 1, 1, 1)
+
+    if unit == 'daily':
+        step = datetime.timedelta(days=1)
+    elif unit == 'weekly':
+        # ISO weeks, from monday
+        d -= datetime.timedelta(days=d.weekday())
+        step = datetime.timedelta(days=7)
+    elif unit in ('monthly', 'quarterly', 'yearly'):
+        months = {'monthly': 1, 'quarterly': 3, 'yearly': 12}[unit]
+        ret = []
+        while True:
+            ret.append(d)
+            if d >= end:
+                return ret
+            m = d.month - 1 + months
+            d = datetime.date(d.year + m // 12, m % 12 + 1, 1)
+    else:
+        raise ValueError('unknown span \'%s\' (%s)' % (unit, ', '.join(UNITS)))
+
+    ret = []
+    while True:
+        ret.append(d)
+        if d >= end:
+            return ret
+        d += step
+
+
+def zoneinfo(name):
+    try:
+        from zoneinfo import ZoneInfo
+    except ImportError:
+        from backports.zoneinfo import ZoneInfo
+
+    return ZoneInfo(name)
+
+
+class Calendar(object):
+    def __init__(self, timezone=None):
+        self.timezone = timezone
+        self.tz = zoneinfo(timezone) if timezone else None
+
+        # tabulated years, as naive seconds
+        self.years = None
+        self.lo = self.hi = 0
+        # naive seconds from which offsets[i + 1] applies, offsets[0] before
+        self.changes = []
+        self.offsets = [0]
+        # unit: (boundaries epoch seconds, span start dates 'YYYY-MM-DD')
+        self.tables = {}
+
+    def offset(self, epoch):
+        """UTC offset (seconds) at epoch"""
+        if self.tz is None:
+            return time.localtime(epoch).tm_gmtoff
+        return int(datetime.datetime.fromtimestamp(epoch, self.tz).utcoffset().total_seconds())
+
+    def cover(self, year):
+        """extend the tables to year"""
+        first, last = (year, year) if self.years is None else \
+            (min(year, self.years[0]), max(year, self.years[1]))
+
+        lo = int((datetime.datetime(first, 1, 1) - _epoch).total_seconds())
+        hi = int((datetime.datetime(last + 1, 1, 1) - _epoch).total_seconds())
+
+        # one probe a day, offset changes located to the second; the margin
+        # covers the weeks straddling new year
+        changes = []
+        t = lo - 8 * DAY
+        offsets = [self.offset(t)]
+        while t < hi + 8 * DAY:
+            o = self.offset(t + DAY)
+            if o != offsets[-1]:
+                a, b = t, t + DAY
+                while b - a > 1:
+                    m = (a + b) // 2
+                    if self.offset(m) == offsets[-1]:
+                        a = m
+                    else:
+                        b = m
+                # wall clock of the change on the old offset: ambiguous
+                # times after a backward change are their first occurrence
+                changes.append(b + offsets[-1])
+                offsets.append(o)
+            t += DAY
+
+        self.years = (first, last)
+        self.lo, self.hi = lo, hi
+        self.changes, self.offsets = changes, offsets
+        self.tables = {}
+
+    def naive(self, s):
+        """naive seconds of a sacct 'YYYY-MM-DDTHH:MM:SS' time"""
+        return (datetime.datetime.fromisoformat(s) - _epoch).total_seconds()
+
+    def local_epoch(self, n):
+        if not self.lo <= n < self.hi:
+            self.cover(int(_epoch.year + n // (365.2425 * DAY)))
+            if not self.lo <= n < self.hi:
+                # year estimate off by one near new year
+                self.cover(self.years[0] - 1 if n < self.lo else self.years[1] + 1)
+
+        return self.to_epoch(n)
+
+    def to_epoch(self, n):
+        if not self.changes:
+            return n - self.offsets[0]
+        return n - self.offsets[bisect.bisect_right(self.changes, n)]
+
+    def epoch(self, s):
+        """epoch seconds of a sacct local time"""
+        return self.local_epoch(self.naive(s))
+
+    def local(self, epoch):
+        """sacct local time of epoch seconds"""
+        return (_epoch + datetime.timedelta(seconds=epoch + self.offset(epoch))).isoformat()
+
+    def elapsed(self, s, e):
+        """true seconds between two sacct local times"""
+        return self.epoch(e) - self.epoch(s)
+
+    def table(self, unit):
+        """(epoch seconds, 'YYYY-MM-DD') of the span starts of unit"""
+        if unit not in self.tables:
+            dates = span_starts(unit, *self.years)
+            self.tables[unit] = (
+                [self.to_epoch(int((datetime.datetime(d.year, d.month, d.day) - _epoch)
+                                      .total_seconds())) for d in dates],
+                [d.isoformat() for d in dates],
+            )
+        return self.tables[unit]
+
+    def spans(self, unit, start, end):
+        """[(key, span start, span end)] epochs of the spans overlapping [start, end]"""
+        # cover both ends before reading tables
+        self.local_epoch(start + self.offset(start))
+        self.local_epoch(end + self.offset(end))
+
+        bounds, keys = self.table(unit)
+        i = max(0, bisect.bisect_right(bounds, start) - 1)
+        ret = []
+        while i < len(keys) - 1 and bounds[i] <= end:
+            ret.append((keys[i], bounds[i], bounds[i + 1]))
+            i += 1
+        return ret
+
+
+CALENDAR = Calendar()
+
+
+def configure(cfg):
+    """use the [general] timezone"""
+    global CALENDAR
+
+    timezone = cfg.get('general', 'timezone', '') or None
+    if timezone != CALENDAR.timezone:
+        CALENDAR = Calendar(timezone)
+
+
+def calendar():
+    return CALENDAR
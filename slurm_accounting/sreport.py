@@ -1,13 +1,19 @@
-import subprocess
+# keep module import cheap: the CLIs run from cron and monitoring probes, so
+# subprocess, tempfile, configparser and argparse are imported where needed
 import os
 import re
-import tempfile
+import bisect
 import datetime
-import argparse
+from array import array
+from itertools import repeat
 
-from . import config
-
-from .slurm_config import parse_slurm_conf, node_spec_from_list, nodes_procs, parse_node_spec, partition_nodes
+from . import spans, symbols
+from .spans import calendar
+from .symbols import intern_columns, intern_row
+from .slurm_config import (
+    parse_slurm_conf, node_spec_from_list, nodes_procs, parse_node_spec, partition_nodes,
+    nodes_tres, parse_billing_weights
+)
 
 class Command(object):
     def __init__(self, cmd, opts=[], output_filter=lambda e: e, verbose=False, remote_host=None):
@@ -17,7 +23,11 @@ class Command(object):
         self.output_filter = output_filter
         self.remote_host = remote_host
 
-    def __call__(self, cmdline=[]):
+    def _execute(self, cmdline):
+        """run the command, yield its (rewound) output file once"""
+        import subprocess
+        import tempfile
+
         cmdlist = [self.cmd] + self.opts + cmdline
 
         if self.remote_host is not None:
@@ -37,28 +47,42 @@ class Command(object):
 
             stdout.seek(0)
 
+            yield stdout
+
+    def __call__(self, cmdline=[]):
+        for stdout in self._execute(cmdline):
             for l in stdout:
                 yield self.output_filter(l.decode())
 
+    def blocks(self, cmdline=[], block_size=1 << 20):
+        """raw output in blocks of about block_size bytes"""
+        for stdout in self._execute(cmdline):
+            while True:
+                block = stdout.read(block_size)
+                if not block:
+                    break
+                yield block
+
 class SreportCluster(Command):
     @classmethod
     def filter(cls, e):
         return e.strip().split('|')
 
     def __init__(self, include_header=True, skip_groups=False, skip_users=False, verbose=False,
-                 remote_host=None):
-        super(SreportCluster, self).__init__('sreport', ['-n', '-P', '-t', 'Hour', 'cluster',
-                                                        'AccountUtilizationByUser',
-                                                        'format=account%30,login%30,used%30'],
+                 remote_host=None, command='sreport', extra_args=[]):
+        super(SreportCluster, self).__init__(command, ['-n', '-P', '-t', 'Hour', 'cluster',
+                                                      'AccountUtilizationByUser',
+                                                      'format=account%30,login%30,used%30'],
                                              SreportCluster.filter, verbose=verbose,
                                              remote_host=remote_host)
 
         self.include_header = include_header
         self.skip_groups = skip_groups
         self.skip_users = skip_users
+        self.extra_args = extra_args
 
     def __call__(self, start=None, end=None):
-        cmdline = []
+        cmdline = list(self.extra_args)
         if start is not None:
             cmdline.append('Start=%s' % start)
 
@@ -83,36 +107,215 @@ class SreportCluster(Command):
 
             yield r
 
+    def periods(self, periods, workers=4):
+        """(start, end, rows) of each (start, end) period, in order
+
+        Periods are queried concurrently by at most workers sreport
+        processes; each is yielded as soon as it and the previous ones are
+        done.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        include_header, self.include_header = self.include_header, False
+
+        def query(period):
+            return list(self(*period))
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                for (start, end), rows in zip(periods, pool.map(query, periods)):
+                    yield start, end, rows
+        finally:
+            self.include_header = include_header
+
+class JobBatch(object):
+    """A batch of sacct rows stored as one list per column"""
+    def __init__(self, columns, size):
+        self.columns = columns
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def take(self, indices, **replace):
+        """sub-batch of rows at indices, with some columns replaced"""
+        columns = dict(replace)
+        for k, v in self.columns.items():
+            if k not in columns:
+                columns[k] = [v[i] for i in indices]
+
+        return JobBatch(columns, len(indices))
+
+    def rows(self):
+        """per row dicts, as yielded by Sacct.__call__"""
+        names = list(self.columns)
+        for values in zip(*[self.columns[n] for n in names]):
+            yield dict(zip(names, values))
+
+
+def split_blocks(blocks, format, columns=None):
+    """turn raw --parsable2 output blocks into JobBatch objects
+
+    Each block is decoded and split at once; only the requested columns
+    are kept, user/group/account... values interned (see symbols).
+    """
+    names = columns or format
+    indices = [format.index(n) for n in names]
+    width = len(format)
+
+    def batch(data):
+        text = data.decode()
+        nrows = text.count('\n')
+        # every line must have its width fields: a total count would let
+        # missing and extra separators of malformed lines cancel out
+        counts = set(map(str.count, text.split('\n')[:-1], repeat('|')))
+        if counts == {width - 1}:
+            # one split for the whole block, columns are then strided slices
+            cells = text.replace('\n', '|').split('|')
+            return JobBatch(intern_columns({n: cells[i:-1:width] for n, i in zip(names, indices)}),
+                            nrows)
+
+        # malformed lines (e.g. messages on stderr): split line by line
+        rows = [l.split('|') for l in text.split('\n')]
+        rows = [r for r in rows if len(r) == width]
+        if not rows:
+            return None
+        transposed = list(zip(*rows))
+        return JobBatch(intern_columns({n: list(transposed[i]) for n, i in zip(names, indices)}),
+                        len(rows))
+
+    tail = b''
+    for block in blocks:
+        block = tail + block
+        cut = block.rfind(b'\n') + 1
+        tail = block[cut:]
+
+        b = cut and batch(block[:cut])
+        if b:
+            yield b
+
+    b = tail.strip() and batch(tail.strip() + b'\n')
+    if b:
+        yield b
+
+
+def parse_totalcpu(s):
+    """sacct TotalCPU ([DD-[HH:]]MM:SS[.mmm]) in seconds"""
+    if not s:
+        return 0.
+    days = 0
+    if '-' in s:
+        days, s = s.split('-', 1)
+        days = int(days)
+    seconds = 0.
+    for w in s.split(':'):
+        seconds = seconds * 60 + float(w)
+    return days * 86400 + seconds
+
+
+def fold_steps(batches, window=256):
+    """fold job step rows (jobid.step) into their job allocation row
+
+    Yields batches of allocation rows only, with totalcpu (seconds) summed
+    and maxrss (MB) maximized over steps. sacct lists steps right after
+    their job, so only the last few jobs are kept pending: memory stays
+    bounded by window whatever the number of rows.
+    """
+    pending = {}
+    names = None
+
+    def flush(jobid, out):
+        values, cpu, rss, has_steps = pending.pop(jobid)
+        row = dict(zip(names, values))
+        if 'totalcpu' in row:
+            row['totalcpu'] = cpu if has_steps else parse_totalcpu(row['totalcpu'])
+        if 'maxrss' in row:
+            row['maxrss'] = rss
+        for n in names:
+            out[n].append(row[n])
+
+    for batch in batches:
+        names = list(batch.columns)
+        out = {n: [] for n in names}
+        columns = [batch[n] for n in names]
+        jobids = batch['jobid']
+        totalcpu = batch.columns.get('totalcpu', [''] * len(batch))
+        maxrss = batch.columns.get('maxrss', [''] * len(batch))
+
+        for i, jobid in enumerate(jobids):
+            if '.' not in jobid:
+                pending[jobid] = [[c[i] for c in columns], 0., 0., False]
+                if len(pending) > window:
+                    flush(next(iter(pending)), out)
+                continue
+
+            state = pending.get(jobid.split('.', 1)[0])
+            if state is None:
+                # step of an unknown (filtered out or already flushed) job
+                continue
+            state[1] += parse_totalcpu(totalcpu[i])
+            state[2] = max(state[2], parse_mem_mb(maxrss[i]))
+            state[3] = True
+
+        size = len(out[names[0]])
+        if size:
+            yield JobBatch(out, size)
+
+    if pending:
+        out = {n: [] for n in names}
+        for jobid in list(pending):
+            flush(jobid, out)
+        yield JobBatch(out, len(out[names[0]]))
+
+
 class Sacct(Command):
+    default_format = (
+        'jobid',
+        'user',
+        'elapsed',
+        'ncpus',
+        'partition',
+        'nodelist',
+        'group',
+        'start',
+        'end',
+        'state',
+    )
+
+    # optional fields, only fetched when a report needs them
+    extra_format = (
+        'alloctres',
+        'elapsedraw',
+        'totalcpu',
+        'maxrss',
+    )
+
     @classmethod
     def filter(cls, e):
         return e.strip().split('|')
 
     def __init__(self, format=None, extra_options=[], verbose=False,
-                 remote_host=None):
-
-        self.format = format or (
-            'jobid',
-            'user',
-            'elapsed',
-            'ncpus',
-            'partition',
-            'nodelist',
-            'group',
-            'start',
-            'end',
-            'state',
-        )
+                 remote_host=None, command='sacct'):
+
+        self.format = tuple(format or self.default_format)
 
         super(Sacct, self).__init__(
-            'sacct',
-            ['-a', '--parsable2', '--noheader', '-X',
+            command,
+            ['-a', '--parsable2', '--noheader',
              '--format=%s' % ','.join(self.format)] + extra_options,
             Sacct.filter, verbose=verbose,
             remote_host=remote_host)
 
-    def __call__(self, start=None, end=None, partition=None, nodes=None, states=[], other_args=[]):
+    def cmdline(self, start=None, end=None, partition=None, nodes=None, states=[], other_args=[],
+                steps=False):
         cmdline = []
+        if not steps:
+            # job allocations only
+            cmdline.append('-X')
+
         if start is not None:
             cmdline.append('--starttime=%s' % start)
 
@@ -130,13 +333,40 @@ class Sacct(Command):
 
         cmdline += other_args
 
-        super_call = super(Sacct, self).__call__(cmdline)
+        return cmdline
+
+    def __call__(self, start=None, end=None, partition=None, nodes=None, states=[], other_args=[]):
+        super_call = super(Sacct, self).__call__(
+            self.cmdline(start, end, partition, nodes, states, other_args)
+        )
 
         for r in super_call:
             if r is None:
                 continue
 
-            yield dict(list(zip(self.format, r)))
+            yield intern_row(dict(list(zip(self.format, r))))
+
+    def batches(self, start=None, end=None, partition=None, nodes=None, states=[], other_args=[],
+                columns=None, block_size=1 << 20, steps=False):
+        """same query as __call__, yielding JobBatch objects of columns
+
+        With steps, job steps are fetched too and folded into their job
+        (see fold_steps()).
+        """
+        blocks = self.blocks(self.cmdline(start, end, partition, nodes, states, other_args, steps),
+                             block_size)
+
+        batches = split_blocks(blocks, self.format, columns)
+        if steps:
+            batches = fold_steps(batches)
+
+        return batches
+
+    @classmethod
+    def sorted_format(cls, fields):
+        """fields in default sacct format order, other fields last"""
+        order = {f: i for i, f in enumerate(cls.default_format + cls.extra_format)}
+        return tuple(sorted(fields, key=lambda f: (order.get(f, len(order)), f)))
 
 def parse_elapsed(s):
     days = 0
@@ -148,6 +378,34 @@ def parse_elapsed(s):
 
     return datetime.timedelta(days=days, seconds=seconds, minutes=minutes, hours=hours)
 
+# AllocTRES values kept per job, as a (cpu, mem MB, gpus, billing) tuple
+TRES_CPU, TRES_MEM, TRES_GPU, TRES_BILLING = range(4)
+
+_mem_units = {'K': 1. / 1024, 'M': 1., 'G': 1024., 'T': 1024. * 1024, 'P': 1024. ** 3}
+_tres_cache = {}
+
+
+def parse_mem_mb(s):
+    if s[-1:] in _mem_units:
+        return float(s[:-1]) * _mem_units[s[-1]]
+    return float(s or 0) / (1024 * 1024)
+
+
+def parse_tres(s):
+    """AllocTRES string (billing=4,cpu=4,gres/gpu=1,mem=16G,node=1) as a tuple
+
+    Jobs share few distinct TRES strings: parsed values are memoized.
+    """
+    v = _tres_cache.get(s)
+    if v is None:
+        d = dict(w.split('=', 1) for w in s.split(',') if '=' in w)
+        cpu = float(d.get('cpu', 0))
+        v = (cpu, parse_mem_mb(d.get('mem', '0')), float(d.get('gres/gpu', 0)),
+             float(d.get('billing', cpu)))
+        if len(_tres_cache) < 65536:
+            _tres_cache[s] = v
+    return v
+
 def parse_slurm_datetime(s):
     if s == 'Unknown':
         return None
@@ -177,12 +435,35 @@ def print_datetime(d):
     return d.strftime("%Y-%m-%dT%H:%M:%S")
 
 class Bin(object):
+    # sacct fields this bin reads from jobs, besides start/end/ncpus/state
+    columns = ()
+
     def new(self):
         raise NotImplementedError
 
     def job(self, job):
         raise NotImplementedError
 
+    def batch(self, batch):
+        """account a JobBatch, bins may override this with a columnar version"""
+        for job in batch.rows():
+            self.job(job)
+
+    def merge(self, other):
+        """add the jobs accounted by other (a bin of the same shape) to self"""
+        raise NotImplementedError
+
+    def state(self):
+        """lossless JSON serializable accumulator state"""
+        raise NotImplementedError
+
+    def load(self, state):
+        """restore state() into this (fresh) bin"""
+        raise NotImplementedError
+
+    def fields(self):
+        return set(self.columns)
+
     def indices(self, indices):
         return []
 
@@ -205,6 +486,23 @@ class CpuSecondsBin(Bin):
     def job(self, job):
         self.cpuseconds += job['cpuseconds']
 
+    def batch(self, batch):
+        cpuseconds = self.cpuseconds
+        for v in batch['cpuseconds']:
+            cpuseconds += v
+        self.cpuseconds = cpuseconds
+
+    def merge(self, other):
+        self.cpuseconds += other.cpuseconds
+        return self
+
+    def state(self):
+        return self.cpuseconds
+
+    def load(self, state):
+        self.cpuseconds = state
+        return self
+
     def __getitem__(self, key):
         return self.cpuseconds
 
@@ -215,6 +513,126 @@ class CpuHoursBin(CpuSecondsBin):
     def __str__(self):
         return '%.f' % self[0]
 
+class TresSecondsBin(Bin):
+    """allocated TRES x seconds, for one entry of the parse_tres() tuple"""
+    columns = ('alloctres', )
+    index = TRES_CPU
+    scale = 1.
+
+    def __init__(self, newbin=None):
+        self.value = 0.
+
+    def new(self):
+        return self.__class__()
+
+    def job(self, job):
+        self.value += job['seconds'] * parse_tres(job['alloctres'])[self.index]
+
+    def batch(self, batch):
+        value = self.value
+        index = self.index
+        for seconds, tres in zip(batch['seconds'], batch['alloctres']):
+            value += seconds * parse_tres(tres)[index]
+        self.value = value
+
+    def merge(self, other):
+        self.value += other.value
+        return self
+
+    def state(self):
+        return self.value
+
+    def load(self, state):
+        self.value = state
+        return self
+
+    def __getitem__(self, key):
+        return self.value / self.scale
+
+    def __str__(self):
+        return '%.f' % self[0]
+
+class GpuHoursBin(TresSecondsBin):
+    index = TRES_GPU
+    scale = 3600.
+
+class MemGBHoursBin(TresSecondsBin):
+    index = TRES_MEM
+    scale = 3600. * 1024
+
+class BillingHoursBin(TresSecondsBin):
+    index = TRES_BILLING
+    scale = 3600.
+
+class EfficiencyBin(Bin):
+    """used / allocated resources ratio, as a percentage"""
+    def __init__(self, newbin=None):
+        self.used = 0.
+        self.allocated = 0.
+
+    def new(self):
+        return self.__class__()
+
+    def job(self, job):
+        used, allocated = self.usage(job)
+        self.used += used
+        self.allocated += allocated
+
+    def batch(self, batch):
+        used, allocated = self.used, self.allocated
+        for u, a in self.usages(batch):
+            used += u
+            allocated += a
+        self.used, self.allocated = used, allocated
+
+    def merge(self, other):
+        self.used += other.used
+        self.allocated += other.allocated
+        return self
+
+    def state(self):
+        return [self.used, self.allocated]
+
+    def load(self, state):
+        self.used, self.allocated = state
+        return self
+
+    def __getitem__(self, key):
+        if not self.allocated:
+            return 0.
+        return 100. * self.used / self.allocated
+
+    def __str__(self):
+        return '%.1f%%' % self[0]
+
+class CpuEfficiencyBin(EfficiencyBin):
+    """TotalCPU over allocated cpu time (needs job steps)"""
+    columns = ('totalcpu', 'elapsedraw')
+
+    def usage(self, job):
+        # TotalCPU covers the whole job: prorate it to the accounted part
+        elapsed = float(job['elapsedraw'] or 0)
+        ratio = job['seconds'] / elapsed if elapsed > 0 else 0.
+        return job['totalcpu'] * ratio, job['cpuseconds']
+
+    def usages(self, batch):
+        for totalcpu, elapsed, seconds, cpuseconds in zip(batch['totalcpu'], batch['elapsedraw'],
+                                                          batch['seconds'], batch['cpuseconds']):
+            elapsed = float(elapsed or 0)
+            yield (totalcpu * seconds / elapsed if elapsed > 0 else 0.), cpuseconds
+
+class MemEfficiencyBin(EfficiencyBin):
+    """MaxRSS over allocated memory, weighted by time (needs job steps)"""
+    columns = ('maxrss', 'alloctres')
+
+    def usage(self, job):
+        seconds = job['seconds']
+        return job['maxrss'] * seconds, parse_tres(job['alloctres'])[TRES_MEM] * seconds
+
+    def usages(self, batch):
+        for maxrss, tres, seconds in zip(batch['maxrss'], batch['alloctres'], batch['seconds']):
+            yield maxrss * seconds, parse_tres(tres)[TRES_MEM] * seconds
+
 class PercentBin(Bin):
     def __init__(self, bin, refval):
         self.bin = bin
@@ -226,6 +644,23 @@ class PercentBin(Bin):
     def job(self, job):
         self.bin.job(job)
 
+    def batch(self, batch):
+        self.bin.batch(batch)
+
+    def merge(self, other):
+        self.bin.merge(other.bin)
+        return self
+
+    def state(self):
+        return self.bin.state()
+
+    def load(self, state):
+        self.bin.load(state)
+        return self
+
+    def fields(self):
+        return self.bin.fields()
+
     def __getitem__(self, key):
         return 100. * self.bin[key] / self.refval
 
@@ -243,20 +678,237 @@ class JobCountBin(Bin):
     def job(self, job):
         self.count += 1
 
+    def batch(self, batch):
+        self.count += len(batch)
+
+    def merge(self, other):
+        self.count += other.count
+        return self
+
+    def state(self):
+        return self.count
+
+    def load(self, state):
+        self.count = state
+        return self
+
     def __getitem__(self, key):
         return self.count
 
 
+class UtilizationBin(Bin):
+    """allocated cpu time in percent of the capacity: cores * true span length
+
+    Jobs carry the cores of their cluster and the length of their span
+    (the report period, or the day/week/month... of a span grouping).
+    """
+    def __init__(self, newbin=None):
+        self.cpuseconds = 0.
+        # cluster: capacity seconds
+        self.capacity = {}
+
+    def new(self):
+        return self.__class__()
+
+    def job(self, job):
+        self.cpuseconds += job['cpuseconds']
+        capacity = job['cores'] * job['span']
+        if capacity > self.capacity.get(job['cluster'], 0.):
+            self.capacity[job['cluster']] = capacity
+
+    def batch(self, batch):
+        self.cpuseconds += sum(batch['cpuseconds'])
+        for cluster, cores, span in zip(batch['cluster'], batch['cores'], batch['span']):
+            if cores * span > self.capacity.get(cluster, 0.):
+                self.capacity[cluster] = cores * span
+
+    def merge(self, other):
+        self.cpuseconds += other.cpuseconds
+        for cluster, capacity in other.capacity.items():
+            self.capacity[cluster] = max(capacity, self.capacity.get(cluster, 0.))
+        return self
+
+    def state(self):
+        return [self.cpuseconds, self.capacity]
+
+    def load(self, state):
+        self.cpuseconds, self.capacity = state[0], dict(state[1])
+        return self
+
+    def __getitem__(self, key):
+        capacity = sum(self.capacity.values())
+        return 100. * self.cpuseconds / capacity if capacity else 0.
+
+    def __str__(self):
+        return '%02.1f%%' % self[0]
+
+
+class HistogramCell(object):
+    """one bucket of a HistogramBin, rendered like a value bin"""
+    def __init__(self, value, format):
+        self.value = value
+        self.format = format
+
+    def __getitem__(self, key):
+        return self.value
+
+    def __str__(self):
+        return self.format % self.value
+
+
+class HistogramBin(Bin):
+    """jobs (or a job value) by bucket of a job field, in a fixed size array
+
+    Bucket i holds field values in [edges[i], edges[i + 1]), the first one
+    everything below edges[1] and the last one everything from edges[-1].
+    Cells of other periods merge by array addition.
+    """
+    field = 'ncpus'
+    # None counts jobs, else the batch column summed, divided by scale
+    weight = None
+    scale = 1.
+    # field value divisor before bucketing
+    unit = 1.
+    edges = tuple(2 ** i for i in range(13))
+    format = '%.f'
+
+    def __init__(self, newbin=None):
+        self.cells = array('d', bytes(8 * len(self.edges)))
+
+    @property
+    def columns(self):
+        # seconds and cpuseconds are computed by the report
+        return tuple(c for c in (self.field, self.weight)
+                     if c is not None and c not in ('seconds', 'cpuseconds'))
+
+    def new(self):
+        return self.__class__()
+
+    def bucket(self, v):
+        return max(0, bisect.bisect_right(self.edges, float(v or 0) / self.unit) - 1)
+
+    def job(self, job):
+        w = 1. if self.weight is None else float(job[self.weight] or 0)
+        self.cells[self.bucket(job[self.field])] += w
+
+    def batch(self, batch):
+        cells = self.cells
+        bucket = self.bucket
+        if self.weight is None:
+            for v in batch[self.field]:
+                cells[bucket(v)] += 1.
+        else:
+            for v, w in zip(batch[self.field], batch[self.weight]):
+                cells[bucket(v)] += float(w or 0)
+
+    def merge(self, other):
+        for i, v in enumerate(other.cells):
+            self.cells[i] += v
+        return self
+
+    def state(self):
+        return list(self.cells)
+
+    def load(self, state):
+        self.cells = array('d', state)
+        return self
+
+    def labels(self):
+        def label(v):
+            return '%g' % v
+
+        # integer edges (cpus, nodes): inclusive bounds, 1, 2-3, 4-7...
+        discrete = self.unit == 1 and all(e == int(e) for e in self.edges)
+
+        ret = []
+        for lo, hi in zip(self.edges, self.edges[1:]):
+            if discrete:
+                hi -= 1
+            ret.append(label(lo) if discrete and lo == hi else '%s-%s' % (label(lo), label(hi)))
+        ret.append('%s+' % label(self.edges[-1]))
+        return ret
+
+    def indices(self, indices):
+        return [self.labels()]
+
+    def __contains__(self, key):
+        return key in self.labels()
+
+    def __getitem__(self, key):
+        return HistogramCell(self.cells[self.labels().index(key)] / self.scale, self.format)
+
+    def __str__(self):
+        return ' '.join('%s:%s' % (l, self[l]) for l in self.labels())
+
+class NcpusHistogramBin(HistogramBin):
+    """jobs by allocated cpus (log2 buckets)"""
+
+class DurationHistogramBin(HistogramBin):
+    """jobs by run time in hours"""
+    field = 'elapsedraw'
+    unit = 3600.
+    edges = (0, 0.25, 1, 4, 12, 24, 48, 168)
+
+class SizeCpuHoursHistogramBin(HistogramBin):
+    """cpu hours by allocated cpus (log2 buckets)"""
+    weight = 'cpuseconds'
+    scale = 3600.
+
+
+def histogram_bin(name, field, edges, weight=None, unit=1.):
+    """HistogramBin class of a [histogram:NAME] section"""
+    scale = 1.
+    if weight == 'cpu_hours':
+        weight, scale = 'cpuseconds', 3600.
+    elif weight in (None, '', 'count'):
+        weight = None
+
+    return type(name, (HistogramBin, ), {
+        'field': field, 'weight': weight, 'scale': scale, 'unit': unit,
+        'edges': tuple(sorted(float(e) for e in edges)),
+    })
+
+
 class GroupingBin(Bin):
     separators = ('\n', ',', )
-    def __init__(self, hashfunc, orderfunc, newbin):
+    def __init__(self, hashfunc, orderfunc, newbin, field=None):
         self.hashfunc = hashfunc
         self.orderfunc = orderfunc
         self.newbin = newbin
         self.bindict = {}
+        # key is the value of this job field: batches can be split by column
+        self.field = field
+        if field is not None:
+            self.columns = (field, )
 
     def new(self):
-        return self.__class__(self.newbin.new())
+        # same key functions, no keys yet; newbin is a prototype only ever
+        # cloned, so it can be shared
+        ret = object.__new__(self.__class__)
+        ret.__dict__.update(self.__dict__)
+        ret.bindict = {}
+        return ret
+
+    def merge(self, other):
+        for k, b in other.bindict.items():
+            if k not in self.bindict:
+                self.bindict[k] = self.newbin.new()
+
+            self.bindict[k].merge(b)
+
+        return self
+
+    def state(self):
+        return {k: b.state() for k, b in self.bindict.items()}
+
+    def load(self, state):
+        for k, st in state.items():
+            if k not in self.bindict:
+                self.bindict[k] = self.newbin.new()
+
+            self.bindict[k].load(st)
+
+        return self
 
     def job(self, job):
         keys = self.hashfunc(job)
@@ -271,6 +923,26 @@ class GroupingBin(Bin):
             bin = self.bindict[k]
             bin.job(job)
 
+    def batch(self, batch):
+        if self.field is None:
+            return super(GroupingBin, self).batch(batch)
+
+        groups = {}
+        for i, k in enumerate(batch[self.field]):
+            if k in groups:
+                groups[k].append(i)
+            else:
+                groups[k] = [i]
+
+        for k, indices in groups.items():
+            if k not in self.bindict:
+                self.bindict[k] = self.newbin.new()
+
+            self.bindict[k].batch(batch.take(indices))
+
+    def fields(self):
+        return set(self.columns) | self.newbin.fields()
+
     def key_list(self):
         keys = list(self.bindict.keys())
 
@@ -304,13 +976,28 @@ class GroupingBin(Bin):
 class UserGroupingBin(GroupingBin):
     def __init__(self, newbin):
         super(UserGroupingBin, self).__init__(hashfunc=lambda j: j['user'],
-                                              orderfunc=None, newbin=newbin)
+                                              orderfunc=None, newbin=newbin, field='user')
 
 
 class GroupGroupingBin(GroupingBin):
     def __init__(self, newbin):
         super(GroupGroupingBin, self).__init__(hashfunc=lambda j: j['group'],
-                                               orderfunc=None, newbin=newbin)
+                                               orderfunc=None, newbin=newbin, field='group')
+
+class AccountGroupingBin(GroupingBin):
+    def __init__(self, newbin):
+        super(AccountGroupingBin, self).__init__(hashfunc=lambda j: j['account'],
+                                                 orderfunc=None, newbin=newbin, field='account')
+
+class PartitionGroupingBin(GroupingBin):
+    def __init__(self, newbin):
+        super(PartitionGroupingBin, self).__init__(hashfunc=lambda j: j['partition'],
+                                                   orderfunc=None, newbin=newbin, field='partition')
+
+class ClusterGroupingBin(GroupingBin):
+    def __init__(self, newbin):
+        super(ClusterGroupingBin, self).__init__(hashfunc=lambda j: j['cluster'],
+                                                 orderfunc=None, newbin=newbin, field='cluster')
 
 class StartGroupingBin(GroupingBin):
     def __init__(self, newbin):
@@ -320,242 +1007,835 @@ class StartGroupingBin(GroupingBin):
         super(StartGroupingBin, self).__init__(hashfunc, orderfunc=parse_slurm_date, newbin=newbin)
 
 
-class SpanGroupingBin(GroupingBin):
-    def __init__(self, hashfunc, newbin, filling=(None, None)):
+class TopKGroupingBin(GroupingBin):
+    """the N heaviest keys of a job field by cpu seconds, the rest in 'other'
+
+    A weighted Space-Saving summary: at most capacity monitored keys have
+    a cpu seconds count, an overestimation bound (error) and a bin. A new
+    key evicts the lightest one (its bin folded into the 'other' bin) and
+    starts from floor, the most any unmonitored key may weigh. Keys
+    monitored before the first eviction are complete: their bin holds all
+    their jobs and their count is exact. Leaders are the N heaviest
+    monitored keys; they are exact when they are all complete and heavier
+    than floor (confirmed()). Otherwise recount() keeps the keys that may
+    still be leaders as candidates, with empty bins, and the same jobs are
+    accounted again (see Report.rescan()); when no bounded candidate set
+    exists, the jobs are accounted in a table large enough never to evict.
+    Nothing is lost: every job is accounted either in a key bin or in
+    'other'.
+    """
+    OTHER = 'other'
+    CAPACITY_FACTOR = 4
+
+    def __init__(self, field, n, newbin):
+        super(TopKGroupingBin, self).__init__(hashfunc=lambda j: j[field], orderfunc=None,
+                                              newbin=newbin, field=field)
+        self.n = n
+        self.limit = max(self.CAPACITY_FACTOR * n, n + 8)
+        self.reset()
+
+    def reset(self):
+        self.capacity = self.limit
+        # key: [cpu seconds, overestimation]
+        self.counts = {}
+        self.complete = set()
+        self.floor = 0.
+        self.evicted = False
+        # keys admitted, at least the number of distinct keys
+        self.seen = 0
+        # fixed candidates while recounting
+        self.candidates = None
+        self.other = self.newbin.new()
+        self.folded = None
 
-        super(SpanGroupingBin, self).__init__(hashfunc, orderfunc=parse_slurm_date, newbin=newbin)
+    def new(self):
+        ret = super(TopKGroupingBin, self).new()
+        ret.reset()
+        return ret
+
+    def evict(self, k):
+        self.floor = max(self.floor, self.counts.pop(k)[0])
+        self.evicted = True
+        self.other.merge(self.bindict.pop(k))
+        self.complete.discard(k)
+
+    def monitor(self, k, weight):
+        """bin of key k, evicting the lightest key for a new one"""
+        self.folded = None
+
+        c = self.counts.get(k)
+        if c is not None:
+            c[0] += weight
+            return self.bindict[k]
+        if self.candidates is not None:
+            return self.other
+
+        if len(self.bindict) >= self.capacity:
+            self.evict(min(self.counts, key=lambda key: (self.counts[key][0], key)))
+
+        if not self.evicted:
+            self.complete.add(k)
+        self.counts[k] = [self.floor + weight, self.floor]
+        self.seen += 1
+        self.bindict[k] = self.newbin.new()
+        return self.bindict[k]
 
-        self.filling = filling
+    def job(self, job):
+        self.monitor(job[self.field], job['cpuseconds']).job(job)
+
+    def batch(self, batch):
+        groups = {}
+        for i, k in enumerate(batch[self.field]):
+            if k in groups:
+                groups[k].append(i)
+            else:
+                groups[k] = [i]
+
+        cpuseconds = batch['cpuseconds']
+        for k, indices in groups.items():
+            self.monitor(k, sum(cpuseconds[i] for i in indices)).batch(batch.take(indices))
+
+    def ranked(self):
+        """leaders, heaviest first"""
+        return sorted(self.counts, key=lambda k: (-self.counts[k][0], k))[:self.n]
+
+    def confirmed(self):
+        """are the leaders and their bins exact?"""
+        if self.candidates is not None:
+            return True
+        leaders = self.ranked()
+        if not all(k in self.complete for k in leaders):
+            return False
+        # monitored keys weigh at most their count, the others floor
+        return not self.evicted or self.counts[leaders[-1]][0] > self.floor
+
+    def recount(self):
+        """empty the bins of the keys that may be leaders: account the same jobs again"""
+        lower = sorted((c - e for c, e in self.counts.values()), reverse=True)
+        threshold = lower[self.n - 1] if len(lower) >= self.n else 0.
+
+        if self.evicted and self.floor >= threshold:
+            # any unmonitored key may be a leader (the N-th one is lost in
+            # the tail): count every key once, state() keeps limit of them
+            seen = self.seen
+            self.reset()
+            self.capacity = max(self.limit, seen)
+            return
 
-        self.__fill()
+        candidates = [k for k, (c, e) in self.counts.items() if c >= threshold]
+        self.reset()
+        self.candidates = set(candidates)
+        self.counts = {k: [0., 0.] for k in candidates}
+        self.complete = set(candidates)
+        self.bindict = {k: self.newbin.new() for k in candidates}
+
+    def merge(self, other):
+        if self.candidates is not None or other.candidates is not None:
+            raise ValueError('cannot merge top-K groupings being recounted')
+
+        # a key missing on one side weighs at most the floor of that side
+        floor, other_floor = self.floor, other.floor
+        for k, c in self.counts.items():
+            if k not in other.counts:
+                c[0] += other_floor
+                c[1] += other_floor
+                if other.evicted:
+                    self.complete.discard(k)
+
+        for k, (count, error) in other.counts.items():
+            b = other.bindict[k]
+            if k in self.counts:
+                c = self.counts[k]
+                c[0] += count
+                c[1] += error
+                if k not in other.complete:
+                    self.complete.discard(k)
+            else:
+                self.counts[k] = [count + floor, error + floor]
+                self.bindict[k] = self.newbin.new()
+                if k in other.complete and not self.evicted:
+                    self.complete.add(k)
+            self.bindict[k].merge(b)
+
+        self.floor = floor + other_floor
+        self.evicted = self.evicted or other.evicted
+        self.seen += other.seen
+        self.other.merge(other.other)
+
+        # keep the capacity heaviest keys
+        for k in sorted(self.counts, key=lambda key: (-self.counts[key][0], key))[self.capacity:]:
+            self.evict(k)
+
+        self.folded = None
+        return self
+
+    def state(self):
+        """the summary of the limit heaviest keys, the others folded in other"""
+        keys = sorted(self.counts, key=lambda k: (-self.counts[k][0], k))
+        floor, other = self.floor, self.other
+        if len(keys) > self.limit:
+            other = self.newbin.new().merge(other)
+            for k in keys[self.limit:]:
+                floor = max(floor, self.counts[k][0])
+                other.merge(self.bindict[k])
+
+        return {
+            'floor': floor,
+            'evicted': self.evicted or len(keys) > self.limit,
+            'seen': self.seen,
+            'keys': {k: self.counts[k] + [k in self.complete, self.bindict[k].state()]
+                     for k in keys[:self.limit]},
+            'candidates': None if self.candidates is None else sorted(self.candidates),
+            'other': other.state(),
+        }
+
+    def load(self, state):
+        self.floor = state['floor']
+        self.evicted = state['evicted']
+        self.seen = state['seen']
+        for k, (count, error, complete, st) in state['keys'].items():
+            self.counts[k] = [count, error]
+            self.bindict[k] = self.newbin.new().load(st)
+            if complete:
+                self.complete.add(k)
+        if state['candidates'] is not None:
+            self.candidates = set(state['candidates'])
+        self.other.load(state['other'])
+        self.folded = None
+        return self
+
+    def fold(self):
+        """(leaders, other bin): the n heaviest keys, the rest folded in other"""
+        if self.folded is None:
+            leaders = self.ranked()
+            other = self.newbin.new().merge(self.other)
+            for k, b in self.bindict.items():
+                if k not in leaders:
+                    other.merge(b)
+            self.folded = leaders, other
+
+        return self.folded
 
-    def __fill(self):
-        b, e = self.filling
+    def key_list(self):
+        return self.fold()[0] + [self.OTHER]
 
-        if b is None or e is None:
-            return
+    def indices(self, indices):
+        if len(indices) == 0: indices.append([])
 
-        keys = self.hashfunc(dict(start=b, end=e))
+        # leaders of sibling bins first, heaviest first, other last
+        keys = [k for k in indices[0] if k != self.OTHER]
+        keys += [k for k in self.fold()[0] if k not in keys]
 
-        for k in keys[:-1]: # don't put a bin on last span
+        subindices = indices[1:]
+        for k in self.key_list():
+            subindices = self[k].indices(subindices)
 
-            if k not in self.bindict:
-                self.bindict[k] = self.newbin.new()
+        return [keys + [self.OTHER]] + subindices
 
-    def next_span(self, date):
-        raise NotImplementedError
+    def __getitem__(self, key):
+        if key == self.OTHER:
+            return self.fold()[1]
+        return self.bindict[key]
 
-    def new(self):
-        return self.__class__(self.newbin.new(), self.filling)
+    def __contains__(self, key):
+        return key == self.OTHER or key in self.fold()[0]
 
-    def job(self, job):
-        keys = self.hashfunc(job)
+    def __str__(self):
+        return str({k: self[k] for k in self.key_list()})
 
-        if not isinstance(keys, list):
-            keys = [keys]
 
-#        print('job', [job[k] for k in ['jobid', 'ncpus', 'start', 'end', 'cpuseconds']])
-        cpuseconds = 0
-        spans = []
+def topk_bins(tree):
+    """TopKGroupingBin instances of a grouping tree"""
+    if isinstance(tree, TopKGroupingBin):
+        yield tree
+    elif isinstance(tree, GroupingBin):
+        for b in tree.bindict.values():
+            yield from topk_bins(b)
 
-        for k in keys:
-            spanjob = job.copy()
-            kd = parse_slurm_date(k)
-            kdp1 = self.next_span(kd)
 
-            jstart = parse_slurm_datetime(spanjob['start'])
-            if jstart  < kd:
-                jstart = kd
-                spanjob['start'] = print_datetime(jstart)
+class SpanGroupingBin(GroupingBin):
+    """jobs split between the calendar spans they overlap (see spans)"""
+    unit = None
+
+    def __init__(self, newbin, filling=(None, None)):
+
+        super(SpanGroupingBin, self).__init__(None, orderfunc=parse_slurm_date, newbin=newbin)
+
+        self.filling = filling
 
-            jend = parse_slurm_datetime(spanjob['end'])
-            if jend > kdp1:
-                jend = kdp1
-                spanjob['end'] = print_datetime(jend)
+        # epoch seconds of the report period, span keys it covers
+        self.period = None
+        self.fill_keys = []
+        b, e = filling
+        if b is not None and e is not None:
+            cal = calendar()
+            self.period = (cal.epoch(b), cal.epoch(e))
+            # don't put a bin on last span
+            self.fill_keys = [k for k, _, _ in cal.spans(self.unit, *self.period)[:-1]]
 
-            elapsed = jend - jstart
-            cpus = int(spanjob['ncpus'])
-            spanjob['cpuseconds'] = elapsed.total_seconds() * cpus
+        self.__fill()
 
-            if spanjob['cpuseconds'] == 0:
+    def __fill(self):
+        for k in self.fill_keys:
+            if k not in self.bindict:
+                self.bindict[k] = self.newbin.new()
+
+    def new(self):
+        ret = super(SpanGroupingBin, self).new()
+        ret.__fill()
+        return ret
+
+    def pieces(self, start, end):
+        """(key, start, end, seconds, span seconds) of a job in each span it overlaps
+
+        span seconds is the true length of the span within the report period.
+        """
+        cal = calendar()
+        s, e = cal.epoch(start), cal.epoch(end)
+        bounds, keys = cal.table(self.unit)
+        p0, p1 = self.period or (bounds[0], bounds[-1])
+
+        i = bisect.bisect_right(bounds, s) - 1
+        while bounds[i] < e:
+            b0, b1 = bounds[i], bounds[i + 1]
+            yield (keys[i],
+                   start if s >= b0 else keys[i] + 'T00:00:00',
+                   end if e <= b1 else keys[i + 1] + 'T00:00:00',
+                   min(e, b1) - max(s, b0),
+                   min(b1, p1) - max(b0, p0))
+            i += 1
+
+    def job(self, job):
+        cpus = int(job['ncpus'])
+        for k, start, end, seconds, span in self.pieces(job['start'], job['end']):
+            if seconds * cpus == 0:
                 # don't register empty jobs
                 continue
 
-            cpuseconds += spanjob['cpuseconds']
-            spans.append((k, cpuseconds))
+            spanjob = job.copy()
+            spanjob.update(start=start, end=end, seconds=seconds, cpuseconds=seconds * cpus,
+                           span=span)
 
             if k not in self.bindict:
                 self.bindict[k] = self.newbin.new()
 
-            bin = self.bindict[k]
-            bin.job(spanjob)
+            self.bindict[k].job(spanjob)
+
+    def batch(self, batch):
+        # key: indices, start, end, seconds, cpuseconds, span columns
+        groups = {}
+        for i, (s, e, ncpus) in enumerate(zip(batch['start'], batch['end'], batch['ncpus'])):
+            cpus = int(ncpus)
+            for k, start, end, seconds, span in self.pieces(s, e):
+                if seconds * cpus == 0:
+                    continue
+
+                g = groups.get(k)
+                if g is None:
+                    g = groups[k] = ([], [], [], [], [], [])
+                g[0].append(i)
+                g[1].append(start)
+                g[2].append(end)
+                g[3].append(seconds)
+                g[4].append(seconds * cpus)
+                g[5].append(span)
+
+        for k, (indices, starts, ends, seconds, cpuseconds, spans) in groups.items():
+            if k not in self.bindict:
+                self.bindict[k] = self.newbin.new()
+
+            self.bindict[k].batch(batch.take(indices, start=starts, end=ends, seconds=seconds,
+                                             cpuseconds=cpuseconds, span=spans))
 
 class DailyGroupingBin(SpanGroupingBin):
-    span = datetime.timedelta(days=1)
+    unit = 'daily'
 
-    def __init__(self, newbin, filling=(None, None)):
-        def hashfunc(j):
-            # start bin
-            b = parse_slurm_datetime(j['start'])
+class WeeklyGroupingBin(SpanGroupingBin):
+    unit = 'weekly'
 
-            # end bin is date of end, ep1 is for correct ending of the while loop
-            ep1 = parse_slurm_date(j['end'].split('T', 1)[0]) + self.span
+class MonthlyGroupingBin(SpanGroupingBin):
+    unit = 'monthly'
+
+class QuarterlyGroupingBin(SpanGroupingBin):
+    unit = 'quarterly'
+
+class YearlyGroupingBin(SpanGroupingBin):
+    unit = 'yearly'
+
+
+def span_filling(start, end):
+    """span groupings get a (maybe empty) bin for every span of the period"""
+    if start is None or end is None:
+        return (None, None)
+    return (print_datetime(start), print_datetime(end))
+
+
+# grouping grammar: 'a * b * value' names and how to build them from the bin
+# they contain and the report period
+GROUPINGS = {
+    'user': lambda b, start, end: UserGroupingBin(b),
+    'group': lambda b, start, end: GroupGroupingBin(b),
+    'account': lambda b, start, end: AccountGroupingBin(b),
+    'partition': lambda b, start, end: PartitionGroupingBin(b),
+    'cluster': lambda b, start, end: ClusterGroupingBin(b),
+    'job_start': lambda b, start, end: StartGroupingBin(b),
+    'daily': lambda b, start, end: DailyGroupingBin(b, filling=span_filling(start, end)),
+    'weekly': lambda b, start, end: WeeklyGroupingBin(b, filling=span_filling(start, end)),
+    'monthly': lambda b, start, end: MonthlyGroupingBin(b, filling=span_filling(start, end)),
+    'quarterly': lambda b, start, end: QuarterlyGroupingBin(b, filling=span_filling(start, end)),
+    'yearly': lambda b, start, end: YearlyGroupingBin(b, filling=span_filling(start, end)),
+}
+
+# 'name(N)' groupings
+PARAMETRIC_GROUPINGS = {
+    'top_user': lambda n, b, start, end: TopKGroupingBin('user', n, b),
+    'top_group': lambda n, b, start, end: TopKGroupingBin('group', n, b),
+    'top_account': lambda n, b, start, end: TopKGroupingBin('account', n, b),
+}
+
+_parametric_re = re.compile(r'^(\w+)\(\s*([0-9]+)\s*\)$')
+
+
+def grouping_factory(name):
+    """GROUPINGS like builder of a grouping name, or None"""
+    if name in GROUPINGS:
+        return GROUPINGS[name]
+
+    m = _parametric_re.match(name)
+    if m is None or m.group(1) not in PARAMETRIC_GROUPINGS or int(m.group(2)) == 0:
+        return None
 
-            ret = []
-            while b < ep1:
-                ret.append(print_date(b))
-                b += self.span
+    factory, n = PARAMETRIC_GROUPINGS[m.group(1)], int(m.group(2))
+    return lambda b, start, end: factory(n, b, start, end)
+
+VALUES = {
+    'cpu_seconds': CpuSecondsBin,
+    'cpu_hours': CpuHoursBin,
+    'job_count': JobCountBin,
+    'gpu_hours': GpuHoursBin,
+    'mem_gb_hours': MemGBHoursBin,
+    'billing_hours': BillingHoursBin,
+    'cpu_efficiency': CpuEfficiencyBin,
+    'mem_efficiency': MemEfficiencyBin,
+    'utilization': UtilizationBin,
+    'ncpus_hist': NcpusHistogramBin,
+    'duration_hist': DurationHistogramBin,
+    'size_cpu_hours_hist': SizeCpuHoursHistogramBin,
+}
+
+
+def register_histograms(cfg):
+    """add the histograms of [histogram:NAME] sections to VALUES
+
+        [histogram:nodes_hist]
+        field = nnodes        ; numeric sacct field (or seconds)
+        edges = 1,2,4,16,64   ; or log2 = 12 for 1,2,4...4096
+        weight = cpu_hours    ; default: count jobs
+    """
+    for section in cfg.sections('^histogram:'):
+        name = section.split(':', 1)[1]
+        o = cfg.section(section)
+        if 'edges' in o:
+            edges = o['edges'].split(',')
+        else:
+            edges = [2 ** i for i in range(int(o.get('log2', 12)) + 1)]
+
+        VALUES[name] = histogram_bin(name, o.get('field', 'ncpus'), edges, o.get('weight'),
+                                     float(o.get('unit', 1.)))
+        if VALUES[name].weight is None and name not in NOT_PERIOD_ADDITIVE:
+            NOT_PERIOD_ADDITIVE.append(name)
+
+
+class GroupingPlan(object):
+    """A compiled, validated grouping specification
+
+    'group * cpu_hours, monthly * cpu_hours' is parsed once; new() then
+    clones prototype trees (cached per period) for each report period.
+    """
+    def __init__(self, spec):
+        self.spec = spec
+        self.titles = []
+
+        for grouping_spec in spec.split(','):
+            title = [s.strip() for s in grouping_spec.split('*')]
+
+            *groupings, value = title
+            if value not in VALUES:
+                raise ValueError('invalid grouping \'%s\': \'%s\' is not a value (%s)' %
+                                 (grouping_spec.strip(), value, ', '.join(sorted(VALUES))))
+            for g in groupings:
+                if grouping_factory(g) is None:
+                    raise ValueError('invalid grouping \'%s\': unknown grouping \'%s\' (%s)' %
+                                     (grouping_spec.strip(), g,
+                                      ', '.join(sorted(GROUPINGS) +
+                                                ['%s(N)' % p for p in sorted(PARAMETRIC_GROUPINGS)])))
+
+            if sum(1 for g in groupings if _parametric_re.match(g)) > 1:
+                raise ValueError('invalid grouping \'%s\': more than one top-K grouping' %
+                                 grouping_spec.strip())
+
+            self.titles.append(title)
+
+        self.prototypes = {}
+
+    def prototype(self, start_date, end_date):
+        # span groupings depend on the calendar timezone
+        key = (start_date, end_date, calendar().timezone)
+        if key not in self.prototypes:
+            if len(self.prototypes) >= 64:
+                # many short periods (rolling windows): keep memory bounded
+                self.prototypes.clear()
+
+            trees = []
+            for title in self.titles:
+                *groupings, value = title
+                grouping = VALUES[value]()
+                for g in reversed(groupings):
+                    grouping = grouping_factory(g)(grouping, start_date, end_date)
+                trees.append(grouping)
+
+            self.prototypes[key] = trees
+
+        return self.prototypes[key]
+
+    def new(self, start_date, end_date):
+        """fresh (grouping, title) accumulators for a period"""
+        return [(p.new(), title)
+                for p, title in zip(self.prototype(start_date, end_date), self.titles)]
+
+    def mergeable(self, title, parts='monthly'):
+        """can trees of consecutive parts be merged into the one of their union?
+
+        Parts are months (periodic_reports rollups) or hours (rolling
+        windows). Jobs crossing a part boundary are split between parts:
+        values must add up (job_count doesn't) and keys must not depend on
+        the clipping (job_start, top-K leaders do), unless a span grouping
+        nested in the parts splits jobs the same way first: days and months
+        in months, none in hours (weeks cross months). Past hours of
+        rolling windows are never recomputed: only values that are final
+        for running jobs (cpu and TRES time) can be merged from them.
+        Top-K groupings are never merged, whatever span encloses them: the
+        leaders of a part may have been recounted.
+        """
+        if any(_parametric_re.match(name) for name in title):
+            return False
+
+        for name in title:
+            if name in PERIOD_SPLITTING[parts]:
+                return True
+            if name in NOT_PERIOD_ADDITIVE:
+                return False
+            if parts == 'hourly' and name in VALUES and name not in HOURLY_ADDITIVE:
+                return False
 
-            return ret
+        return True
 
-        super(DailyGroupingBin, self).__init__(hashfunc, newbin, filling)
+    def __str__(self):
+        return ','.join('*'.join(title) for title in self.titles)
 
-    def next_span(self, date):
-        return date + self.span
 
-class MonthlyGroupingBin(SpanGroupingBin):
+# see GroupingPlan.mergeable(): span groupings nested in parts of each size
+PERIOD_SPLITTING = {'monthly': ('daily', 'monthly'), 'hourly': ()}
+HOURLY_ADDITIVE = ('cpu_seconds', 'cpu_hours', 'gpu_hours', 'mem_gb_hours', 'billing_hours')
+NOT_PERIOD_ADDITIVE = ['job_count', 'job_start', 'ncpus_hist', 'duration_hist', 'utilization']
 
-    def __init__(self, newbin, filling=(None, None)):
-        def hashfunc(j):
-            # start bin
-            b = parse_slurm_month(j['start'].split('T', 1)[0].rsplit('-', 1)[0])
+_plans = {}
+
+
+def grouping_plan(spec):
+    """compiled GroupingPlan of spec, compiled once per process"""
+    if spec not in _plans:
+        _plans[spec] = GroupingPlan(spec)
+    return _plans[spec]
 
-            # end bin is date of end, ep1 is for correct ending of the while loop
-            ep1 = self.next_span(parse_slurm_month(j['end'].split('T', 1)[0].rsplit('-', 1)[0]))
 
-            ret = []
-            while b < ep1:
-                ret.append(print_date(b))
-                b = self.next_span(b)
+def plan_fields(plan):
+    """sacct fields of the groupings of a plan"""
+    fields = set()
+    for grouping, _title in plan.new(None, None):
+        fields |= grouping.fields()
+    return fields
 
-            return ret
 
-        super(MonthlyGroupingBin, self).__init__(hashfunc, newbin, filling)
+def merge_groupings(groupings, others):
+    """merge the (grouping, title) lists of two runs of the same plan"""
+    for (grouping, title), (other, other_title) in zip(groupings, others):
+        if title != other_title:
+            raise ValueError('cannot merge %s into %s' % ('*'.join(other_title), '*'.join(title)))
+        grouping.merge(other)
 
-    def next_span(self, date):
-        ret = date + datetime.timedelta(days=31)
-        return parse_slurm_month(print_month(ret))
+    return groupings
 
 
-def sreporting(conf_file, report=None, grouping_specs=None, start=None, end=None, extra_options=[]):
+def cluster_get(cfg, cluster, option, default):
+    """option of section [cluster:NAME], falling back to [general]"""
+    if cluster is not None and cfg.has('cluster:' + cluster, option):
+        return cfg.get('cluster:' + cluster, option)
+    return cfg.get('general', option, default)
+
+
+def load_slurm_conf(cfg, cluster=None):
     # read slurm configuration
-    with open('/etc/slurm/slurm.conf', 'r') as f:
-        slurm_conf = parse_slurm_conf(f)
+    with open(cluster_get(cfg, cluster, 'slurm_conf', '/etc/slurm/slurm.conf'), 'r') as f:
+        return parse_slurm_conf(f)
 
-    slurm_nodes = slurm_conf['nodes']
-    slurm_partitions = slurm_conf['partitions']
 
-    # read report configuration
-    cfg = config.Config(conf_file)
+def make_sacct(cfg, format=None, extra_options=[], verbose=False, cluster=None, source=None):
+    """job source of a cluster: live sacct unless 'source' says otherwise (see sources)"""
+    source = source or cluster_get(cfg, cluster, 'source', 'sacct')
+    if source != 'sacct':
+        from .sources import make_source
+        return make_source(source, format=format, cluster=cluster)
 
-    query_grace = parse_elapsed(cfg.get('general', 'query_grace', '00:00:00'))
+    if cluster is not None and cfg.has('cluster:' + cluster, 'clusters'):
+        # query through slurmdbd federation (sacct --clusters)
+        extra_options = ['--clusters=%s' % cfg.get('cluster:' + cluster, 'clusters')] + extra_options
 
-    query_start_date = cfg.getdate('general', 'default_start', '1970-01-01')
-    start_date = query_start_date
-    if start is not None:
-        start_date = parse_slurm_date(start)
-        query_start_date = max(query_start_date, start_date - query_grace)
+    return Sacct(format=format, extra_options=extra_options, verbose=verbose,
+                 command=cluster_get(cfg, cluster, 'sacct', 'sacct'),
+                 remote_host=cluster_get(cfg, cluster, 'remote_host', False) or None)
 
-    query_end_date = datetime.datetime.now()
-    end_date = query_end_date
-    if end is not None:
-        end_date = parse_slurm_date(end)
-        query_end_date = end_date + query_grace
 
-    # select report
-    report_section = 'report:' + (report or cfg.get('general', 'default_report'))
+def make_sreport(cfg, verbose=False, cluster=None, **kwargs):
+    """SreportCluster of the sreport command of a cluster (or [general])"""
+    extra_args = []
+    if cluster is not None and cfg.has('cluster:' + cluster, 'clusters'):
+        extra_args.append('clusters=%s' % cfg.get('cluster:' + cluster, 'clusters'))
 
-    src = Sacct(extra_options=extra_options, verbose=False)
+    return SreportCluster(verbose=verbose, command=cluster_get(cfg, cluster, 'sreport', 'sreport'),
+                          remote_host=cluster_get(cfg, cluster, 'remote_host', False) or None,
+                          extra_args=extra_args, **kwargs)
 
-    partition = cfg.get(report_section, 'partition', False) or None
 
-    selected_nodes = set(slurm_nodes.keys())  # all nodes from cluster
+def cluster_list(cfg, clusters=None):
+    """clusters to report on: comma separated names or [general] clusters"""
+    clusters = clusters or cfg.get('general', 'clusters', False) or None
+    if clusters is None:
+        return None
+    return [c.strip() for c in clusters.split(',') if c.strip()]
+
+
+class Report(object):
+    """One report section evaluated over a [start, end) period.
+
+    Holds everything sreporting() used to compute inline: the node/partition
+    selection, the sacct query window (widened by query_grace) and the
+    grouping trees jobs are accounted into.
+    """
+    def __init__(self, cfg, report=None, grouping_specs=None, start=None, end=None,
+                 slurm_conf=None, cluster=None, groupings=None):
+        if slurm_conf is None:
+            slurm_conf = load_slurm_conf(cfg, cluster)
+
+        self.cluster = cluster
+
+        slurm_nodes = slurm_conf['nodes']
+        slurm_partitions = slurm_conf['partitions']
+
+        query_grace = parse_elapsed(cfg.get('general', 'query_grace', '00:00:00'))
+
+        query_start_date = cfg.getdate('general', 'default_start', '1970-01-01')
+        start_date = query_start_date
+        if start is not None:
+            start_date = parse_slurm_date(start)
+            query_start_date = max(query_start_date, start_date - query_grace)
+
+        query_end_date = datetime.datetime.now()
+        end_date = query_end_date
+        if end is not None:
+            end_date = parse_slurm_date(end)
+            query_end_date = end_date + query_grace
 
-    if partition is not None:
-        # restrict to jobs running nodes from selected partition
-        pnodes = set(partition_nodes(slurm_partitions[partition]))
-        selected_nodes &= pnodes
+        self.start_date = start_date
+        self.end_date = end_date
+        self.query_start_date = query_start_date
+        self.query_end_date = query_end_date
 
-    node_restriction = False
+        # select report
+        self.report = report or cfg.get('general', 'default_report')
+        report_section = 'report:' + self.report
+        self.report_section = report_section
 
-    restrict_to_partitions_nodes = cfg.get(report_section, 'restrict_to_partitions_nodes', False) or None
-    if restrict_to_partitions_nodes is not None:
-        # restrict to jobs running on nodes from specified partitions nodes 
+        partition = cfg.get(report_section, 'partition', False) or None
 
-        restrict_to_partitions_nodes = sorted(restrict_to_partitions_nodes.split(','))
-        for part in restrict_to_partitions_nodes:
-            pnodes = set(partition_nodes(slurm_partitions[part]))
+        selected_nodes = set(slurm_nodes.keys())  # all nodes from cluster
+
+        if partition is not None:
+            # restrict to jobs running nodes from selected partition
+            pnodes = set(partition_nodes(slurm_partitions[partition]))
             selected_nodes &= pnodes
 
+        node_restriction = False
+
+        restrict_to_partitions_nodes = cfg.get(report_section, 'restrict_to_partitions_nodes', False) or None
+        if restrict_to_partitions_nodes is not None:
+            # restrict to jobs running on nodes from specified partitions nodes 
+
+            restrict_to_partitions_nodes = sorted(restrict_to_partitions_nodes.split(','))
+            for part in restrict_to_partitions_nodes:
+                pnodes = set(partition_nodes(slurm_partitions[part]))
+                selected_nodes &= pnodes
+
+                node_restriction = True
+
+
+        restrict_to_nodes_spec = cfg.get(report_section, 'restrict_to_nodes', False) or None
+        if restrict_to_nodes_spec is not None:
+            # restrict to jobs running on certain nodes
+            nnodes = set(parse_node_spec(restrict_to_nodes_spec))
+            selected_nodes &= nnodes
+
             node_restriction = True
 
 
-    restrict_to_nodes_spec = cfg.get(report_section, 'restrict_to_nodes', False) or None
-    if restrict_to_nodes_spec is not None:
-        # restrict to jobs running on certain nodes
-        nnodes = set(parse_node_spec(restrict_to_nodes_spec))
-        selected_nodes &= nnodes
+        selected_nodes_spec = None
+        if node_restriction:
+            selected_nodes_spec = node_spec_from_list(list(selected_nodes))
+
+        self.partition = partition
+        self.restrict_to_partitions_nodes = restrict_to_partitions_nodes
+        self.restrict_to_nodes_spec = restrict_to_nodes_spec
+        self.selected_nodes = selected_nodes
+        self.selected_nodes_spec = selected_nodes_spec
+        self.states = ['RUNNING']
 
-        node_restriction = True
+        # cores = cfg.get(report_section, 'cores', None)
+        cores = nodes_procs(selected_nodes, slurm_nodes)
+        if cluster is not None and not node_restriction and partition is None:
+            # whole cluster capacity may be set in its [cluster:NAME] section
+            cores = cfg.get('cluster:' + cluster, 'cores', False) or cores
 
+        self.cores = int(cores)
+        spans.configure(cfg)
+        duration = calendar().elapsed(print_datetime(start_date), print_datetime(end_date))
+        self.maxseconds = int(self.cores * duration)
 
-    selected_nodes_spec = None
-    if node_restriction:
-        selected_nodes_spec = node_spec_from_list(list(selected_nodes))
+        billing_weights = None
+        if partition is not None and 'TRESBillingWeights' in slurm_partitions[partition]:
+            billing_weights = parse_billing_weights(slurm_partitions[partition]['TRESBillingWeights'])
+        self.tres = nodes_tres(selected_nodes, slurm_nodes, billing_weights)
+        self.duration = duration
 
-    print(report_section, partition, restrict_to_partitions_nodes, restrict_to_nodes_spec, selected_nodes_spec)
+        register_histograms(cfg)
+        symbols.configure(cfg)
 
-    maxseconds = 1
-    # cores = cfg.get(report_section, 'cores', None)
-    cores = nodes_procs(selected_nodes, slurm_nodes)
+        if isinstance(grouping_specs, GroupingPlan):
+            self.plan = grouping_specs
+        else:
+            self.plan = grouping_plan(grouping_specs or cfg.get(report_section, 'grouping', False) or 'cpu_hours')
 
-    cores = int(cores)
-    duration = (end_date - start_date).total_seconds()
-    maxseconds = int(cores * duration)
+        if groupings is not None:
+            # shared with other cluster reports of a federation
+            self.groupings = groupings
+        else:
+            self.groupings = self.plan.new(start_date, end_date)
 
-    bins_dict = {
-        'cpu_seconds':CpuSecondsBin,
-        'cpu_hours':CpuHoursBin,
-        'job_count':JobCountBin,
-        'user':UserGroupingBin,
-        'group':GroupGroupingBin,
-        'job_start':StartGroupingBin,
-        'daily':lambda b: DailyGroupingBin(b, filling=(print_datetime(start_date), print_datetime(end_date))),
-        'monthly':lambda b: MonthlyGroupingBin(b, filling=(print_datetime(start_date), print_datetime(end_date))),
-    }
+        # fields deciding the header, of more groupings than computed here
+        self.header_fields = None
 
-    grouping_specs = (grouping_specs or cfg.get(report_section, 'grouping', False) or 'cpu_hours').split(',')
-    groupings = []
-    for grouping_spec in grouping_specs:
+    def __str__(self):
+        ret = ' '.join(str(e) for e in (self.report_section, self.partition,
+                                         self.restrict_to_partitions_nodes,
+                                         self.restrict_to_nodes_spec,
+                                         self.selected_nodes_spec))
+        if self.cluster is not None:
+            ret = '{} cluster={}'.format(ret, self.cluster)
+        return ret
+
+    def fetch_key(self):
+        """sacct filters of this report: reports sharing them may share queries"""
+        return (self.cluster, self.partition, self.selected_nodes_spec, tuple(self.states))
+
+    def fields(self):
+        """sacct fields needed by the groupings of this report"""
+        fields = {'start', 'end', 'ncpus', 'state'}
+        for grouping, _title in self.groupings:
+            fields |= grouping.fields()
+        # not a sacct field: set by the report itself
+        fields.discard('cluster')
+        if 'totalcpu' in fields or 'maxrss' in fields:
+            # to fold steps into their job
+            fields.add('jobid')
+        return fields
+
+    def uses_steps(self):
+        """job step usage (TotalCPU, MaxRSS) is only known with step rows"""
+        fields = self.fields()
+        return 'totalcpu' in fields or 'maxrss' in fields
+
+    def cluster_name(self):
+        return self.cluster or 'local'
+
+    def window(self, start_date, end_date):
+        """same selection over another period, with empty groupings"""
+        import copy
+
+        r = copy.copy(self)
+        r.start_date = r.query_start_date = start_date
+        r.end_date = r.query_end_date = end_date
+        r.duration = calendar().elapsed(print_datetime(start_date), print_datetime(end_date))
+        r.maxseconds = int(r.cores * r.duration)
+        r.groupings = self.plan.new(start_date, end_date)
+
+        return r
+
+    def batch(self, batch):
+        """columnar version of job(): clip a JobBatch, feed the groupings"""
+        start, end = print_datetime(self.start_date), print_datetime(self.end_date)
+        elapsed_seconds = calendar().elapsed
+
+        indices = []
+        starts = []
+        ends = []
+        seconds = []
+        cpuseconds = []
+        for i, (s, e, state, ncpus) in enumerate(zip(batch['start'], batch['end'],
+                                                     batch['state'], batch['ncpus'])):
+            if state == 'PENDING':
+                continue
 
-        grouping_def = [s.strip() for s in grouping_spec.split('*')]
-        title = grouping_def + []
-        grouping_def.reverse()
+            # timestamps share one format: compare them as strings
+            if e == 'Unknown' or e > end:
+                e = end
+            elif e < start:
+                continue
 
-        grouping = None
-        for g in grouping_def:
-            grouping = bins_dict[g](grouping)
+            if s > end:
+                continue
+            if s < start:
+                s = start
 
-        groupings.append((grouping, title))
+            indices.append(i)
+            starts.append(s)
+            ends.append(e)
+            elapsed = elapsed_seconds(s, e)
+            seconds.append(elapsed)
+            cpuseconds.append(elapsed * int(ncpus))
 
-    jobs = src(start=query_start_date.strftime('%Y-%m-%dT%H:%M:%S'),
-               end=query_end_date.strftime('%Y-%m-%dT%H:%M:%S'),
-               partition=partition,
-               nodes=selected_nodes_spec,
-               states=['RUNNING'])
+        if not indices:
+            return
+
+        n = len(indices)
+        clipped = batch.take(indices, start=starts, end=ends, seconds=seconds, cpuseconds=cpuseconds,
+                             cluster=[self.cluster_name()] * n, cores=[self.cores] * n,
+                             span=[self.duration] * n)
+
+        for grouping, _title in self.groupings:
+            grouping.batch(clipped)
 
-    #jobs.next()
-    for r in jobs:
+    def job(self, r):
         if r['state'] == 'PENDING':
-            continue
+            return
+        start_date, end_date = self.start_date, self.end_date
+
         jstart = parse_slurm_datetime(r['start'])
         jend = parse_slurm_datetime(r['end']) or end_date
 
         if jend and jend < start_date:
-            continue
+            return
 
         if jstart > end_date:
-            continue
+            return
 
         jstart = max(jstart, start_date)
         r['start'] = print_datetime(jstart)
@@ -567,71 +1847,232 @@ def sreporting(conf_file, report=None, grouping_specs=None, start=None, end=None
 
         r['end'] = print_datetime(jend)
 
-        elapsed = jend - jstart
+        elapsed = calendar().elapsed(r['start'], r['end'])
         cpus = int(r['ncpus'])
-        r['cpuseconds'] = elapsed.total_seconds() * cpus
+        r['seconds'] = elapsed
+        r['cpuseconds'] = elapsed * cpus
+        r['cluster'] = self.cluster_name()
+        r['cores'] = self.cores
+        r['span'] = self.duration
 
-        for grouping, _title in groupings:
+        for grouping, _title in self.groupings:
             grouping.job(r)
 
         #print(','.join([r[k] for k in src.format] + ['%.2f' % (elapsed.total_seconds()/3600)]))
 
-    rets = {}
-    for grouping, title in groupings:
+    def rescan(self):
+        """report recounting the groupings whose top-K leaders are not exact, or None
+
+        Call it once the jobs are accounted and feed the returned report the
+        same jobs again: its groupings are those of this report, top-K bins
+        emptied for a recount (see TopKGroupingBin). One recount is always
+        enough.
+        """
+        import copy
+
+        groupings = []
+        for grouping, title in self.groupings:
+            bins = list(topk_bins(grouping))
+            if all(b.confirmed() for b in bins):
+                continue
+
+            # leaf values are below the top-K bins: recount them all
+            for b in bins:
+                b.recount()
+            groupings.append((grouping, title))
+
+        if not groupings:
+            return None
+
+        r = copy.copy(self)
+        r.groupings = groupings
+        return r
+
+    def selection_header(self):
         ret = ''
 
-        if partition is not None:
-            ret += 'partition,{}\n'.format(partition)
+        if self.partition is not None:
+            ret += 'partition,{}\n'.format(self.partition)
 
-        if restrict_to_partitions_nodes is not None:
-            ret += 'restrict_to_partitions_nodes,{}\n'.format(','.join(restrict_to_partitions_nodes))
+        if self.restrict_to_partitions_nodes is not None:
+            ret += 'restrict_to_partitions_nodes,{}\n'.format(','.join(self.restrict_to_partitions_nodes))
 
-        if restrict_to_nodes_spec is not None:
-            ret += 'restrict_to_nodes,"{}"\n'.format(restrict_to_nodes_spec)
+        if self.restrict_to_nodes_spec is not None:
+            ret += 'restrict_to_nodes,"{}"\n'.format(self.restrict_to_nodes_spec)
 
         ret += 'selected_nodes,"{}"\n'.format(
-            selected_nodes_spec or node_spec_from_list(list(selected_nodes))
+            self.selected_nodes_spec or node_spec_from_list(list(self.selected_nodes))
         )
-        ret += 'cores,{}\n'.format(cores)
-        ret += 'max_seconds,{}\n'.format(maxseconds)
-        ret += 'max_hours,{}\n'.format(maxseconds // 3600)
-        ret += 'max_daily_hours,{}\n'.format(cores * 24)
-        ret += '\n'
-
-
-
-        indices = grouping.indices([])
-
-        if len(indices) == 0:
-            ret += '{}\n'.format(title[0])
-            ret += '{}\n'.format(grouping)
-        elif len(indices) == 1:
-            ret += '{}\n'.format('*'.join(title))
-            for i in indices[0]:
-                ret += '{}\n'.format('%s,%s' % (i, grouping[i]))
-        elif len(indices) == 2:
-            y, x = indices
-            ret += '{}\n'.format('*'.join(title))
-            ret += ','
-            ret += '{}\n'.format(','.join(x))
-            for i in y:
-                ret += i
-                for j in x:
-                    v = ''
-                    if j in grouping[i]:
-                        v = grouping[i][j][0]
-
-                    ret += ',%s' % v
-
-                ret += '\n'
-        else:
-            raise NotImplementedError
 
-        rets['*'.join(title)] = ret
+        return ret
+
+    def uses_tres(self):
+        return 'alloctres' in (self.header_fields or self.fields())
+
+    def header(self):
+        ret = self.selection_header()
+        if self.uses_tres():
+            ret += tres_header(self.tres, self.duration)
+        return ret + capacity_header(self.cores, self.maxseconds)
+
+    def render(self):
+        return render_groupings(self.header(), self.groupings)
+
+
+def capacity_header(cores, maxseconds):
+    ret = 'cores,{}\n'.format(cores)
+    ret += 'max_seconds,{}\n'.format(maxseconds)
+    ret += 'max_hours,{}\n'.format(maxseconds // 3600)
+    ret += 'max_daily_hours,{}\n'.format(cores * 24)
+    ret += '\n'
+
+    return ret
+
+
+def tres_header(tres, duration):
+    hours = duration / 3600.
+    ret = 'gpus,{}\n'.format(tres['gpu'])
+    ret += 'max_gpu_hours,{:.0f}\n'.format(tres['gpu'] * hours)
+    ret += 'memory_gb,{:.0f}\n'.format(tres['mem'] / 1024.)
+    ret += 'max_mem_gb_hours,{:.0f}\n'.format(tres['mem'] / 1024. * hours)
+    ret += 'billing,{:.0f}\n'.format(tres['billing'])
+    ret += 'max_billing_hours,{:.0f}\n'.format(tres['billing'] * hours)
+
+    return ret
+
+
+def render_groupings(header, groupings):
+    rets = {}
+    for grouping, title in groupings:
+        rets['*'.join(title)] = header + render_grouping(grouping, title)
 
     return rets
 
+
+def render_grouping(grouping, title):
+    ret = ''
+
+    indices = grouping.indices([])
+
+    if len(indices) == 0:
+        ret += '{}\n'.format(title[0])
+        ret += '{}\n'.format(grouping)
+    elif len(indices) == 1:
+        ret += '{}\n'.format('*'.join(title))
+        for i in indices[0]:
+            ret += '{}\n'.format('%s,%s' % (i, grouping[i]))
+    elif len(indices) == 2:
+        y, x = indices
+        ret += '{}\n'.format('*'.join(title))
+        ret += ','
+        ret += '{}\n'.format(','.join(x))
+        for i in y:
+            ret += i
+            for j in x:
+                v = ''
+                if j in grouping[i]:
+                    v = grouping[i][j][0]
+
+                ret += ',%s' % v
+
+            ret += '\n'
+    else:
+        raise NotImplementedError
+
+    return ret
+
+
+def leaves(tree, depth, keys=()):
+    """(keys, bin) of the bins depth levels down a grouping tree"""
+    if depth == 0:
+        yield keys, tree
+        return
+
+    for k in tree.key_list():
+        yield from leaves(tree[k], depth - 1, keys + (k, ))
+
+
+def sreporting(conf_file, report=None, grouping_specs=None, start=None, end=None, extra_options=[],
+               clusters=None, processes=1, source=None):
+    from . import config
+
+    # read report configuration
+    cfg = config.Config(conf_file)
+    if source is not None:
+        cfg.set('general', 'source', source)
+
+    clusters = cluster_list(cfg, clusters)
+    if clusters is not None:
+        from .federation import federated_sreporting
+
+        return federated_sreporting(cfg, clusters, report, grouping_specs, start, end,
+                                    extra_options, processes)
+
+    r = Report(cfg, report, grouping_specs, start, end)
+
+    if cfg.getboolean(r.report_section, 'use_sreport_rollups', False):
+        from . import reconcile
+
+        if reconcile.rollup_answerable(r):
+            print(r, 'from sreport rollups')
+            rows = reconcile.sreport_rows(make_sreport(cfg, include_header=False), r.start_date,
+                                          r.end_date)
+            reconcile.fill_from_rollups(r, rows)
+            return r.render()
+
+    src = make_sacct(cfg, format=Sacct.sorted_format(r.fields()), extra_options=extra_options)
+
+    print(r)
+
+    if processes > 1:
+        from . import planner
+
+        planner.execute(planner.plan([r]), src, processes=processes)
+        return r.render()
+
+    def batches():
+        return src.batches(start=r.query_start_date.strftime('%Y-%m-%dT%H:%M:%S'),
+                           end=r.query_end_date.strftime('%Y-%m-%dT%H:%M:%S'),
+                           partition=r.partition,
+                           nodes=r.selected_nodes_spec,
+                           states=r.states,
+                           steps=r.uses_steps())
+
+    for batch in batches():
+        r.batch(batch)
+
+    # top-K leaders not exact after one pass
+    rescan = r.rescan()
+    if rescan is not None:
+        for batch in batches():
+            rescan.batch(batch)
+
+    return r.render()
+
+def rolling_sreporting(conf_file, report=None, grouping_specs=None, length='7d',
+                       extra_options=[], state_path=None):
+    from . import config
+    from .rolling import RollingWindow
+
+    cfg = config.Config(conf_file)
+
+    w = RollingWindow(cfg, report, grouping_specs, length, extra_options=extra_options)
+
+    if state_path is not None:
+        w.load(state_path)
+
+    w.refresh()
+    print(w.proto, 'last', length)
+
+    if state_path is not None:
+        w.save(state_path)
+
+    return w.render()
+
 def main(cfg_path='sreporting.conf'):
+    import argparse
+    from . import config
+
     if not os.path.isabs(cfg_path):
         cfg_path = config.find_config_file(__file__, cfg_path)
 
@@ -647,14 +2088,35 @@ def main(cfg_path='sreporting.conf'):
                         default=None, help='grouping')
     parser.add_argument('-o', '--options', metavar='EXTRA_SACCT_OPTIONS',
                         default='', help='sacct extra options')
+    parser.add_argument('-c', '--clusters', metavar='CLUSTERS',
+                        default=None, help='comma separated [cluster:NAME] sections '
+                        '(default from [general] clusters)')
+    parser.add_argument('-j', '--processes', metavar='N', type=int, default=1,
+                        help='account jobs on N processes')
+    parser.add_argument('--last', metavar='LENGTH', default=None,
+                        help='rolling window up to now instead of START/END_DATE (24h, 7d...)')
+    parser.add_argument('--state', metavar='PATH', default=None,
+                        help='with --last, keep the hourly aggregates in PATH between runs')
+    parser.add_argument('--source', metavar='SOURCE', default=None,
+                        help='read jobs from SOURCE instead of sacct (dump:PATH, archive:DIR, '
+                        'mysqldump:PATH)')
 
     parser.add_argument('--cfg', metavar='PATH',
                         default=cfg_path, help='config file (default=%s)' % cfg_path)
 
     args = parser.parse_args()
 
+    if args.last is not None:
+        rets = rolling_sreporting(args.cfg, args.report, grouping_specs=args.grouping,
+                                  length=args.last, extra_options=args.options.split(),
+                                  state_path=args.state)
+        for ret in rets.values():
+            print(ret)
+        return
+
     rets = sreporting(args.cfg, args.report, grouping_specs=args.grouping, start=args.start, end=args.end,
-                      extra_options=args.options.split())
+                      extra_options=args.options.split(), clusters=args.clusters,
+                      processes=args.processes, source=args.source)
 
     for ret in rets.values():
         print(ret)
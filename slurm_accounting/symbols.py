@@ -0,0 +1,86 @@
+"""Interned job field values.
+
+sacct repeats the same few thousand users, groups, accounts, partitions and
+states over millions of rows. Batches get one canonical str object per
+distinct value of these fields instead of a fresh one per row: all the jobs
+and grouping bins of a process share it, and str objects cache their hash,
+so grouping trees hash each name once rather than once per job and grouping.
+
+Numeric uids and gids (sacct prints them for users unknown to the host it
+runs on) can be resolved to names from passwd and group file snapshots:
+
+    [general]
+    passwd = /var/lib/sreporting/passwd
+    group = /var/lib/sreporting/group
+"""
+
+
+class SymbolTable(object):
+    def __init__(self):
+        # value: canonical value, aliases map to another name
+        self.canonical = {}
+
+    def __len__(self):
+        return len(self.canonical)
+
+    def intern(self, s):
+        return self.canonical.setdefault(s, s)
+
+    def intern_column(self, values):
+        return list(map(self.canonical.setdefault, values, values))
+
+    def alias(self, s, name):
+        """intern s as name (e.g. a uid as its user name)"""
+        self.canonical[s] = self.intern(name)
+
+
+# fields interned by split_blocks() and Sacct
+TABLES = {
+    'user': SymbolTable(),
+    'group': SymbolTable(),
+    'account': SymbolTable(),
+    'partition': SymbolTable(),
+    'state': SymbolTable(),
+    'cluster': SymbolTable(),
+}
+
+
+def intern_columns(columns):
+    """intern the values of the TABLES fields of a {field: values} dict"""
+    for field, values in columns.items():
+        if field in TABLES:
+            columns[field] = TABLES[field].intern_column(values)
+    return columns
+
+
+def intern_row(row):
+    for field, table in TABLES.items():
+        if field in row:
+            row[field] = table.intern(row[field])
+    return row
+
+
+def read_ids(f):
+    """{id: name} of a passwd or group file (name:x:id:...)"""
+    ret = {}
+    for line in f:
+        fields = line.split(':')
+        if len(fields) > 2 and not line.startswith('#'):
+            ret[fields[2]] = fields[0]
+    return ret
+
+
+_configured = {}
+
+
+def configure(cfg):
+    """resolve uids/gids with the passwd/group snapshots of [general], once"""
+    for field, option in (('user', 'passwd'), ('group', 'group')):
+        path = cfg.get('general', option, '') or None
+        if path is None or _configured.get(field) == path:
+            continue
+
+        with open(path) as f:
+            for i, name in read_ids(f).items():
+                TABLES[field].alias(i, name)
+        _configured[field] = path
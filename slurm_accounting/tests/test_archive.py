@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from slurm_accounting import golden
+from slurm_accounting.archive import Archive, read_dump
+from slurm_accounting.sreport import sreporting
+
+GROUPING = 'user*cpu_hours,group*job_count,account*gpu_hours,daily*cpu_seconds'
+
+
+class ArchiveStepsTest(unittest.TestCase):
+    """fill from a dump with job step rows"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cfg = os.path.join(self.dir, 'sreporting.conf')
+        self.jobs = os.path.join(self.dir, 'jobs.txt')
+        golden.write_config(self.cfg, self.jobs)
+        with open(self.jobs, 'wb') as f:
+            f.write(golden.random_jobs(2000))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_fill(self):
+        archive = Archive(os.path.join(self.dir, 'archive'))
+        with open(self.jobs) as f:
+            n = archive.fill(read_dump(f))
+        archive.close()
+
+        with open(self.jobs) as f:
+            started = [r for r in read_dump(f)
+                       if '.' not in r['jobid'] and r['start'] != 'Unknown']
+        self.assertEqual(n, len(started))
+
+        expected = golden.quiet(sreporting, self.cfg, golden.REPORT, GROUPING, *golden.PERIOD)
+        got = golden.quiet(sreporting, self.cfg, golden.REPORT, GROUPING, *golden.PERIOD,
+                           source='archive:' + archive.path)
+        self.assertEqual(got, expected)
+        self.assertNotIn('\n,', got['user*cpu_hours'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import datetime
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from slurm_accounting import golden
+from slurm_accounting.config import Config
+from slurm_accounting.daemon import JobCache, cache_fields
+from slurm_accounting.sreport import JobBatch
+
+
+class FakeSacct(object):
+    """jobs of the last refresh only, as they are at that time"""
+    format = ('jobid', 'end', 'ncpus')
+
+    def __init__(self):
+        self.rows = []
+
+    def batches(self, start=None, end=None, states=[], steps=False):
+        columns = list(zip(*self.rows)) or [()] * len(self.format)
+        yield JobBatch(dict(zip(self.format, (list(c) for c in columns))), len(self.rows))
+
+
+class JobCacheTest(unittest.TestCase):
+    def test_refreshes(self):
+        rnd = random.Random(1)
+        src = FakeSacct()
+        now = datetime.datetime(2024, 1, 1)
+        cache = JobCache(src, now, datetime.timedelta(minutes=10))
+        jobs = {}
+
+        for refresh in range(300):
+            src.rows = []
+            for _ in range(rnd.randint(0, 40)):
+                # new jobs, jobs ending, and late records changing ended jobs
+                jobid = str(rnd.randint(0, 2000))
+                end = 'Unknown' if rnd.random() < .3 else str(refresh)
+                src.rows.append((jobid, end, str(rnd.randint(1, 4))))
+            src.rows += [(j, end, n) for j, (end, n) in jobs.items()
+                         if end == 'Unknown' and rnd.random() < .8]
+            for jobid, end, n in src.rows:
+                jobs[jobid] = (end, n)
+
+            now += datetime.timedelta(minutes=5)
+            cache.refresh(now)
+
+            rows = [r for b in cache.raw_batches() for r in zip(b['jobid'], b['end'], b['ncpus'])]
+            self.assertEqual(len(rows), len(jobs))
+            self.assertEqual({j: (e, n) for j, e, n in rows}, jobs)
+            self.assertEqual(len(cache), len(jobs))
+
+        self.assertLess(len(cache.chunks), 12)
+
+
+class CacheFieldsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def fields(self, *groupings):
+        path = os.path.join(self.dir, 'sreporting.conf')
+        golden.write_config(path, os.path.join(self.dir, 'jobs.txt'), 'UTC')
+        with open(path, 'a') as f:
+            for i, g in enumerate(groupings):
+                f.write('\n[report:r{}]\ngrouping = {}\n'.format(i, g))
+        return cache_fields(Config(path))
+
+    def test_steps_only_when_used(self):
+        self.assertFalse({'totalcpu', 'maxrss'} & self.fields('user*cpu_hours'))
+        self.assertIn('totalcpu', self.fields('user*cpu_hours', 'account*cpu_efficiency'))
+        self.assertIn('alloctres', self.fields('user*cpu_hours'))
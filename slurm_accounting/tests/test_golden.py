@@ -0,0 +1,61 @@
+"""Engines against reports of the baseline sreporting()
+
+baseline/ holds a sacct dump (golden.random_jobs(1000, 7)), its slurm.conf
+and the reports computed from them by sreporting() of the first commit
+(bb37fcf), sacct -X --state=RUNNING being emulated over the dump. They are
+frozen: unlike golden, which compares engines with the current sreporting(),
+sreporting() itself is checked here.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from slurm_accounting import golden
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline')
+
+
+class BaselineTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        with open(os.path.join(BASELINE, 'reports.json')) as f:
+            self.baseline = json.load(f)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def config(self, partition):
+        path = os.path.join(self.dir, 'sreporting.conf')
+        with open(path, 'w') as f:
+            f.write('[general]\n')
+            f.write('source = dump:%s\n' % os.path.join(BASELINE, 'jobs.txt.gz'))
+            f.write('slurm_conf = %s\n' % os.path.join(BASELINE, 'slurm.conf'))
+            # the baseline had naive datetimes
+            f.write('timezone = UTC\n')
+            f.write('\n[report:%s]\n' % golden.REPORT)
+            if partition is not None:
+                f.write('partition = %s\n' % partition)
+            f.write('\n[periodic_reports]\nreport_dir = %s\n' % os.path.join(self.dir, 'reports'))
+        return path
+
+    def test_engines(self):
+        for report in self.baseline['reports']:
+            cfg_path = self.config(report['partition'])
+            expected = report['groupings']
+
+            for engine in sorted(golden.ENGINES):
+                with self.subTest(engine=engine, partition=report['partition'],
+                                  start=report['start'], end=report['end']):
+                    try:
+                        got, _ = golden.run(engine, cfg_path, self.baseline['grouping'],
+                                            report['start'], report['end'])
+                    except ValueError:
+                        # rollups of partial months...
+                        continue
+
+                    self.assertTrue(got)
+                    for title in got:
+                        self.assertEqual(got[title], expected[title], title)
@@ -0,0 +1,77 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from slurm_accounting import golden
+from slurm_accounting.periodic_reports import month_parts, period_units, run_units
+
+
+class LegacyOutputsTest(unittest.TestCase):
+    """CSVs written before fingerprints, without sidecar"""
+    GROUPING = 'user*cpu_hours'
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cfg_path = os.path.join(self.dir, 'sreporting.conf')
+        jobs = os.path.join(self.dir, 'jobs.txt')
+        with open(jobs, 'wb') as f:
+            f.write(golden.random_jobs(500))
+        golden.write_config(self.cfg_path, jobs, 'UTC')
+
+        report_dir = os.path.join(self.dir, 'reports')
+        self.parts = month_parts(report_dir, datetime.datetime(2024, 1, 1),
+                                 datetime.datetime(2024, 3, 1))
+        self.periodic()
+
+        # January as written by an older version
+        self.csv = os.path.join(self.parts[0][0], '{}-{}'.format(golden.REPORT, self.GROUPING))
+        os.remove(self.csv + '.json')
+        with open(self.csv + '.csv', 'a') as f:
+            f.write('legacy\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def periodic(self, **kwargs):
+        reports = {golden.REPORT: self.GROUPING}
+        units = [u for part, s, e in self.parts
+                 for u in period_units(reports, s, e, part, (s.year, s.month))]
+        golden.quiet(run_units, self.cfg_path, units, **kwargs)
+
+    def legacy(self):
+        with open(self.csv + '.csv') as f:
+            return f.read().endswith('legacy\n')
+
+    def test_kept_then_fingerprinted(self):
+        self.periodic()
+        self.assertTrue(self.legacy())
+        self.assertTrue(os.path.isfile(self.csv + '.json'))
+
+        self.periodic()
+        self.assertTrue(self.legacy())
+
+        # inputs changed since
+        with open(self.cfg_path, 'a') as f:
+            f.write('\n[histogram:size]\nfield = ncpus\nedges = 1,8,64\n')
+        self.periodic()
+        self.assertFalse(self.legacy())
+
+    def test_recompute(self):
+        self.periodic(recompute=True)
+        self.assertFalse(self.legacy())
+
+    def test_not_rolled_up(self):
+        self.periodic()
+        start, end = datetime.datetime(2024, 1, 1), datetime.datetime(2024, 3, 1)
+        rollup = os.path.join(self.dir, 'reports', 'rollup')
+        units = period_units({golden.REPORT: self.GROUPING}, start, end, rollup, ('rollup', ),
+                             self.parts)
+        golden.quiet(run_units, self.cfg_path, units)
+
+        with open(os.path.join(rollup, '{}-{}.csv'.format(golden.REPORT, self.GROUPING))) as f:
+            csv = f.read().split('\n\n', 1)[1]
+        expected = golden.sreporting_engine(self.cfg_path, self.GROUPING, '2024-01-01',
+                                            '2024-03-01')
+        self.assertEqual(csv, expected[self.GROUPING])
@@ -0,0 +1,47 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from slurm_accounting import golden
+from slurm_accounting.config import Config
+from slurm_accounting.rolling import RollingWindow
+
+
+class RollingStateTest(unittest.TestCase):
+    """saved hours are only reused with the inputs they were computed from"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cfg_path = os.path.join(self.dir, 'sreporting.conf')
+        self.state = os.path.join(self.dir, 'state.json')
+        jobs = os.path.join(self.dir, 'jobs.txt')
+        with open(jobs, 'wb') as f:
+            f.write(golden.random_jobs(500))
+        golden.write_config(self.cfg_path, jobs, 'UTC')
+
+        w = self.window()
+        w.refresh(datetime.datetime(2024, 2, 1, 12, 30))
+        w.save(self.state)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def window(self):
+        return RollingWindow(Config(self.cfg_path), golden.REPORT, 'user*cpu_hours', '24h')
+
+    def test_same_inputs(self):
+        self.assertTrue(self.window().load(self.state))
+
+    def test_report_section_changed(self):
+        with open(self.cfg_path) as f:
+            cfg = f.read()
+        with open(self.cfg_path, 'w') as f:
+            f.write(cfg.replace('[report:%s]\n' % golden.REPORT,
+                                '[report:%s]\npartition = gpu\n' % golden.REPORT))
+        self.assertFalse(self.window().load(self.state))
+
+    def test_histogram_changed(self):
+        with open(self.cfg_path, 'a') as f:
+            f.write('\n[histogram:size]\nfield = ncpus\nedges = 1,8,64\n')
+        self.assertFalse(self.window().load(self.state))
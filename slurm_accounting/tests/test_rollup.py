@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from slurm_accounting import golden
+from slurm_accounting.sreport import TopKGroupingBin, grouping_plan
+
+GROUPING = 'top_user(2)*cpu_hours,monthly*top_user(2)*cpu_hours,daily*top_user(2)*job_count'
+
+
+def job(jobid, user, start, end, ncpus=1):
+    values = dict.fromkeys(golden.FORMAT, '')
+    values.update(jobid=str(jobid), user=user, ncpus=str(ncpus), partition='batch',
+                  nodelist='n000', group='g', account='a', start=start, end=end,
+                  state='COMPLETED', alloctres='cpu=%d,mem=1000M,node=1' % ncpus,
+                  totalcpu='00:00:00', elapsedraw='0', elapsed='00:00:00')
+    return '|'.join(values[f] for f in golden.FORMAT) + '\n'
+
+
+class TopKRollupTest(unittest.TestCase):
+    """monthly parts whose top-K leaders were recounted"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cfg = os.path.join(self.dir, 'sreporting.conf')
+        jobs = os.path.join(self.dir, 'jobs.txt')
+        golden.write_config(self.cfg, jobs)
+
+        lines = ['|'.join(golden.FORMAT) + '\n']
+        # one-off users fill the summary, then a late heavy user
+        for i in range(15000):
+            day = 1 + i % 28
+            lines.append(job(1000 + i, 'v%d' % i, '2024-01-%02dT10:00:00' % day,
+                             '2024-01-%02dT10:01:00' % day))
+        lines.append(job(20000, 'heavy', '2024-01-30T00:00:00', '2024-01-31T00:00:00', 64))
+        for i in range(50):
+            day = 1 + i % 28
+            lines.append(job(30000 + i, 'u%d' % (i % 3), '2024-02-%02dT08:00:00' % day,
+                             '2024-02-%02dT12:00:00' % day, 4))
+
+        with open(jobs, 'w') as f:
+            f.writelines(lines)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_not_mergeable(self):
+        plan = grouping_plan(GROUPING)
+        for title in plan.titles:
+            self.assertFalse(plan.mergeable(title))
+
+    def test_rollup(self):
+        expected = golden.sreporting_engine(self.cfg, GROUPING, '2024-01-01', '2024-04-01')
+        got = golden.rollup_engine(self.cfg, GROUPING, '2024-01-01', '2024-04-01')
+        self.assertEqual(got, expected)
+        self.assertIn('heavy', expected['top_user(2)*cpu_hours'])
+
+    def test_sidecar_bounded(self):
+        from slurm_accounting import config
+        from slurm_accounting.periodic_reports import month_dir
+        from slurm_accounting.report_store import make_store
+
+        golden.rollup_engine(self.cfg, GROUPING, '2024-01-01', '2024-04-01')
+
+        cfg = config.Config(self.cfg)
+        store = make_store(cfg)
+        part = month_dir(cfg.get('periodic_reports', 'report_dir'), 2024, 1)
+        state = store.sidecar(part, 'golden-top_user(2)*cpu_hours')['state']
+
+        capacity = max(TopKGroupingBin.CAPACITY_FACTOR * 2, 2 + 8)
+        self.assertLessEqual(len(state['keys']), capacity)
+
+
+if __name__ == '__main__':
+    unittest.main()
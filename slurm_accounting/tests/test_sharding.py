@@ -0,0 +1,35 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from slurm_accounting import config, golden, planner, sharding
+from slurm_accounting.sreport import Report, Sacct, make_sacct
+
+
+class WorkerDeathTest(unittest.TestCase):
+    """a killed worker fails the run rather than hanging it"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cfg_path = os.path.join(self.dir, 'sreporting.conf')
+        jobs = os.path.join(self.dir, 'jobs.txt')
+        with open(jobs, 'wb') as f:
+            f.write(golden.random_jobs(3000))
+        golden.write_config(self.cfg_path, jobs, 'UTC')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_killed_worker(self):
+        cfg = config.Config(self.cfg_path)
+        r = Report(cfg, golden.REPORT, 'user*cpu_hours', *golden.PERIOD)
+        src = make_sacct(cfg, format=Sacct.sorted_format(r.fields()))
+        # forked workers inherit it, as by the OOM killer
+        r.batch = lambda batch: os._exit(9)
+
+        t = time.time()
+        with self.assertRaisesRegex(RuntimeError, 'died'):
+            sharding.execute(planner.plan([r]), src, processes=2, block_size=4096,
+                             queue_size=1, poll=.1)
+        self.assertLess(time.time() - t, 30)
@@ -0,0 +1,46 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from slurm_accounting import golden
+from slurm_accounting.sources import DumpSacct
+
+
+class DumpStepsTest(unittest.TestCase):
+    """dumps made without sacct -X: one row per job on every query"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'jobs.txt')
+        with open(self.path, 'wb') as f:
+            f.write(golden.random_jobs(2000))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def rows(self, **kwargs):
+        src = DumpSacct(self.path, ('jobid', 'partition', 'totalcpu', 'maxrss'))
+        return [r for b in src.batches(start='2024-01-01', end='2024-04-01', **kwargs)
+                for r in b.rows()]
+
+    def test_no_steps(self):
+        rows = self.rows()
+        jobids = [r['jobid'] for r in rows]
+        self.assertEqual(len(jobids), len(set(jobids)))
+        self.assertFalse([j for j in jobids if '.' in j])
+
+    def test_steps_follow_their_job(self):
+        every = {r['jobid']: r for r in self.rows(steps=True)}
+        gpu = self.rows(steps=True, partition='gpu')
+
+        self.assertTrue(gpu)
+        self.assertEqual(len(gpu), len({r['jobid'] for r in gpu}))
+        for r in gpu:
+            self.assertEqual(r['partition'], 'gpu')
+            # steps have no partition, yet are folded into their job
+            self.assertEqual(r, every[r['jobid']])
+        self.assertTrue([r for r in gpu if r['maxrss'] > 0])
+
+
+if __name__ == '__main__':
+    unittest.main()